@@ -1,7 +1,11 @@
-from pyliftover import LiftOver
+import os
 import sys
 import csv 
 
+# the liftover module of the CLI converts the positions offline with the chain files in update_database_scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "downloadables"))
+import liftover
+
 # $1 = path to .map file (specific to a certain population and reference genome) created in step 5
 # $2-$6 = path to each combined .clumped files (AFR, AMR, EAS, EUR, SAS) created in step 9
 # $7 = output file path
@@ -11,19 +15,19 @@ import csv
 def getPosMap():
     print("creating position map")
     mapFile = open(sys.argv[1], 'r')
-    posMap = {}
-    lo = LiftOver('hg19', sys.argv[8])
+    snpToChromPos = {}
     for line in mapFile:
         line = line.strip()
         values = line.split()
-        chrom = "chr" + str(values[0])
-        pos = values[3]
-        liftOverObj = lo.convert_coordinate(chrom, int(pos))
         snp = values[1]
-        if liftOverObj != None and liftOverObj != []:
-                newPos = liftOverObj[0][1]
-                chromPos = str(values[0]) + ":" + str(newPos)
-                posMap[snp] = chromPos
+        snpToChromPos[snp] = str(values[0]) + ":" + values[3]
+    mapFile.close()
+    # the positions are converted in one batch
+    convertedPositions = liftover.convertPositions(snpToChromPos.values(), 'hg19', sys.argv[8])
+    posMap = {}
+    for snp, chromPos in snpToChromPos.items():
+        if chromPos in convertedPositions:
+            posMap[snp] = convertedPositions[chromPos]
     print("map created")
     return posMap
 
@@ -0,0 +1,129 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+
+# Persistent store of the possible alleles of each rsID, used for strand flipping.
+#
+# The store is a SQLite database in .workingFiles with one row per rsID, seeded from the possible alleles file
+# downloaded from the server (.workingFiles/allPossibleAlleles.txt) or the one the server is built from
+# (preppedServerFiles/allPossibleAlleles.txt). A seed file is loaded again when its modification time or size
+# changes. The alleles of rsIDs that aren't in the store are queried from MyVariant by connect_to_server.py and
+# written back, so only rsIDs that have never been seen need a network call. rsIDs MyVariant doesn't know are
+# stored with no alleles, so they aren't queried again either.
+
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles", "alleles.sqlite")
+SEED_PATHS = (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "preppedServerFiles", "allPossibleAlleles.txt"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles", "allPossibleAlleles.txt")
+)
+# the per-request caches of MyVariant results the store replaces
+LEGACY_CACHE_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "alleles_*.json")
+# sqlite limits the number of parameters of a statement
+LOOKUP_BATCH_SIZE = 500
+
+# the store opened by each thread of this process (sqlite connections can't be shared between threads)
+openStores = threading.local()
+
+
+class AlleleStore:
+    """
+    rsID -> list of possible alleles, kept in a SQLite database.
+    """
+
+    def __init__(self, storePath):
+        self.storePath = storePath
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(storePath)), exist_ok=True)
+        self.connection = sqlite3.connect(storePath, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS alleles (rsID TEXT PRIMARY KEY, alleles TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS seeds (path TEXT PRIMARY KEY, sourceMtime INTEGER NOT NULL, sourceSize INTEGER NOT NULL)")
+
+    def close(self):
+        self.connection.close()
+
+    def getAlleles(self, rsIDs):
+        # returns {rsID: alleles} for the rsIDs that are in the store
+        rsIDs = list(rsIDs)
+        found = {}
+        for start in range(0, len(rsIDs), LOOKUP_BATCH_SIZE):
+            batch = rsIDs[start:start + LOOKUP_BATCH_SIZE]
+            query = "SELECT rsID, alleles FROM alleles WHERE rsID IN ({0})".format(", ".join("?" * len(batch)))
+            for rsID, alleles in self.connection.execute(query, batch):
+                found[rsID] = json.loads(alleles)
+        return found
+
+    def putAlleles(self, allelesByRsID):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO alleles (rsID, alleles) VALUES (?, ?)",
+                ((rsID, json.dumps(sorted(alleles))) for rsID, alleles in allelesByRsID.items()))
+
+    def seed(self, seedPath):
+        # loads the possible alleles file at seedPath if it changed since it was last loaded
+        try:
+            sourceStat = os.stat(seedPath)
+        except OSError:
+            return
+        row = self.connection.execute("SELECT sourceMtime, sourceSize FROM seeds WHERE path = ?", (seedPath,)).fetchone()
+        if row is not None and row[0] == sourceStat.st_mtime_ns and row[1] == sourceStat.st_size:
+            return
+        try:
+            with open(seedPath, 'r', encoding="utf-8") as f:
+                possibleAlleles = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Could not load the possible alleles in {seedPath}: {e}")
+            return
+        self.putAlleles({rsID: alleles for rsID, alleles in possibleAlleles.items() if isinstance(alleles, list)})
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO seeds (path, sourceMtime, sourceSize) VALUES (?, ?, ?)",
+                (seedPath, sourceStat.st_mtime_ns, sourceStat.st_size))
+        print(f"[LOG] Loaded the possible alleles of {len(possibleAlleles)} rsIDs from {seedPath} into the allele store")
+
+    def importLegacyCaches(self):
+        # moves the results of the old per-request caches into the store
+        for cachePath in glob.glob(LEGACY_CACHE_GLOB):
+            try:
+                with open(cachePath, 'r', encoding="utf-8") as f:
+                    cached = json.load(f)
+                # the old caches also stored empty results for failed queries, so only found alleles are kept
+                self.putAlleles({rsID: alleles for rsID, alleles in cached.items() if alleles})
+            except (OSError, ValueError):
+                pass
+            os.remove(cachePath)
+
+
+def getAlleleStore(storePath=None):
+    # returns the allele store of this thread, opening (and seeding) it the first time
+    storePath = storePath or os.environ.get("PRS_ALLELE_STORE_PATH", DEFAULT_STORE_PATH)
+    store = getattr(openStores, 'store', None)
+    if store is not None and store.pid == os.getpid() and store.storePath == storePath:
+        return store
+    store = AlleleStore(storePath)
+    for seedPath in SEED_PATHS:
+        store.seed(seedPath)
+    store.importLegacyCaches()
+    openStores.store = store
+    return store
+
+
+def lookupAlleles(rsIDs, fetchAlleles):
+    """
+    Returns {rsID: possible alleles} for rsIDs, from the store when possible.
+
+    Args:
+        rsIDs: the rsIDs to look up
+        fetchAlleles: function that takes a list of the rsIDs missing from the store and returns
+                      {rsID: alleles} for the ones it could query. The results are added to the store
+    """
+    store = getAlleleStore()
+    uniqueRsIDs = list(dict.fromkeys(rsIDs))
+    found = store.getAlleles(uniqueRsIDs)
+    missing = [rsID for rsID in uniqueRsIDs if rsID not in found]
+    print(f"[LOG] Allele store: {len(found)} of {len(uniqueRsIDs)} rsIDs found, {len(missing)} to query")
+    if missing:
+        fetched = fetchAlleles(missing)
+        store.putAlleles(fetched)
+        found.update(fetched)
+    return found
@@ -3,13 +3,21 @@ import math
 import csv
 import os
 from filelock import FileLock
+import sparse_score as ss
+import output_writer as ow
 
-def calculateScore(snpSet, parsedObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, sample_num, trait, studyID, pValueAnno, betaAnnotation, valueType, isRSids, sampleOrder, snpOverlap, excludedSnps, includedSnps, preferredPop):
+# numpy is optional. It is used to find the percentile ranks of every sample of a study at once
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def calculateScore(snpSet, parsedObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, sample_num, trait, studyID, pValueAnno, betaAnnotation, valueType, isRSids, sampleOrder, snpOverlap, excludedSnps, includedSnps, preferredPop, genotypeSources=None):
     # check if the input file is a txt or vcf file and then run the calculations on that file
     if isRSids:
         txtcalculations(snpSet, parsedObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, trait, studyID, pValueAnno, betaAnnotation, valueType, snpOverlap, excludedSnps, includedSnps, preferredPop)
     else:
-        vcfcalculations(snpSet, parsedObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, sample_num, trait, studyID, pValueAnno, betaAnnotation, valueType, sampleOrder, snpOverlap, excludedSnps, includedSnps, preferredPop)
+        vcfcalculations(snpSet, parsedObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, sample_num, trait, studyID, pValueAnno, betaAnnotation, valueType, sampleOrder, snpOverlap, excludedSnps, includedSnps, preferredPop, genotypeSources)
     return
 
 
@@ -123,7 +131,7 @@ def txtcalculations(snpSet, txtObj, tableObjDict, mafDict, percentileDict, isJso
     return
 
 
-def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFile, samp_num, trait, studyID, pValueAnno, betaAnnotation, valueType, sampleOrder, snpOverlap, excludedSnps, includedSnps, preferredPop):
+def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFile, samp_num, trait, studyID, pValueAnno, betaAnnotation, valueType, sampleOrder, snpOverlap, excludedSnps, includedSnps, preferredPop, genotypeSources=None):
     # this variable is used as a key in various dictionaries. Due to the nature of the studies in our database, 
     # we separate calculations by trait, studyID, pValueAnnotation, betaAnnotation, and valueType. 
     pValBetaAnnoValType = "|".join((pValueAnno, betaAnnotation, valueType))
@@ -134,6 +142,15 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
     json_study_results = {}
     json_samp_list = []
 
+    # the condensed format doesn't report the variant sets, so if numpy and scipy are installed,
+    # the scores of every sample can be calculated in one sparse matrix product instead of sample by sample
+    sparseScores = None
+    if isCondensedFormat and not isJson and ss.HAS_SPARSE and studyID in tableObjDict['studyIDsToMetaData'].keys():
+        sparseScores, sparseUnits = ss.calculateSparseScores(snpSet, vcfObj, tableObjDict, mafDict, neutral_snps_map, trait, studyID, pValBetaAnnoValType, valueType, sampleOrder, genotypeSources)
+
+    # the percentiles of the study are converted to a sorted array once and searched for each score
+    percentileArray = getPercentileArray(percentileDict, omitPercentiles)
+
     # For every sample in the vcf nested dictionary
     for samp in sampleOrder:
         samp_count += 1
@@ -151,8 +168,10 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
             riskVariants = set()
             mark = False
 
+            if sparseScores is not None:
+                betaUnits = sparseUnits[samp_count - 1]
             # Loop through each snp associated with this disease/study/sample
-            if samp in vcfObj:
+            elif samp in vcfObj:
                 for rsID in vcfObj[samp]:
                     if rsID in snpSet:
                         for riskAllele in tableObjDict['associations'][rsID]['traits'][trait][studyID][pValBetaAnnoValType]:
@@ -197,10 +216,13 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
                 studyUnits = "NA"
 
             # add necessary marks to study/score
-            prs, printStudyID = createMarks(betas, nonMissingSnps, studyID, mark, valueType)
-            percentileRank = getPercentile(prs, percentileDict, omitPercentiles)
+            if sparseScores is not None:
+                prs, printStudyID = sparseScores[samp_count - 1], studyID
+            else:
+                prs, printStudyID = createMarks(betas, nonMissingSnps, studyID, mark, valueType)
             # if the output format is verbose
             if not isCondensedFormat and not isJson:
+                percentileRank = getPercentiles([prs], percentileDict, omitPercentiles, percentileArray)[0]
                 #grab variant sets
                 protectiveVariants, riskVariants, unmatchedAlleleVariants, clumpedVariants = formatSets(protectiveVariants, riskVariants, unmatchedAlleleVariants, clumpedVariants)
                 # add new line to tsv file
@@ -227,7 +249,7 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
                 json_sample_results = {
                     'sample': samp,
                     'polygenicRiskScore': prs,
-                    'percentile': percentileRank,
+                    'percentile': None, # filled in for every sample once all of the scores are calculated
                     'snpOverlap': snpOverlap[samp],
                     'includedSnps': includedSnps[samp],
                     'protectiveVariants': "|".join(protectiveVariants),
@@ -241,6 +263,9 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
                 # check if scores for all the samples have been calculated
                 # if so, write the object to the json file
                 if samp_count == samp_num:
+                    percentileRanks = getPercentiles([x['polygenicRiskScore'] for x in json_samp_list], percentileDict, omitPercentiles, percentileArray)
+                    for json_sample_results, percentileRank in zip(json_samp_list, percentileRanks):
+                        json_sample_results['percentile'] = percentileRank
                     json_study_results.update({'samples': json_samp_list})
                     formatJson(json_study_results, outputFile)
                     # set the objects to empty to save memory
@@ -250,18 +275,9 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
             elif isCondensedFormat:
                 # if this is the first sample, initiate the new line with the first four columns
                 if samp_count == 1:
-                    overlapSnps = []
-                    allIncludedSnps = []
-                    for samp in snpOverlap:
-                        overlapSnps.append(snpOverlap[samp])
-                        allIncludedSnps.append(includedSnps[samp])
-
-                    if len(set(overlapSnps)) == 1:
-                        overlapSnps = list(set(overlapSnps))
-                    if len(set(allIncludedSnps)) == 1:
-                        allIncludedSnps = list(set(allIncludedSnps))
-
-                    newLine = [printStudyID, reportedTrait, trait, citation, pValueAnno, betaAnnotation, valueType, studyUnits, preferredPop, excludedSnps, "|".join([str(x) for x in overlapSnps]), "|".join([str(x) for x in allIncludedSnps])] #TODO
+                    overlapSnps = [snpOverlap[samp] for samp in snpOverlap]
+                    allIncludedSnps = [includedSnps[samp] for samp in snpOverlap]
+                    newLine = [printStudyID, reportedTrait, trait, citation, pValueAnno, betaAnnotation, valueType, studyUnits, preferredPop, excludedSnps] + formatCondensedOverlap(overlapSnps, allIncludedSnps) #TODO
                 newLine.append(prs) # append this sample's score to the row
                 
                 # if we've calculated a score for each sample, write the line to the output file
@@ -275,7 +291,21 @@ def vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJso
     return 
 
 
+def formatCondensedOverlap(overlapSnps, allIncludedSnps):
+    # the SNP overlap and included SNPs columns of the condensed format, a single value if it is the same for every sample
+    if len(set(overlapSnps)) == 1:
+        overlapSnps = list(set(overlapSnps))
+    if len(set(allIncludedSnps)) == 1:
+        allIncludedSnps = list(set(allIncludedSnps))
+    return ["|".join([str(x) for x in overlapSnps]), "|".join([str(x) for x in allIncludedSnps])]
+
+
 def formatJson(studyInfo, outputFile):
+    # if the results are streamed to the output writer process, send the study to it instead of rewriting the end of the file
+    if ow.isStreaming():
+        ow.addJson(studyInfo)
+        return
+
     json_output=[]
     json_output.append(studyInfo)
 
@@ -352,6 +382,43 @@ def getPercentile(prs, percentileDict, omitPercentiles):
         return str(lb)
 
 
+def getPercentileArray(percentileDict, omitPercentiles):
+    # convert the percentile dictionary (p0 - p100) of a study into a sorted numpy array
+    # returns None if there are no percentiles, numpy isn't installed, or the percentiles aren't sorted
+    # (in which case getPercentiles falls back to getPercentile)
+    if np is None or omitPercentiles or percentileDict == {}:
+        return None
+    percentileArray = np.array([float(percentileDict["p{}".format(i)]) for i in range(0, 101)])
+    if not np.all(percentileArray[1:] >= percentileArray[:-1]):
+        return None
+    return percentileArray
+
+
+# This function determines the percentile (or percentile range) of a list of prs scores with the same results as getPercentile
+def getPercentiles(scores, percentileDict, omitPercentiles, percentileArray):
+    if percentileArray is None:
+        return [getPercentile(prs, percentileDict, omitPercentiles) for prs in scores]
+
+    percentileRanks = ["NA"] * len(scores)
+    scoreIndexes = [i for i in range(len(scores)) if scores[i] != "NF"]
+    if not scoreIndexes:
+        return percentileRanks
+    prsArray = np.array([float(scores[i]) for i in scoreIndexes])
+    # the upper bound is the last percentile the prs is greater than or equal to (-1 if it is less than p0)
+    ubs = np.searchsorted(percentileArray, prsArray, side='right') - 1
+    ubs[np.isnan(prsArray)] = -1
+    # the lower bound is the first percentile with the same score as the upper bound
+    lbs = np.searchsorted(percentileArray, percentileArray[np.maximum(ubs, 0)], side='left')
+    for i, lb, ub in zip(scoreIndexes, lbs, ubs):
+        if ub < 0:
+            percentileRanks[i] = "0"
+        elif lb < ub:
+            percentileRanks[i] = "{}-{}".format(lb, ub)
+        else:
+            percentileRanks[i] = str(lb)
+    return percentileRanks
+
+
 def formatSets(protectiveVariants, riskVariants, unmatchedAlleleVariants, clumpedVariants):
 # Format the sets of variants for the output file
     protectiveVariants = "." if str(protectiveVariants) == "set()" else "|".join(protectiveVariants)
@@ -363,6 +430,11 @@ def formatSets(protectiveVariants, riskVariants, unmatchedAlleleVariants, clumpe
 
 
 def formatTSV(isFirst, newLine, header, outputFile):
+    # if the results are streamed to the output writer process, send the line to it instead of appending to the file
+    if not isFirst and ow.isStreaming():
+        ow.addRow(newLine)
+        return
+
     # if the folder of the output file doesn't exist, create it
     if "/" in outputFile:
         os.makedirs(os.path.dirname(outputFile), exist_ok=True)
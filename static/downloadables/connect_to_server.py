@@ -1,11 +1,9 @@
 import json
 import subprocess
-import requests
 import os
 import os.path
 import time
 import datetime
-import hashlib
 from sys import argv
 from io import TextIOWrapper
 import zipfile
@@ -13,6 +11,16 @@ import tarfile
 import gzip
 import myvariant
 from Bio.Seq import Seq
+import http_cache as hc
+import working_download as wd
+import download_manager as dm
+import allele_store as als
+import liftover as lo
+import gwas_ingest as gi
+
+# the most positions sent in one clumps or maf request
+POSITIONS_PER_REQUEST = 10000
+
 
 def get_server_last_update_or_none(url, params):
     """
@@ -20,7 +28,7 @@ def get_server_last_update_or_none(url, params):
     Returns a datetime.date object, or None if server is unavailable.
     """
     try:
-        response = requests.get(url=url, params=params, timeout=10)
+        response = dm.getSession().get(url=url, params=params, timeout=10)
         response.close()
         if response.status_code == 200:
             parts = response.text.split('-')
@@ -35,12 +43,8 @@ def get_server_last_update_or_none(url, params):
 def retrieveAssociationsAndClumps(refGen, traits, studyTypes, studyIDs, ethnicity, valueTypes, sexes, superPop, fileHash, extension, mafCohort):
     checkInternetConnection()
     
-    # Clean up old cache files on startup
-    cleanup_cache()
-    
     # Show cache statistics
-    cache_stats = get_cache_stats()
-    print(f"[LOG] Cache stats - POST: {cache_stats['post_cache']} files, GET: {cache_stats['get_cache']} files, Total: {cache_stats['total_size_mb']:.2f} MB")
+    hc.logCacheStats()
 
     # if the extension is .txt and the mafCohort is user -- Fail this is not a valid combination
     if extension == '.txt' and mafCohort == 'user':
@@ -71,68 +75,48 @@ def retrieveAssociationsAndClumps(refGen, traits, studyTypes, studyIDs, ethnicit
     associationsPath = os.path.join(workingFilesPath, associFileName)
 
     allSuperPops |= set(['AFR', 'AMR', 'EAS', 'EUR', 'SAS'])
-
-    if (checkForAllAssociFile(refGen)):
-        associationsReturnObj = getAllAssociations(refGen)
-        studySnpsPath = os.path.join(workingFilesPath, "traitStudyIDToSnps.txt")
-        studySnpsData = getAllStudySnps()
-        possibleAllelesPath = os.path.join(workingFilesPath, "allPossibleAlleles.txt")
-        possibleAllelesData = getAllPossibleAlleles()
-    
-    dwnldNewMAFFile, mafPathExists = checkForAllMAFFiles(mafCohort, refGen)
+    superPopList = sorted(allSuperPops)
+
+    studySnpsPath = os.path.join(workingFilesPath, "traitStudyIDToSnps.txt")
+    possibleAllelesPath = os.path.join(workingFilesPath, "allPossibleAlleles.txt")
+    mafPath = os.path.join(workingFilesPath, "{m}_maf_{r}.txt".format(m=mafCohort, r=refGen))
+    percentilesPath = os.path.join(workingFilesPath, "allPercentiles_{c}.txt".format(c=percentilesCohort))
+    clumpsPaths = {pop: os.path.join(workingFilesPath, "{p}_clumps_{r}.txt".format(p=pop, r=refGen)) for pop in superPopList}
+
+    # the files are independent of each other, so they are checked, and then downloaded, concurrently
+    # (see download_manager.py). The checks handle their own errors, the downloads are retried
+    checks = dm.runConcurrently([
+        (checkForAllAssociFile, (refGen,)),
+        (checkForAllMAFFiles, (mafCohort, refGen)),
+        (checkForAllPercentilesFiles, (percentilesCohort,))
+    ] + [(checkForAllClumps, (pop, refGen)) for pop in superPopList], retry=False)
+    dwnldNewAssociFile, (dwnldNewMAFFile, mafPathExists), dwnldNewPercentilesFile = checks[:3]
+
+    downloads = {}
+    if (dwnldNewAssociFile):
+        downloads['associations'] = (getAllAssociations, (refGen, associationsPath))
+        downloads['studySnps'] = (getAllStudySnps, (studySnpsPath,))
+        downloads['possibleAlleles'] = (getAllPossibleAlleles, (possibleAllelesPath,))
     if (dwnldNewMAFFile):
-        mafPath = os.path.join(workingFilesPath, "{m}_maf_{r}.txt".format(m=mafCohort, r=refGen))
-        mafData = getAllMaf(mafCohort, refGen)
-
-    if (checkForAllPercentilesFiles(percentilesCohort)):
-        percentilesPath = os.path.join(workingFilesPath, "allPercentiles_{c}.txt".format(c=percentilesCohort))
-        percentileData = getAllPercentiles(percentilesCohort)
-
-    # check to see if associationsReturnObj is instantiated in the local variables
-    if 'associationsReturnObj' in locals():
-        f = open(associationsPath, 'w', encoding="utf-8")
-        f.write(json.dumps(associationsReturnObj, indent=4))
-        f.close()
-
-    if 'mafData' in locals():
-        f = open(mafPath, 'w', encoding="utf-8")
-        f.write(json.dumps(mafData, indent=4))
-        f.close()
-    elif mafCohort != 'user' and not mafPathExists:
+        downloads['maf'] = (getAllMaf, (mafCohort, refGen, mafPath))
+    if (dwnldNewPercentilesFile):
+        downloads['percentiles'] = (getAllPercentiles, (percentilesCohort, percentilesPath))
+    for pop, dwnldNewClumps in zip(superPopList, checks[3:]):
+        if (dwnldNewClumps):
+            downloads[pop] = (getAllClumps, (refGen, pop, clumpsPaths[pop]))
+
+    # the files are streamed to .workingFiles as they are downloaded. Step 2 writes their binary stores and the
+    # study and position indexes of the associations the first time it loads them after they change
+    dm.runConcurrently(list(downloads.values()))
+
+    if 'maf' not in downloads and mafCohort != 'user' and not mafPathExists:
         raise SystemExit("ERROR: We were not able to retrieve the Minor Allele Frequency data at this time. Please try again.")
 
-    if 'percentileData' in locals():
-        f = open(percentilesPath, 'w', encoding='utf-8')
-        f.write(json.dumps(percentileData, indent=4))
-        f.close()
-
-    if 'possibleAllelesData' in locals():
-        f = open(possibleAllelesPath, 'w', encoding="utf-8")
-        f.write(json.dumps(possibleAllelesData, indent=4))
-        f.close()
-
-    # check to see if studySnpsData is instantiated in the local variables
-    if 'studySnpsData' in locals():
-        f = open(studySnpsPath, 'w', encoding="utf-8")
-        f.write(json.dumps(studySnpsData, indent=4))
-        f.close()
-    
-    for pop in allSuperPops:
-        if (checkForAllClumps(pop, refGen)):
-            clumpsPath = os.path.join(workingFilesPath, "{p}_clumps_{r}.txt".format(p=pop, r=refGen))
-            clumpsData = getAllClumps(refGen, pop)
-            
-        # check to see if clumpsData is instantiated in the local variables
-        if 'clumpsData' in locals():
-            f = open(clumpsPath, 'w', encoding="utf-8")
-            f.write(json.dumps(clumpsData, indent=4))
-            f.close()
-
     return
 
 
 # format the uploaded GWAS data and get the clumps from the server
-def formatGWASAndRetrieveClumps(GWASfile, userGwasBeta, GWASextension, GWASrefGen, refGen, superPop, mafCohort, fileHash, extension):
+def formatGWASAndRetrieveClumps(GWASfile, userGwasBeta, GWASextension, GWASrefGen, refGen, superPop, mafCohort, fileHash, extension, pValueCutoff="", prefilter="0"):
     print(f"[LOG] Starting formatGWASAndRetrieveClumps with:")
     print(f"[LOG]   GWASfile: {GWASfile}")
     print(f"[LOG]   userGwasBeta: {userGwasBeta}")
@@ -141,251 +125,148 @@ def formatGWASAndRetrieveClumps(GWASfile, userGwasBeta, GWASextension, GWASrefGe
     print(f"[LOG]   mafCohort: {mafCohort}")
     print(f"[LOG]   fileHash: {fileHash}")
     print(f"[LOG]   extension: {extension}")
+    # with the prefilter, the associations above the p-value cutoff are left out when the file is staged
+    prefilterCutoff = float(pValueCutoff) if prefilter == "1" or prefilter == True else None
+    if prefilterCutoff is not None:
+        print(f"[LOG]   prefilter: p-value <= {prefilterCutoff}")
     
     checkInternetConnection()
     
-    # Clean up old cache files on startup
-    cleanup_cache()
-    
     # Show cache statistics
-    cache_stats = get_cache_stats()
-    print(f"[LOG] Cache stats - POST: {cache_stats['post_cache']} files, GET: {cache_stats['get_cache']} files, Total: {cache_stats['total_size_mb']:.2f} MB")
+    hc.logCacheStats()
 
     # if the extension is .txt and the mafCohort is user -- Fail this is not a valid combination
     if extension == '.txt' and mafCohort == 'user':
         raise SystemExit('\nIn order to use the "user" option for maf cohort, you must upload a vcf, not a txt file. Please upload a vcf instead, or select a different maf cohort option. \n\n')
 
-    GWASfileOpen = openFileForParsing(GWASfile, True)
-
-    allSuperPops = set()
+    workingFilesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
+    # if the directory doesn't exist, make it, and we will need to download the files
+    if not os.path.exists(workingFilesPath):
+        os.mkdir(workingFilesPath)
 
-    associationDict = {}
-    chromSnpDict = {}
-    studyIDsToMetaData = {}
-    studySnpsData = {}
-
-    sii = -1 # studyID index
-    ti = -1 # trait index
-    spi = -1 # super population index
-    si = -1 # snp index
-    ci = -1 # chromosome index
-    pi = -1 # position index
-    rai = -1 # risk allele index
-    ori = -1 # odds ratio index
-    bvi = -1 # beta value index
-    bui = -1 # beta unit index
-    pvi = -1 # p-value index
-    spi = -1 # super population index
-    cti = -1 # citation index
-    rti = -1 # reported trait index
-    pvai = -1 # pvalue annotation index
-    bai = -1 # beta annotation index
-
-    firstLine = True
-    duplicatesSet = set()
-    
-    # Collect all lines for batch processing
-    lines_to_process = []
-    snps_for_flipping = []
-
-    # First pass: collect all data for batch processing
-    for line in GWASfileOpen:
-        line = line.strip()
-        if len(line) == 0: # skip lines that don't have content
-            continue
-        if firstLine:
-            firstLine = False
-            headers = line.lower().split("\t")
+    # the GWAS file is read in chunks and staged in a database instead of memory (see gwas_ingest.py)
+    GWASfileOpen = openFileForParsing(GWASfile, True)
+    numProcesses = gi.getParseProcesses() if GWASfile.lower().endswith((".gz", ".gzip")) else 1
+    staging = gi.GwasStaging(os.path.join(workingFilesPath, "GWASstaging_{fileHash}.sqlite".format(fileHash=fileHash)))
+    try:
+        allSuperPops, studyIDsToMetaData, studyKeys, prefilterData = stageGWASFile(GWASfileOpen, userGwasBeta, GWASrefGen, refGen, superPop, numProcesses, staging, prefilterCutoff)
+        writeGWASFiles(staging, userGwasBeta, allSuperPops, studyIDsToMetaData, studyKeys, prefilterData, refGen, mafCohort, fileHash, workingFilesPath)
+    finally:
+        staging.close()
 
-            try:
-                sii = headers.index("study id")
-                ti = headers.index("trait")
-                si = headers.index("rsid")
-                ci = headers.index("chromosome")
-                pi = headers.index("position")
-                rai = headers.index("risk allele")
-                if userGwasBeta:
-                    bvi = headers.index("beta coefficient")
-                    bui = headers.index("beta units")
-                else:
-                    ori = headers.index("odds ratio")
-                pvi = headers.index("p-value")
-                spi = headers.index("super population")
-            except ValueError:
-                raise SystemExit("ERROR: The GWAS file format is not correct. Please check your file to ensure the required columns are present in a tab separated format. Additionally, check your column names and ensure that there are no extra spaces in the names and that your spelling is correct.")
+    return
 
-            cti = headers.index("citation") if "citation" in headers else -1
-            rti = headers.index("reported trait") if "reported trait" in headers else -1
-            pvai = headers.index("p-value annotation") if "p-value annotation" in headers else -1
-            bai = headers.index("beta annotation") if "beta annotation" in headers else -1
 
-        else:
-            # Store line for batch processing
-            lines_to_process.append(line)
-    
-    GWASfileOpen.close()
-    
-    # Collect SNPs for batch strand flipping
-    print(f"[LOG] Collecting SNPs from {len(lines_to_process)} lines for batch processing...")
-    for line in lines_to_process:
-        line_parts = line.split("\t")
-        if len(line_parts) > max(si, rai):
-            original_rsid = line_parts[si]
-            risk_allele = line_parts[rai]
-            if original_rsid and risk_allele:
-                snps_for_flipping.append((original_rsid, risk_allele))
-    
-    # Batch process strand flipping
-    print(f"[LOG] Starting batch strand flipping for {len(snps_for_flipping)} SNP-allele pairs...")
-    flipped_alleles = batchStrandFlipping(snps_for_flipping)
-    print(f"[LOG] Batch strand flipping complete")
-    
-    # Second pass: process lines with flipped alleles
-    print(f"[LOG] Processing GWAS data with pre-computed strand flipping...")
-    for line in lines_to_process:
-        line = line.split("\t")
-        # Add super population to the super population set
-        preferredPop = getPreferredPop(line[spi], superPop)
-        # Add super population to the super population set
-        allSuperPops.add(preferredPop)
-        # create the chrom:pos to snp dict
-        # Format chromPos to match BCF format (with 'chr' prefix if missing)
-        chrom = line[ci]
-        if not chrom.startswith('chr'):
-            chrom = 'chr' + chrom
-        chromPos = ":".join([chrom, line[pi]])
-        
-        # Store original rsID for reference
-        original_rsid = line[si]
-        if chromPos not in chromSnpDict:
-            # Map chromPos to itself (chromPos will be the primary identifier)
-            chromSnpDict[chromPos] = chromPos
-        
-        # create the snp to associations stuff dict
-        # Use chromPos as the primary key instead of rsID
-        if chromPos not in associationDict:
-            associationDict[chromPos] = {
-                "pos": chromPos,
-                "original_rsid": original_rsid,  # Store original rsID as metadata
-                "traits": {}
-            }
-        # if trait not in associationsDict[chromPos][traits]
-        if line[ti] not in associationDict[chromPos]["traits"]:
-            associationDict[chromPos]["traits"][line[ti]] = {}
-        # if studyID not in associationDict[chromPos]["traits"][trait]
-        if line[sii] not in associationDict[chromPos]["traits"][line[ti]]:
-            associationDict[chromPos]["traits"][line[ti]][line[sii]] = {}
-        # if pvalannotation not in associationDict[chromPos]["traits"][line[ti]][line[sii]]
-        pValueAnnotation = line[pvai] if pvai != -1 and pvai < len(line) else "NA"
-        betaAnnotation = line[bai] if bai != -1 and bai < len(line) else "NA"
-        valueType = "beta" if userGwasBeta else "OR"
-        pvalBetaAnnoValType = pValueAnnotation + "|" + betaAnnotation + "|" + valueType
-        if pvalBetaAnnoValType not in associationDict[chromPos]["traits"][line[ti]][line[sii]]:
-            associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType] = {}
-        
-        # Use pre-computed flipped allele
-        riskAllele = flipped_alleles.get((original_rsid, line[rai]), line[rai])
-        if riskAllele not in associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType]:
-            associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType][riskAllele]= {
-                "pValue": float(line[pvi]),
-                "sex": "NA",
-                "ogValueTypes": 'beta' if userGwasBeta else 'OR'
-            }
-            if userGwasBeta:
-                associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType][riskAllele]['betaValue'] = float(line[bvi])
-                associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType][riskAllele]['betaUnit'] = line[bui]
+# reads the GWAS file into the staging database one chunk at a time, and returns the super populations, study
+# metadata, and trait/study combinations (numbered in the order they are found) of the file, and what the prefilter
+# left out (None without a prefilterCutoff)
+def stageGWASFile(GWASfileOpen, userGwasBeta, GWASrefGen, refGen, superPop, numProcesses, staging, prefilterCutoff=None):
+    allSuperPops = set()
+    studyIDsToMetaData = {}
+    studyKeys = {}
+    numRows = 0
+    numDropped = 0
+
+    for rows in gi.readGwasChunks(GWASfileOpen, userGwasBeta, numProcesses):
+        numRows += len(rows)
+        print(f"[LOG] Processing a chunk of {len(rows)} GWAS rows ({numRows} so far)...")
+
+        # the metadata is kept for every row, so the super populations used for clumping don't depend on the prefilter
+        droppedRows = []
+        keptRows = []
+        for row in rows:
+            # Add super population to the super population set
+            preferredPop = getPreferredPop(row.superPop, superPop)
+            allSuperPops.add(preferredPop)
+
+            # create the metadata info dict
+            # if the studyID is not in the studyIDsToMetaData
+            if row.studyID not in studyIDsToMetaData:
+                studyIDsToMetaData[row.studyID] = {
+                    "citation": row.citation,
+                    "reportedTrait": row.reportedTrait,
+                    "studyTypes": [],
+                    "traits": {},
+                    "ethnicity": []
+                }
+            # if the trait is not in the studyIDsToMetaData[studyID]["traits"]
+            if row.trait not in studyIDsToMetaData[row.studyID]["traits"]:
+                # add the trait
+                studyIDsToMetaData[row.studyID]["traits"][row.trait] = {
+                    "studyTypes": [],
+                    "pValBetaAnnoValType": [row.uniqueKey],
+                    "superPopulations": [row.superPop]
+                }
+            elif row.uniqueKey not in studyIDsToMetaData[row.studyID]["traits"][row.trait]['pValBetaAnnoValType']:
+                # each annotation once, so the metadata doesn't grow with the number of rows
+                studyIDsToMetaData[row.studyID]["traits"][row.trait]['pValBetaAnnoValType'].append(row.uniqueKey)
+
+            # number the trait|studyID|pValueAnnotation combinations, the chromPos of each row are added to them
+            # (instead of rsIDs) when the trait/study to snps file is written
+            traitStudyIDPValAnno = "|".join([row.trait, row.uniqueKey, row.studyID])
+            studyKey = studyKeys.setdefault(traitStudyIDPValAnno, len(studyKeys))
+
+            # a NaN p-value is never below the cutoff
+            if prefilterCutoff is not None and not row.pValue <= prefilterCutoff:
+                droppedRows.append((row, studyKey))
             else:
-                associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType][riskAllele]['oddsRatio'] = float(line[ori])
-                associationDict[chromPos]["traits"][line[ti]][line[sii]][pvalBetaAnnoValType][riskAllele]['betaUnit'] = 'NA'
-    
-        else:
-            # if the snp is duplicated, notify the user and exit
-            raise SystemExit("ERROR: The GWAS file contains at least one duplicated snp for the following combination. {}, {}, {}, {}, . \n Please ensure that there is only one snp for each combination.".format(chromPos, line[ti], line[sii], pvalBetaAnnoValType))
-
-        # create the metadata info dict
-        # if the studyID is not in the studyIDsToMetaData
-        if line[sii] not in studyIDsToMetaData:
-            studyIDsToMetaData[line[sii]] = {
-                "citation": line[cti] if cti != -1 and cti < len(line) else "",
-                "reportedTrait": line[rti] if rti != -1 and rti < len(line) else "",
-                "studyTypes": [],
-                "traits": {},
-                "ethnicity": []
-            }
-        # if the trait is not in the studyIDsToMetaData[studyID]["traits"]
-        if line[ti] not in studyIDsToMetaData[line[sii]]["traits"]:
-            # add the trait
-            studyIDsToMetaData[line[sii]]["traits"][line[ti]] = {
-                "studyTypes": [],
-                "pValBetaAnnoValType": [pvalBetaAnnoValType],
-                "superPopulations": [line[spi]]
-            }
-        else:
-            studyIDsToMetaData[line[sii]]["traits"][line[ti]]['pValBetaAnnoValType'].append(pvalBetaAnnoValType)
-            
-        # create studyID/trait/pValueAnnotation to snps
-        # if trait|studyID|pValueAnnotation not in the studySnpsData
-        joinList = [line[ti], pvalBetaAnnoValType, line[sii]]
-        traitStudyIDPValAnno = "|".join(joinList)
-        if traitStudyIDPValAnno not in studySnpsData:
-            studySnpsData[traitStudyIDPValAnno] = []
-        # add chromPos to the traitStudyIDToSnp (instead of rsID)
-        studySnpsData[traitStudyIDPValAnno].append(chromPos)
-    
+                keptRows.append((row, studyKey))
+
+        if droppedRows:
+            numDropped += len(droppedRows)
+            staging.addDroppedAssociations(droppedRows)
+        stageGWASRows(keptRows, GWASrefGen, refGen, staging)
+
+    prefilterData = None
+    if prefilterCutoff is not None:
+        # the rows of a position whose other risk allele was staged are staged after all, the rest are only counted
+        partialRows = staging.takePartiallyDroppedAssociations()
+        for start in range(0, len(partialRows), gi.GWAS_CHUNK_ROWS):
+            stageGWASRows(partialRows[start:start + gi.GWAS_CHUNK_ROWS], GWASrefGen, refGen, staging)
+        numDropped -= len(partialRows)
+        droppedSnpCounts = staging.getDroppedSnpCounts()
+        prefilterData = {
+            "pValueCutoff": prefilterCutoff,
+            "excludedSnps": {traitStudyIDPValAnno: droppedSnpCounts[studyKey] for traitStudyIDPValAnno, studyKey in studyKeys.items() if studyKey in droppedSnpCounts}
+        }
+        print(f"[LOG] Prefilter left out {numDropped} of {numRows} rows with a p-value above {prefilterCutoff}")
+        if numRows > 0 and numDropped == numRows:
+            raise SystemExit(f"ERROR: None of the associations in the GWAS file have a p-value at or below the p-value cutoff ({prefilterCutoff}). Please use a higher cutoff.")
+
+    numPositions = staging.getNumPositions()
     print(f"[LOG] GWAS file parsing completed:")
-    print(f"[LOG]   Parsed {len(associationDict)} SNPs from GWAS file")
+    print(f"[LOG]   Parsed {numPositions} SNPs from {numRows} rows of the GWAS file")
     print(f"[LOG]   Found {len(studyIDsToMetaData)} unique studies")
-    print(f"[LOG]   Found {len(studySnpsData)} trait/study combinations")
+    print(f"[LOG]   Found {len(studyKeys)} trait/study combinations")
     print(f"[LOG]   Identified {len(allSuperPops)} super populations: {allSuperPops}")
+    if GWASrefGen != refGen:
+        print(f"[LOG] Converted the SNP positions from {GWASrefGen} to {refGen}: got position mappings for {len(staging.getConvertedPositions())} chromosome positions")
+    return allSuperPops, studyIDsToMetaData, studyKeys, prefilterData
 
-    # remove duplicated associations
-    duplicates_removed = len(duplicatesSet)
-    for (snp, trait, studyID) in duplicatesSet:
-        del associationDict[snp]["traits"][trait][studyID]
-        if associationDict[snp]["traits"][trait] == {}:
-            del associationDict[snp]["traits"][trait]
-            if associationDict[snp]["traits"] == {}:
-                del associationDict[snp]
-    
-    if duplicates_removed > 0:
-        print(f"[LOG] Removed {duplicates_removed} duplicate associations")
 
-    # if the samples reference genome does not equal the gwas reference genome, get a dictionary with the correct positions
-    chromSnpDict = {}
+# strand flips and stages a chunk of (GwasRow, studyKey), converting their positions if the reference genomes differ
+def stageGWASRows(rows, GWASrefGen, refGen, staging):
+    if not rows:
+        return
+    # strand flip the risk alleles of the chunk at once
+    flipped_alleles = batchStrandFlipping([(row.rsID, row.riskAllele) for row, _ in rows if row.rsID and row.riskAllele])
+    # Use pre-computed flipped allele
+    staging.addAssociations([(row, flipped_alleles.get((row.rsID, row.riskAllele), row.riskAllele), studyKey) for row, studyKey in rows])
+
+    # if the samples reference genome does not equal the gwas reference genome, convert the positions of the chunk
+    # locally with the liftOver chain files (see liftover.py)
     if GWASrefGen != refGen:
-        print(f"[LOG] Converting SNP positions from {GWASrefGen} to {refGen}")
-        snps = list(associationDict.keys())
-        
-        # Use retry logic for SNP position conversion
-        chromSnpDict = retry_network_call(
-            getUrlWithParams,
-            "https://prs.byu.edu/snps_to_chrom_pos", 
-            { "snps": snps, "refGen": refGen }
-        )
-        print(f"[LOG] Got position mappings for {len(chromSnpDict)} chromosome positions")
+        staging.addConvertedPositions(lo.convertPositions(dict.fromkeys(row.chromPos for row, _ in rows), GWASrefGen, refGen))
+
 
-    mergedAssociDict = dict()
-    mergedAssociDict.update(associationDict)
-    mergedAssociDict.update(chromSnpDict)
-    chromPos = list(chromSnpDict.keys())
-    print(f"[LOG] Created merged associations dict with {len(mergedAssociDict)} entries")
+# gets the clumps and maf of the staged GWAS associations from the server and writes the working files of the upload
+def writeGWASFiles(staging, userGwasBeta, allSuperPops, studyIDsToMetaData, studyKeys, prefilterData, refGen, mafCohort, fileHash, workingFilesPath):
+    chromPos = staging.getConvertedPositions()
     print(f"[LOG] chromPos contains {len(chromPos)} chromosome positions")
 
-    associationsReturnObj = {
-        "associations": mergedAssociDict,
-        "studyIDsToMetaData": studyIDsToMetaData
-    }
-    print(f"[LOG] Created associationsReturnObj with {len(associationsReturnObj['associations'])} associations")
-        
-    workingFilesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
-    # if the directory doesn't exist, make it, and we will need to download the files
-    if not os.path.exists(workingFilesPath):
-        os.mkdir(workingFilesPath)
-    
     fileName = "GWASassociations_{fileHash}.txt".format(fileHash=fileHash)
     associationsPath = os.path.join(workingFilesPath, fileName)
 
-
     # Access and write the clumps file for each of the super populations preferred in the GWAS file
     print(f"[LOG] Processing clumps for {len(allSuperPops)} super populations: {allSuperPops}")
     clumps_written = 0
@@ -448,44 +329,32 @@ def formatGWASAndRetrieveClumps(GWASfile, userGwasBeta, GWASextension, GWASrefGe
     # get the study:snps info
     fileName = "traitStudyIDToSnps_{ahash}.txt".format(ahash = fileHash)
     studySnpsPath = os.path.join(workingFilesPath, fileName)
-    print(f"[LOG] StudySnps data contains {len(studySnpsData)} trait/study combinations")
+    # trait/study combinations the prefilter left no associations in aren't written
+    keptStudyKeys = staging.getStudyKeys()
+    print(f"[LOG] StudySnps data contains {len(keptStudyKeys)} trait/study combinations")
 
-    # get the possible alleles for snps
+    # the possible alleles for snps
     fileName = "possibleAlleles_{ahash}.txt".format(ahash = fileHash)
     possibleAllelesPath = os.path.join(workingFilesPath, fileName)
-    print(f"[LOG] Getting possible alleles for {len(associationsReturnObj['associations'])} SNPs")
-    
-    try:
-        possibleAllelesData = getPossibleAlleles(list(associationsReturnObj['associations'].keys()))
-        if possibleAllelesData is None:
-            print(f"[ERROR] possibleAllelesData is None")
-        elif not possibleAllelesData:
-            print(f"[WARN] possibleAllelesData is empty")
-        else:
-            print(f"[LOG] Retrieved possible alleles for {len(possibleAllelesData)} SNPs")
-    except Exception as e:
-        print(f"[ERROR] Failed to get possible alleles data: {e}")
-        possibleAllelesData = None
 
-
-    # Write associations file with validation
+    # Write associations file with validation, one association at a time
     print(f"[LOG] Writing associations file: {associationsPath}")
     try:
-        if associationsReturnObj and 'associations' in associationsReturnObj and 'studyIDsToMetaData' in associationsReturnObj:
-            associations_count = len(associationsReturnObj['associations'])
-            studies_count = len(associationsReturnObj['studyIDsToMetaData'])
-            print(f"[LOG] AssociationsReturnObj contains {associations_count} associations and {studies_count} studies")
-            
-            with open(associationsPath, 'w', encoding="utf-8") as f:
-                f.write(json.dumps(associationsReturnObj))
-            
-            # Verify file was written correctly
-            if os.path.exists(associationsPath) and os.path.getsize(associationsPath) > 0:
-                print(f"[LOG] Successfully wrote associations file: {associationsPath} (size: {os.path.getsize(associationsPath)} bytes)")
-            else:
-                raise Exception("Associations file validation failed")
+        with open(associationsPath, 'w', encoding="utf-8") as f:
+            f.write('{"associations": ')
+            gi.writeJsonItems(f, staging.iterAssociations(userGwasBeta))
+            f.write(', "studyIDsToMetaData": ')
+            f.write(json.dumps(studyIDsToMetaData))
+            if prefilterData is not None:
+                f.write(', "gwasPrefilter": ')
+                f.write(json.dumps(prefilterData))
+            f.write('}')
+
+        # Verify file was written correctly
+        if os.path.exists(associationsPath) and os.path.getsize(associationsPath) > 0:
+            print(f"[LOG] Successfully wrote associations file: {associationsPath} (size: {os.path.getsize(associationsPath)} bytes)")
         else:
-            raise Exception("associationsReturnObj is invalid or missing required keys")
+            raise Exception("Associations file validation failed")
     except Exception as e:
         print(f"[ERROR] Failed to write associations file {associationsPath}: {e}")
         raise SystemExit(f"CRITICAL ERROR: Could not write associations file: {e}")
@@ -504,15 +373,13 @@ def formatGWASAndRetrieveClumps(GWASfile, userGwasBeta, GWASextension, GWASrefGe
         except Exception as e:
             print(f"[ERROR] Failed to write MAF file {mafPath}: {e}")
 
-    # Write studySnps file with validation  
+    # Write studySnps file with validation, one trait/study combination at a time
     print(f"[LOG] Writing studySnps file: {studySnpsPath}")
     try:
-        if studySnpsData and len(studySnpsData) > 0:
-            print(f"[LOG] StudySnpsData contains {len(studySnpsData)} entries")
-            
+        if keptStudyKeys:
             with open(studySnpsPath, 'w', encoding="utf-8") as f:
-                f.write(json.dumps(studySnpsData))
-            
+                gi.writeJsonItems(f, ((traitStudyIDPValAnno, staging.iterStudySnps(studyKey)) for traitStudyIDPValAnno, studyKey in studyKeys.items() if studyKey in keptStudyKeys))
+
             # Verify file was written correctly
             if os.path.exists(studySnpsPath) and os.path.getsize(studySnpsPath) > 0:
                 print(f"[LOG] Successfully wrote studySnps file: {studySnpsPath} (size: {os.path.getsize(studySnpsPath)} bytes)")
@@ -524,23 +391,37 @@ def formatGWASAndRetrieveClumps(GWASfile, userGwasBeta, GWASextension, GWASrefGe
         print(f"[ERROR] Failed to write studySnps file {studySnpsPath}: {e}")
         raise SystemExit(f"CRITICAL ERROR: Could not write studySnps file: {e}")
 
-    # Write possible alleles file with validation
-    if possibleAllelesData is not None:
-        print(f"[LOG] Writing possible alleles file: {possibleAllelesPath}")
-        try:
-            with open(possibleAllelesPath, 'w', encoding="utf-8") as f:
-                f.write(json.dumps(possibleAllelesData))
-            
-            if os.path.exists(possibleAllelesPath) and os.path.getsize(possibleAllelesPath) > 0:
-                print(f"[LOG] Successfully wrote possible alleles file: {possibleAllelesPath} (size: {os.path.getsize(possibleAllelesPath)} bytes)")
-            else:
-                print(f"[WARN] Possible alleles file validation failed: {possibleAllelesPath}")
-        except Exception as e:
-            print(f"[ERROR] Failed to write possible alleles file {possibleAllelesPath}: {e}")
+    # Write possible alleles file with validation, getting the possible alleles of a chunk of snps at a time
+    # (into a temporary file that replaces it once every lookup succeeded, so a failed lookup leaves no partial file)
+    print(f"[LOG] Writing possible alleles file: {possibleAllelesPath}")
+    tmpPath = possibleAllelesPath + ".tmp{0}".format(os.getpid())
+    try:
+        with open(tmpPath, 'w', encoding="utf-8") as f:
+            gi.writeJsonItems(f, iterPossibleAlleles(staging.iterPositions()))
+        os.replace(tmpPath, possibleAllelesPath)
+
+        if os.path.exists(possibleAllelesPath) and os.path.getsize(possibleAllelesPath) > 0:
+            print(f"[LOG] Successfully wrote possible alleles file: {possibleAllelesPath} (size: {os.path.getsize(possibleAllelesPath)} bytes)")
+        else:
+            print(f"[WARN] Possible alleles file validation failed: {possibleAllelesPath}")
+    except Exception as e:
+        print(f"[ERROR] Failed to write possible alleles file {possibleAllelesPath}: {e}")
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
     
     print(f"[LOG] Completed writing all required files for fileHash {fileHash}")
 
-    return
+
+# yields (snp, possible alleles) for the snps, looking up the alleles of a chunk of snps at a time
+def iterPossibleAlleles(snps):
+    chunk = []
+    for snp in snps:
+        chunk.append(snp)
+        if len(chunk) >= gi.GWAS_CHUNK_ROWS:
+            yield from getPossibleAlleles(chunk).items()
+            chunk = []
+    if chunk:
+        yield from getPossibleAlleles(chunk).items()
 
 
 # opens and returns an open file from the inputFile path, using zipfile, tarfile, gzip, or open depending on the file's type
@@ -593,12 +474,13 @@ def checkForAllAssociFile(refGen, max_age_days=30):
         print(f"[LOG] Cache file {associFileName} does not exist, will download.")
         return True
 
-    file_mod_time = os.path.getmtime(allAssociationsFile)
+    # the file is current as of its last download or the last time the server confirmed it hadn't changed
+    file_mod_time = wd.getLastChecked(allAssociationsFile)
     file_age_days = (time.time() - file_mod_time) / 86400
     print(f"[LOG] Cache file {associFileName} is {file_age_days:.8f} days old.")
 
     if file_age_days > max_age_days:
-        print(f"[LOG] Cache file {associFileName} is older than {max_age_days} days, will redownload.")
+        print(f"[LOG] Cache file {associFileName} is older than {max_age_days} days, will check the server for changes.")
         return True
 
     # File is fresh enough, just use it
@@ -614,7 +496,7 @@ def checkForAllClumps(pop, refGen):
     if os.path.exists(allClumpsFile):
         params = {"refGen": refGen, "superPop": pop}
         server_update = get_server_last_update_or_none("https://prs.byu.edu/last_clumps_update", params)
-        fileModDateObj = time.localtime(os.path.getmtime(allClumpsFile))
+        fileModDateObj = time.localtime(wd.getLastChecked(allClumpsFile))
         fileModDate = datetime.date(fileModDateObj.tm_year, fileModDateObj.tm_mon, fileModDateObj.tm_mday)
         if server_update is not None:
             if (server_update <= fileModDate):
@@ -636,7 +518,7 @@ def checkForAllMAFFiles(mafCohort, refGen):
         pathExists = True
         params = {"cohort": mafCohort, "refGen": refGen}
         server_update = get_server_last_update_or_none("https://prs.byu.edu/last_maf_update", params)
-        fileModDateObj = time.localtime(os.path.getmtime(allMAFfile))
+        fileModDateObj = time.localtime(wd.getLastChecked(allMAFfile))
         fileModDate = datetime.date(fileModDateObj.tm_year, fileModDateObj.tm_mon, fileModDateObj.tm_mday)
         if server_update is not None:
             if (server_update <= fileModDate):
@@ -657,7 +539,7 @@ def checkForAllPercentilesFiles(percentilesCohort):
     if os.path.exists(allPercentilesfile):
         params = {"cohort": percentilesCohort}
         server_update = get_server_last_update_or_none("https://prs.byu.edu/last_percentiles_update", params)
-        fileModDateObj = time.localtime(os.path.getmtime(allPercentilesfile))
+        fileModDateObj = time.localtime(wd.getLastChecked(allPercentilesfile))
         fileModDate = datetime.date(fileModDateObj.tm_year, fileModDateObj.tm_mon, fileModDateObj.tm_mday)
         if server_update is not None:
             if (server_update <= fileModDate):
@@ -670,55 +552,61 @@ def checkForAllPercentilesFiles(percentilesCohort):
 
 
 # gets associations obj download from the Server
-def getAllAssociations(refGen): 
+# (the download files are streamed to .workingFiles by working_download.py, which only asks the server for the
+# changes since the local version. They return whether the local file changed)
+def getAllAssociations(refGen, associationsPath): 
     params = {
         "refGen": refGen,
     }
-    associationsReturnObj = getUrlWithParams("https://prs.byu.edu/get_associations_download_file", params = params)
+    associationsChanged = wd.downloadWorkingFile(associationsPath, "https://prs.byu.edu/get_associations_download_file", params)
     # Organized with pos/snp as the Keys
-    return associationsReturnObj
+    return associationsChanged
 
 
 # gets the clumps file download from the server
-def getAllClumps(refGen, superPop):
+def getAllClumps(refGen, superPop, clumpsPath):
     params = {
         'refGen': refGen,
         'superPop': superPop
     }
-    clumpsReturnObj = getUrlWithParams("https://prs.byu.edu/get_clumps_download_file", params=params)
-    return clumpsReturnObj
+    clumpsChanged = wd.downloadWorkingFile(clumpsPath, "https://prs.byu.edu/get_clumps_download_file", params)
+    return clumpsChanged
 
 
-def getAllMaf(mafCohort, refGen):
-    if (mafCohort == 'user'): return {}
+def getAllMaf(mafCohort, refGen, mafPath):
+    if (mafCohort == 'user'):
+        wd.writeJsonFile(mafPath, {})
+        return True
     params = {
         "cohort": mafCohort,
         "refGen": refGen
     }
-    mafReturnedObj = getUrlWithParams("https://prs.byu.edu/get_maf_download_file", params=params)
-    return mafReturnedObj
+    mafChanged = wd.downloadWorkingFile(mafPath, "https://prs.byu.edu/get_maf_download_file", params)
+    return mafChanged
 
 
-def getAllPercentiles(percentilesCohort):
-    if (percentilesCohort == 'user'): return {}
+def getAllPercentiles(percentilesCohort, percentilesPath):
+    if (percentilesCohort == 'user'):
+        wd.writeJsonFile(percentilesPath, {})
+        return True
     params = {
         "cohort": percentilesCohort
     }
-    percentilesReturnedObj = getUrlWithParams("https://prs.byu.edu/get_percentiles_download_file", params=params)
-    return percentilesReturnedObj
+    percentilesChanged = wd.downloadWorkingFile(percentilesPath, "https://prs.byu.edu/get_percentiles_download_file", params)
+    return percentilesChanged
 
 
 # gets study snps file download from the Server
 # gets a list of snps for all of the unique trait/pValueAnnotation/betaAnnotation/valueType/studyID combinations
-def getAllStudySnps(): 
-    studySnpsReturnObj = getUrlWithParams("https://prs.byu.edu/get_traitStudyID_to_snp", params={})
+def getAllStudySnps(studySnpsPath): 
+    studySnpsChanged = wd.downloadWorkingFile(studySnpsPath, "https://prs.byu.edu/get_traitStudyID_to_snp", {})
     # Organized with study as the Keys and snps as values
-    return studySnpsReturnObj
+    return studySnpsChanged
 
 
-def getAllPossibleAlleles():
-    possibleAllelesObj = getUrlWithParams("https://prs.byu.edu/get_all_possible_alleles", params={})
-    return possibleAllelesObj
+def getAllPossibleAlleles(possibleAllelesPath):
+    possibleAllelesChanged = wd.downloadWorkingFile(possibleAllelesPath, "https://prs.byu.edu/get_all_possible_alleles", {})
+    return possibleAllelesChanged
 
 
 # This function is used to combine json from all the separate calls into one json object. Due to the amount of nesting in the json
@@ -842,14 +730,12 @@ def getSpecificAssociations(refGen, traits, studyTypes, studyIDs, ethnicity, val
 
 def runStrandFlipping(snp, allele, cached_alleles=None):
     """Single strand flipping with optional cached alleles"""
-    import myvariant
     from Bio.Seq import Seq
 
     if cached_alleles is not None and snp in cached_alleles:
         possibleAlleles = cached_alleles[snp]
     else:
-        mv = myvariant.MyVariantInfo()
-        possibleAlleles = getVariantAlleles(snp, mv)
+        possibleAlleles = getBatchVariantAlleles([snp]).get(snp, [])
     
     riskAllele = Seq(allele)
     if riskAllele not in possibleAlleles:
@@ -935,13 +821,12 @@ def batchStrandFlipping(snp_allele_pairs):
 
 
 def getPossibleAlleles(snpsFromAssociations):
-    mv = myvariant.MyVariantInfo()
+    allelesByRsID = getBatchVariantAlleles([snp for snp in snpsFromAssociations if snp.startswith("rs")])
     snpsToPossibleAlleles = {}
 
     for snp in snpsFromAssociations:
         if snp.startswith("rs"):
-            possibleAlleles = getVariantAlleles(snp, mv)
-            snpsToPossibleAlleles[snp] = possibleAlleles
+            snpsToPossibleAlleles[snp] = allelesByRsID.get(snp, [])
         elif ":" in snp:
             # For chromPos identifiers, we can't query MyVariant
             # So we'll return empty alleles list (will be handled elsewhere)
@@ -951,356 +836,137 @@ def getPossibleAlleles(snpsFromAssociations):
 
 def getBatchVariantAlleles(rsIDs):
     """
-    Fetch variant alleles for multiple rsIDs using MyVariant batch API.
-    Much faster than individual queries. Includes local caching.
+    Fetch variant alleles for multiple rsIDs. The alleles are read from the allele store (see allele_store.py),
+    and only the rsIDs missing from it are queried with the MyVariant batch API.
     
     Args:
         rsIDs: List of rsID strings
     
     Returns:
-        Dict mapping rsID to list of alleles
+        Dict mapping rsID to list of alleles (rsIDs whose query failed are left out)
     """
-    import myvariant
-    import time
-    import os
-    import json
-    import hashlib
-    
     if not rsIDs:
         return {}
-    
-    # Check local cache first
-    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-    
-    # Create cache key from sorted rsIDs
-    cache_key = hashlib.md5('|'.join(sorted(rsIDs)).encode()).hexdigest()
-    cache_file = os.path.join(cache_dir, f"alleles_{cache_key}.json")
-    
-    # Try to load from cache
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r') as f:
-                cached_data = json.load(f)
-            print(f"[LOG] Loaded {len(cached_data)} alleles from cache")
-            return cached_data
-        except:
-            pass  # Cache file corrupted, continue with API call
-    
+    return als.lookupAlleles(rsIDs, queryBatchVariantAlleles)
+
+
+def queryBatchVariantAlleles(rsIDs):
+    # queries the alleles of the rsIDs from MyVariant, in concurrent batches
     print(f"[LOG] Using MyVariant batch API for {len(rsIDs)} SNPs...")
-    
-    mv = myvariant.MyVariantInfo()
-    cached_alleles = {}
-    
+
     # MyVariant batch API supports up to 1000 queries per request
     BATCH_SIZE = 1000
-    total_batches = (len(rsIDs) + BATCH_SIZE - 1) // BATCH_SIZE
-    
-    for batch_num in range(total_batches):
-        start_idx = batch_num * BATCH_SIZE
-        end_idx = min((batch_num + 1) * BATCH_SIZE, len(rsIDs))
-        batch_rsids = rsIDs[start_idx:end_idx]
+    batches = [rsIDs[start:start + BATCH_SIZE] for start in range(0, len(rsIDs), BATCH_SIZE)]
+    batchCalls = [(queryVariantAllelesBatch, (batch_num, len(batches), batch_rsids)) for batch_num, batch_rsids in enumerate(batches)]
+
+    cached_alleles = {}
+    for batchAlleles in dm.runConcurrently(batchCalls, retry=False):
+        cached_alleles.update(batchAlleles)
+
+    found_count = sum(1 for alleles in cached_alleles.values() if alleles)
+    print(f"[LOG] Batch API complete: Found alleles for {found_count}/{len(rsIDs)} SNPs")
+    return cached_alleles
+
+
+def queryVariantAllelesBatch(batch_num, total_batches, batch_rsids):
+    # returns {rsID: alleles} for one batch, or {} if the batch failed (so it is queried again next time)
+    print(f"[LOG] Processing batch {batch_num + 1}/{total_batches} ({len(batch_rsids)} SNPs)...")
+    batchAlleles = {}
+    try:
+        # Prepare batch query with dbsnp.rsid format
+        queries = [f"dbsnp.rsid:{rsid}" for rsid in batch_rsids]
         
-        print(f"[LOG] Processing batch {batch_num + 1}/{total_batches} ({len(batch_rsids)} SNPs)...")
+        # Use batch query (each thread uses its own client)
+        mv = myvariant.MyVariantInfo()
+        start_time = time.time()
+        results = dm.retry_network_call(
+            mv.querymany,
+            queries,
+            scopes="dbsnp.rsid",
+            fields="dbsnp.alleles.allele,dbsnp.ref,dbsnp.alt",
+            returnall=True,
+            verbose=False
+        )
+        elapsed = time.time() - start_time
+        print(f"[LOG] Batch {batch_num + 1} completed in {elapsed:.2f}s")
         
-        try:
-            # Prepare batch query with dbsnp.rsid format
-            queries = [f"dbsnp.rsid:{rsid}" for rsid in batch_rsids]
-            
-            # Use batch query
-            start_time = time.time()
-            results = mv.querymany(
-                queries,
-                scopes="dbsnp.rsid",
-                fields="dbsnp.alleles.allele,dbsnp.ref,dbsnp.alt",
-                returnall=True,
-                verbose=False
-            )
-            elapsed = time.time() - start_time
-            print(f"[LOG] Batch {batch_num + 1} completed in {elapsed:.2f}s")
-            
-            # Process results
-            if 'out' in results:
-                for i, result in enumerate(results['out']):
-                    rsid = batch_rsids[i]
-                    alleles = set()
+        # Process results
+        if 'out' in results:
+            for i, result in enumerate(results['out']):
+                # a query can have more than one hit, so the rsID is taken from the query of the result
+                query = result.get('query') if isinstance(result, dict) else None
+                rsid = query.split(':', 1)[-1] if query else batch_rsids[i]
+                alleles = set(batchAlleles.get(rsid, []))
+                
+                if result and 'dbsnp' in result:
+                    dbsnp_data = result['dbsnp']
                     
-                    if result and 'dbsnp' in result:
-                        dbsnp_data = result['dbsnp']
-                        
-                        # Extract alleles from different fields
-                        if 'alleles' in dbsnp_data:
-                            if isinstance(dbsnp_data['alleles'], list):
-                                for allele_obj in dbsnp_data['alleles']:
-                                    if isinstance(allele_obj, dict) and 'allele' in allele_obj:
-                                        alleles.add(allele_obj['allele'])
-                            elif isinstance(dbsnp_data['alleles'], dict) and 'allele' in dbsnp_data['alleles']:
-                                alleles.add(dbsnp_data['alleles']['allele'])
-                        
-                        # Add ref allele
-                        if 'ref' in dbsnp_data and dbsnp_data['ref']:
-                            alleles.add(dbsnp_data['ref'])
-                        
-                        # Add alt allele
-                        if 'alt' in dbsnp_data and dbsnp_data['alt']:
-                            if isinstance(dbsnp_data['alt'], list):
-                                alleles.update(dbsnp_data['alt'])
-                            else:
-                                alleles.add(dbsnp_data['alt'])
+                    # Extract alleles from different fields
+                    if 'alleles' in dbsnp_data:
+                        if isinstance(dbsnp_data['alleles'], list):
+                            for allele_obj in dbsnp_data['alleles']:
+                                if isinstance(allele_obj, dict) and 'allele' in allele_obj:
+                                    alleles.add(allele_obj['allele'])
+                        elif isinstance(dbsnp_data['alleles'], dict) and 'allele' in dbsnp_data['alleles']:
+                            alleles.add(dbsnp_data['alleles']['allele'])
                     
-                    cached_alleles[rsid] = list(alleles) if alleles else []
-            
-            # Handle missing results
-            if 'missing' in results:
-                for missing_query in results['missing']:
-                    # Extract rsID from "dbsnp.rsid:rs123" format
-                    if ':' in missing_query:
-                        rsid = missing_query.split(':', 1)[1]
-                        cached_alleles[rsid] = []
-                        print(f"[WARN] No alleles found for {rsid}")
-            
-            # Small delay between batches to be respectful to API
-            if batch_num < total_batches - 1:
-                time.sleep(0.1)
+                    # Add ref allele
+                    if 'ref' in dbsnp_data and dbsnp_data['ref']:
+                        alleles.add(dbsnp_data['ref'])
+                    
+                    # Add alt allele
+                    if 'alt' in dbsnp_data and dbsnp_data['alt']:
+                        if isinstance(dbsnp_data['alt'], list):
+                            alleles.update(dbsnp_data['alt'])
+                        else:
+                            alleles.add(dbsnp_data['alt'])
                 
-        except Exception as e:
-            print(f"[ERROR] Batch {batch_num + 1} failed: {e}")
-            # Fall back to empty alleles for this batch
-            for rsid in batch_rsids:
-                cached_alleles[rsid] = []
-    
-    found_count = sum(1 for alleles in cached_alleles.values() if alleles)
-    print(f"[LOG] Batch API complete: Found alleles for {found_count}/{len(rsIDs)} SNPs")
-    
-    # Save to cache for future use
-    try:
-        with open(cache_file, 'w') as f:
-            json.dump(cached_alleles, f)
-        print(f"[LOG] Saved alleles to cache for future use")
+                batchAlleles[rsid] = list(alleles) if alleles else []
+        
+        # Handle missing results
+        if 'missing' in results:
+            for missing_query in results['missing']:
+                # Extract rsID from "dbsnp.rsid:rs123" format
+                if ':' in missing_query:
+                    rsid = missing_query.split(':', 1)[1]
+                    batchAlleles[rsid] = []
+                    print(f"[WARN] No alleles found for {rsid}")
     except Exception as e:
-        print(f"[WARN] Failed to save cache: {e}")
-    
-    return cached_alleles
-
-def getVariantAlleles(rsID, mv):
-    """
-    Legacy function for single variant allele lookup.
-    Kept for backward compatibility.
-    """
-    import contextlib, io
-
-    f=io.StringIO()
-    with contextlib.redirect_stdout(f):
-        queryResult = mv.query('dbsnp.rsid:{}'.format(rsID), fields='dbsnp.alleles.allele, dbsnp.dbsnp_merges, dbsnp.gene.strand, dbsnp.alt, dbsnp.ref')
-    output = f.getvalue()
-
-    objs = queryResult['hits'][0] if len(queryResult['hits']) > 0 else None
-    objsList = []
-    if isinstance(objs, dict):
-        objsList.append(objs)
-        objs = objsList
-
-    alleles = set()
-    if objs is not None:
-        for obj in objs:
-            if ('alleles' in obj['dbsnp']):
-                for alleleObj in obj['dbsnp']['alleles']:
-                    alleles.add(alleleObj['allele'])
-            if ('ref' in obj['dbsnp'] and obj['dbsnp']['ref'] != ""):
-                alleles.add(obj['dbsnp']['ref'])
-            if ('alt' in obj['dbsnp'] and obj['dbsnp']['alt'] != ""):
-                alleles.add(obj['dbsnp']['alt'])
-            if (len(alleles) == 0):
-                print(obj, "STILL NO ALLELES")
-    else:
-        # TODO maybe: try to find it with a merged snp?
-        pass
+        print(f"[ERROR] Batch {batch_num + 1} failed: {e}")
+        return {}
 
-    return list(alleles)
+    return batchAlleles
 
 
 # for POST urls with caching
-def postUrlWithBody(url, body, max_age_hours=24):
-    import json
-    
-    # Create cache directory if it doesn't exist
-    workingFilesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
-    if not os.path.exists(workingFilesPath):
-        os.mkdir(workingFilesPath)
-    
-    cacheDir = os.path.join(workingFilesPath, "post_cache")
-    if not os.path.exists(cacheDir):
-        os.mkdir(cacheDir)
-    
-    # Create cache key from URL and body
-    cache_content = f"{url}|{json.dumps(body, sort_keys=True, ensure_ascii=False)}"
-    cache_key = hashlib.md5(cache_content.encode('utf-8')).hexdigest()
-    cache_file = os.path.join(cacheDir, f"post_{cache_key}.json")
-    
-    # Check if cache exists and is fresh
-    if os.path.exists(cache_file):
-        file_mod_time = os.path.getmtime(cache_file)
-        file_age_hours = (time.time() - file_mod_time) / 3600
-        
-        if file_age_hours < max_age_hours:
-            print(f"[LOG] Using cached response for POST {url} (age: {file_age_hours:.2f}h)")
-            try:
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"[WARN] Cache file corrupted, will fetch fresh: {e}")
-                # Continue to fetch fresh data if cache is corrupted
-    
-    # Fetch fresh data
-    print(f"[LOG] POST URL: {url}")
-    print(f"[LOG] POST BODY: {json.dumps(body, ensure_ascii=False)}")
-
-    response = requests.post(url=url, data=body)
-    response.close()
-    if response.status_code == 504:
-        print("\n*** The connection timed out. If you haven't already, try running the first step with no additional filters, then running the second step with the filters.")
-        print("(See the README file for an example -- under Applying Step Numbers)\n")
-    assert (response), "Error connecting to the server: {0} - {1}".format(response.status_code, response.reason) 
-    
-    result = {}
-    if response.status_code == 204:
-        result = {}
-    else:
-        result = response.json()
-    
-    # Cache the result
-    try:
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
-        print(f"[LOG] Cached POST response to {cache_file}")
-    except Exception as e:
-        print(f"[WARN] Failed to cache response: {e}")
-    
-    return result 
+def postUrlWithBody(url, body, max_age_hours=24, cache=True):
+    def send(headers):
+        print(f"[LOG] POST URL: {url}")
+        print(f"[LOG] POST BODY: {json.dumps(body, ensure_ascii=False)}")
+        response = dm.getSession().post(url=url, data=body, headers=headers)
+        response.close()
+        if response.status_code == 504:
+            print("\n*** The connection timed out. If you haven't already, try running the first step with no additional filters, then running the second step with the filters.")
+            print("(See the README file for an example -- under Applying Step Numbers)\n")
+        assert (response or response.status_code == 304), "Error connecting to the server: {0} - {1}".format(response.status_code, response.reason)
+        return response
 
+    return hc.fetchJson('POST', url, body, send, max_age_hours, cache)
 
 
 # for GET urls with caching
-def getUrlWithParams(url, params, max_age_hours=24):
+def getUrlWithParams(url, params, max_age_hours=24, cache=True):
     import urllib.parse
-    import json
-    
-    # Create cache directory if it doesn't exist
-    workingFilesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
-    if not os.path.exists(workingFilesPath):
-        os.mkdir(workingFilesPath)
-    
-    cacheDir = os.path.join(workingFilesPath, "get_cache")
-    if not os.path.exists(cacheDir):
-        os.mkdir(cacheDir)
-    
-    # Create cache key from URL and params
     full_url = url + '?' + urllib.parse.urlencode(params, doseq=True)
-    cache_key = hashlib.md5(full_url.encode('utf-8')).hexdigest()
-    cache_file = os.path.join(cacheDir, f"get_{cache_key}.json")
-    
-    # Check if cache exists and is fresh
-    if os.path.exists(cache_file):
-        file_mod_time = os.path.getmtime(cache_file)
-        file_age_hours = (time.time() - file_mod_time) / 3600
-        
-        if file_age_hours < max_age_hours:
-            print(f"[LOG] Using cached response for GET {url} (age: {file_age_hours:.2f}h)")
-            try:
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"[WARN] Cache file corrupted, will fetch fresh: {e}")
-                # Continue to fetch fresh data if cache is corrupted
-    
-    # Fetch fresh data
-    print(f"[LOG] GET URL: {full_url}")
-
-    response = requests.get(url=url, params=params)
-    response.close()
-    assert (response), "Error connecting to the server: {0} - {1}".format(response.status_code, response.reason) 
-    
-    result = response.json()
-    
-    # Cache the result
-    try:
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
-        print(f"[LOG] Cached GET response to {cache_file}")
-    except Exception as e:
-        print(f"[WARN] Failed to cache response: {e}")
-    
-    return result  
-
-
-def retry_network_call(func, *args, max_retries=3, **kwargs):
-    """
-    Retry wrapper for network calls with exponential backoff
-    """
-    import time
-    
-    for attempt in range(max_retries):
-        try:
-            result = func(*args, **kwargs)
-            return result
-        except Exception as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt  # Exponential backoff: 1s, 2s, 4s
-                print(f"[WARN] Network call failed (attempt {attempt + 1}/{max_retries}): {e}")
-                print(f"[LOG] Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                print(f"[ERROR] Network call failed after {max_retries} attempts: {e}")
-                raise
-
-
-def cleanup_cache(max_age_days=7):
-    """
-    Clean up old cache files to prevent disk space issues.
-    Removes cache files older than max_age_days.
-    """
-    workingFilesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
-    
-    for cache_type in ["post_cache", "get_cache"]:
-        cache_dir = os.path.join(workingFilesPath, cache_type)
-        if not os.path.exists(cache_dir):
-            continue
-            
-        try:
-            for filename in os.listdir(cache_dir):
-                file_path = os.path.join(cache_dir, filename)
-                if os.path.isfile(file_path):
-                    file_age_days = (time.time() - os.path.getmtime(file_path)) / 86400
-                    if file_age_days > max_age_days:
-                        os.remove(file_path)
-                        print(f"[LOG] Removed old cache file: {filename} (age: {file_age_days:.1f} days)")
-        except Exception as e:
-            print(f"[WARN] Error cleaning cache directory {cache_type}: {e}")
 
+    def send(headers):
+        print(f"[LOG] GET URL: {full_url}")
+        response = dm.getSession().get(url=url, params=params, headers=headers)
+        response.close()
+        assert (response or response.status_code == 304), "Error connecting to the server: {0} - {1}".format(response.status_code, response.reason)
+        return response
 
-def get_cache_stats():
-    """
-    Get statistics about the cache usage.
-    """
-    workingFilesPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
-    stats = {"post_cache": 0, "get_cache": 0, "total_size_mb": 0}
-    
-    for cache_type in ["post_cache", "get_cache"]:
-        cache_dir = os.path.join(workingFilesPath, cache_type)
-        if os.path.exists(cache_dir):
-            try:
-                files = os.listdir(cache_dir)
-                stats[cache_type] = len(files)
-                
-                for filename in files:
-                    file_path = os.path.join(cache_dir, filename)
-                    if os.path.isfile(file_path):
-                        stats["total_size_mb"] += os.path.getsize(file_path) / (1024 * 1024)
-            except Exception as e:
-                print(f"[WARN] Error reading cache directory {cache_type}: {e}")
-    
-    return stats
+    return hc.fetchJson('GET', full_url, None, send, max_age_hours, cache)
 
 
 # get clumps using the refGen and superPop
@@ -1312,29 +978,16 @@ def getClumps(refGen, superPop, snpsFromAssociations):
     print(f"Retrieving clumping information: {superPop}")
 
     try:
-        chromToPosMap = {}
-        clumps = {}
-        for pos in snpsFromAssociations:
-            if (len(pos.split(":")) > 1):
-                chrom,posit = pos.split(":")
-                if (chrom not in chromToPosMap.keys()):
-                    chromToPosMap[chrom] = [pos]
-                else:
-                    chromToPosMap[chrom].append(pos)
-
-        print("Clumps downloaded by chromosome:")
-        for chrom in chromToPosMap:
-            print("{0}...".format(chrom), end="", flush=True)
-            body['positions'] = chromToPosMap[chrom]
-            
-            # Use retry logic for critical clumping call
-            chrom_clumps = retry_network_call(
-                postUrlWithBody, 
-                "https://prs.byu.edu/ld_clumping_by_pos", 
-                body
-            )
-            clumps = {**chrom_clumps, **clumps}
-        print('\n')
+        chromToPosMap = groupPositionsByChrom(snpsFromAssociations)
+        # the server looks up the positions of several chromosomes in one request, so the positions are sent in
+        # batches of up to POSITIONS_PER_REQUEST across chromosomes
+        positions = [pos for chrom in chromToPosMap for pos, _ in chromToPosMap[chrom]]
+        batches = [positions[start:start + POSITIONS_PER_REQUEST] for start in range(0, len(positions), POSITIONS_PER_REQUEST)]
+        print(f"Clumps of {len(positions)} positions on {len(chromToPosMap)} chromosomes downloaded in {len(batches)} requests")
+        batchCalls = [(postUrlWithBody, ("https://prs.byu.edu/ld_clumping_by_pos", {**body, 'positions': batch})) for batch in batches]
+
+        # the batches are downloaded concurrently, each call with retry logic
+        clumps = mergeBatchResults(dm.runConcurrently(batchCalls))
     except AssertionError:
         raise SystemExit("ERROR: 504 - Connection to the server timed out")
 
@@ -1353,35 +1006,48 @@ def getMaf(mafCohort, refGen, snpsFromAssociations):
     print("Retrieving maf information")
     
     try:
-        chromToPosMap = {}
-        maf = {}
-        for pos in snpsFromAssociations:
-            if (len(pos.split(":")) > 1):
-                chrom,posit = pos.split(":")
-                if (chrom not in chromToPosMap.keys()):
-                    chromToPosMap[chrom] = [posit]
-                else:
-                    chromToPosMap[chrom].append(posit)
-
+        chromToPosMap = groupPositionsByChrom(snpsFromAssociations)
+        # the server looks up the maf of one chromosome per request, so the positions of each chromosome are sent
+        # in batches of up to POSITIONS_PER_REQUEST
+        batchCalls = []
         for chrom in chromToPosMap:
-            print("{0}...".format(chrom), end="", flush=True)
-            body['chrom'] = chrom
-            body['pos'] = chromToPosMap[chrom]
-            
-            # Use retry logic for MAF call
-            chrom_maf = retry_network_call(
-                postUrlWithBody,
-                "https://prs.byu.edu/get_maf", 
-                body
-            )
-            maf = {**chrom_maf, **maf}
-        print('\n')
+            posits = [posit for _, posit in chromToPosMap[chrom]]
+            for start in range(0, len(posits), POSITIONS_PER_REQUEST):
+                batchCalls.append((postUrlWithBody, ("https://prs.byu.edu/get_maf", {**body, 'chrom': chrom, 'pos': posits[start:start + POSITIONS_PER_REQUEST]})))
+        print(f"Maf of {sum(len(posits) for posits in chromToPosMap.values())} positions on {len(chromToPosMap)} chromosomes downloaded in {len(batchCalls)} requests")
+
+        # the batches are downloaded concurrently, each call with retry logic
+        maf = mergeBatchResults(dm.runConcurrently(batchCalls))
     except AssertionError:
         raise SystemExit("ERROR: 504 - Connection to the server timed out")
 
     return maf
 
 
+# groups "chrom:pos" positions by chromosome as {chrom: [(position, pos)]}, in the order the chromosomes are found
+def groupPositionsByChrom(snpsFromAssociations):
+    chromToPosMap = {}
+    for pos in dict.fromkeys(snpsFromAssociations):
+        if (len(pos.split(":")) > 1):
+            chrom,posit = pos.split(":")
+            chromToPosMap.setdefault(chrom, []).append((pos, posit))
+    return chromToPosMap
+
+
+# merges the results of the batches of a request into the first one. A key in more than one batch keeps the value of
+# the first batch it is in
+def mergeBatchResults(batchResults):
+    merged = {}
+    for result in batchResults:
+        if not merged:
+            merged = result
+            continue
+        for key, value in result.items():
+            if key not in merged:
+                merged[key] = value
+    return merged
+
+
 def getPercentiles(percentilesCohort, finalStudyList):
     # if the cohort is user, return empty, we will use the user maf
     if (percentilesCohort == 'user'): return {}
@@ -1536,6 +1202,6 @@ def getPreferredPop(popList, superPop):
 
 if __name__ == "__main__":
     if argv[1] == "GWAS":
-        formatGWASAndRetrieveClumps(argv[2], argv[3], argv[4], argv[5], argv[6], argv[7], argv[8], argv[9], argv[10])
+        formatGWASAndRetrieveClumps(argv[2], argv[3], argv[4], argv[5], argv[6], argv[7], argv[8], argv[9], argv[10], argv[11], argv[12])
     else:
         retrieveAssociationsAndClumps(argv[1], argv[2], argv[3], argv[4], argv[5], argv[6], argv[7], argv[8], argv[9], argv[10], argv[11])
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Shared HTTP session and download threads for the requests step 1 sends to the server.
+#
+# Every request goes through one keep-alive session per process, so the connection to the server (and its TLS
+# handshake) is reused instead of opened again for each request. Independent requests (the database files, the
+# clump files of each super population, the batches of positions the clumps and maf are requested for, ...) are run
+# concurrently by a bounded pool of threads (PRS_DOWNLOAD_THREADS, 6 by default), with each call retried by
+# retry_network_call, so step 1 is limited by the bandwidth to the server rather than by the round trip of each request.
+
+DEFAULT_THREADS = 6
+
+# the session of this process (processes started with fork open their own)
+openSession = None
+sessionLock = threading.Lock()
+
+
+def getNumThreads():
+    numThreads = os.environ.get("PRS_DOWNLOAD_THREADS", DEFAULT_THREADS)
+    try:
+        numThreads = int(numThreads)
+    except ValueError:
+        raise SystemExit(f"ERROR: PRS_DOWNLOAD_THREADS must be a number of threads, not '{numThreads}'.")
+    return max(1, numThreads)
+
+
+def getSession():
+    # returns the keep-alive session of this process, with a connection pool large enough for every download thread
+    global openSession
+    with sessionLock:
+        if openSession is None or openSession[0] != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=getNumThreads())
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            openSession = (os.getpid(), session)
+        return openSession[1]
+
+
+def retry_network_call(func, *args, max_retries=3, **kwargs):
+    """
+    Retry wrapper for network calls with exponential backoff
+    """
+    for attempt in range(max_retries):
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except Exception as e:
+            if attempt < max_retries - 1:
+                wait_time = 2 ** attempt  # Exponential backoff: 1s, 2s, 4s
+                print(f"[WARN] Network call failed (attempt {attempt + 1}/{max_retries}): {e}")
+                print(f"[LOG] Retrying in {wait_time} seconds...")
+                time.sleep(wait_time)
+            else:
+                print(f"[ERROR] Network call failed after {max_retries} attempts: {e}")
+                raise
+
+
+def runConcurrently(calls, retry=True):
+    """
+    Runs independent network calls in the download threads.
+
+    Args:
+        calls: list of (function, args) tuples
+        retry: if True, each call is retried with retry_network_call
+
+    Returns:
+        list: the result of each call, in the order of calls. If a call fails, its exception is raised once every
+              call has finished
+    """
+    if len(calls) <= 1:
+        return [retry_network_call(func, *args) if retry else func(*args) for func, args in calls]
+
+    with ThreadPoolExecutor(max_workers=min(getNumThreads(), len(calls))) as executor:
+        if retry:
+            futures = [executor.submit(retry_network_call, func, *args) for func, args in calls]
+        else:
+            futures = [executor.submit(func, *args) for func, args in calls]
+    return [future.result() for future in futures]
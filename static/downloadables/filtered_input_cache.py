@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import zlib
+
+# Cache of the filtered input files made by grep_file.py.
+#
+# Filtering reads the whole input file, but its result only depends on the input file and the SNPs of the selected
+# studies, so runs on the same input with a different p-value cutoff, output format, maf cohort, ... can reuse it.
+# Each filtered file is kept in .workingFiles/filteredInputCache (or PRS_FILTER_CACHE_DIR) under the key of the
+# filtering, with the SNPs it matched (in the order they were matched, to count the LD clumps again), in a SQLite
+# index in the same directory. The key is the md5 of:
+#   the input files   their path, size, and modification time. With PRS_FILTER_CACHE_FULL_HASH=1 the sha256 of
+#                     their content is used instead, so copies and touched files are still found. The content hash
+#                     of a file is recorded with its size and modification time, so it's only computed once
+#   the SNPs          the md5 of the sorted SNPs of the selected studies
+#   the rest          the input type, GWAS upload, and the name, size, and modification time of the associations
+#                     file the SNPs are matched with (the database associations or the GWAS upload)
+# The cache is kept under a byte budget (PRS_FILTER_CACHE_MAX_MB, 2048MB by default, 0 turns the cache off) by
+# removing the least recently used filtered files. Filtered files are hard linked to the path the run uses (or copied
+# where links aren't possible), so removing the run's filtered file doesn't remove the cached one.
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles", "filteredInputCache")
+DEFAULT_MAX_MB = 2048
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FilteredInputCache:
+    """
+    Filtered input files and the SNPs they matched, kept under maxBytes by least recently used eviction.
+    """
+
+    def __init__(self, cacheDir, maxBytes, fullHash=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.fullHash = fullHash
+        os.makedirs(cacheDir, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(cacheDir, "index.sqlite"), timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, fileName TEXT NOT NULL, size INTEGER NOT NULL, stored REAL NOT NULL, lastAccess REAL NOT NULL, matchedSnps BLOB NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entriesByAccess ON entries (lastAccess)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS contentHashes (path TEXT PRIMARY KEY, sourceMtime INTEGER NOT NULL, sourceSize INTEGER NOT NULL, contentHash TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            row = self.connection.execute("SELECT value FROM info WHERE name = 'version'").fetchone()
+            if row is not None and row[0] != CACHE_VERSION:
+                for fileName, in self.connection.execute("SELECT fileName FROM entries"):
+                    self.removeFile(fileName)
+                self.connection.execute("DELETE FROM entries")
+            self.connection.execute("INSERT OR REPLACE INTO info (name, value) VALUES ('version', ?)", (CACHE_VERSION,))
+
+    def close(self):
+        self.connection.close()
+
+    def getInputIdentity(self, inputPath):
+        # the size and modification time of the input file, or the hash of its content
+        inputPath = os.path.abspath(inputPath)
+        sourceStat = os.stat(inputPath)
+        if not self.fullHash:
+            return "{0}|{1}|{2}".format(inputPath, sourceStat.st_size, sourceStat.st_mtime_ns)
+        row = self.connection.execute("SELECT sourceMtime, sourceSize, contentHash FROM contentHashes WHERE path = ?", (inputPath,)).fetchone()
+        if row is not None and row[0] == sourceStat.st_mtime_ns and row[1] == sourceStat.st_size:
+            return row[2]
+        print(f"[LOG] Hashing the content of {inputPath} for the filtered input cache")
+        digest = hashlib.sha256()
+        with open(inputPath, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO contentHashes (path, sourceMtime, sourceSize, contentHash) VALUES (?, ?, ?, ?)",
+                (inputPath, sourceStat.st_mtime_ns, sourceStat.st_size, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def makeKey(self, inputFiles, allSnps, *params):
+        snpsHash = hashlib.md5("\n".join(sorted(allSnps)).encode('utf-8')).hexdigest()
+        keyContent = json.dumps([CACHE_VERSION, [self.getInputIdentity(aFile) for aFile in inputFiles], snpsHash, list(params)])
+        return hashlib.md5(keyContent.encode('utf-8')).hexdigest()
+
+    def get(self, key, filteredInputPath):
+        """
+        Puts the cached filtered file of key at filteredInputPath and returns the SNPs it matched, or returns None if
+        it isn't cached. Marks the file as used.
+        """
+        row = self.connection.execute("SELECT fileName, matchedSnps FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            matchedSnps = json.loads(zlib.decompress(row[1]).decode('utf-8'))
+            linkOrCopy(os.path.join(self.cacheDir, row[0]), filteredInputPath)
+        except (OSError, zlib.error, ValueError) as e:
+            print(f"[WARN] Cached filtered input is missing or corrupted, filtering again: {e}")
+            self.remove(key)
+            return None
+        with self.connection:
+            self.connection.execute("UPDATE entries SET lastAccess = ? WHERE key = ?", (time.time(), key))
+        return matchedSnps
+
+    def put(self, key, filteredInputPath, matchedSnps):
+        # stores the filtered file at filteredInputPath (which stays where it is) and evicts files to stay in the budget
+        blob = zlib.compress(json.dumps(matchedSnps).encode('utf-8'))
+        size = os.path.getsize(filteredInputPath) + len(blob)
+        if size > self.maxBytes:
+            print(f"[LOG] Not caching the filtered input ({size / (1024 * 1024):.2f} MB is more than the cache budget)")
+            return
+        fileName = key + os.path.splitext(filteredInputPath)[1]
+        tmpPath = os.path.join(self.cacheDir, fileName + ".tmp{0}".format(os.getpid()))
+        linkOrCopy(filteredInputPath, tmpPath)
+        os.replace(tmpPath, os.path.join(self.cacheDir, fileName))
+        now = time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO entries (key, fileName, size, stored, lastAccess, matchedSnps) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, fileName, size, now, now, sqlite3.Binary(blob)))
+            self.evict()
+
+    def remove(self, key):
+        with self.connection:
+            row = self.connection.execute("SELECT fileName FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.removeFile(row[0])
+
+    def removeFile(self, fileName):
+        try:
+            os.remove(os.path.join(self.cacheDir, fileName))
+        except OSError:
+            pass
+
+    def evict(self):
+        # removes the least recently used filtered files until the cache is within its budget (inside a transaction)
+        excess = (self.connection.execute("SELECT SUM(size) FROM entries").fetchone()[0] or 0) - self.maxBytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, fileName, size in self.connection.execute("SELECT key, fileName, size FROM entries ORDER BY lastAccess"):
+            evicted.append((key, fileName))
+            excess -= size
+            if excess <= 0:
+                break
+        for key, fileName in evicted:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.removeFile(fileName)
+        print(f"[LOG] Evicted {len(evicted)} filtered inputs from the cache to stay under {self.maxBytes / (1024 * 1024):.0f} MB")
+
+
+def linkOrCopy(sourcePath, destPath):
+    # a new name for the file, so the file at destPath can be removed (but mustn't be written to)
+    if os.path.exists(destPath):
+        os.remove(destPath)
+    try:
+        os.link(sourcePath, destPath)
+    except OSError:
+        shutil.copyfile(sourcePath, destPath)
+
+
+def getCache():
+    # returns the cache, or None if it is turned off
+    maxMb = os.environ.get("PRS_FILTER_CACHE_MAX_MB", DEFAULT_MAX_MB)
+    try:
+        maxBytes = int(float(maxMb) * 1024 * 1024)
+    except ValueError:
+        raise SystemExit(f"ERROR: PRS_FILTER_CACHE_MAX_MB must be a number of megabytes, not '{maxMb}'.")
+    if maxBytes <= 0:
+        return None
+    fullHash = os.environ.get("PRS_FILTER_CACHE_FULL_HASH", "0") == "1"
+    return FilteredInputCache(os.environ.get("PRS_FILTER_CACHE_DIR", DEFAULT_CACHE_DIR), maxBytes, fullHash)
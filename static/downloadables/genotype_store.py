@@ -0,0 +1,315 @@
+from array import array
+from itertools import chain
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import vcf
+from connect_to_server import openFileForParsing
+
+# allele codes used in the genotype store
+# 0 is the reference allele, 1..n are the alternate alleles (ALT index + 1)
+MISSING_ALLELE = -1 # the allele is unknown ('.')
+ABSENT_ALLELE = -2 # the sample has fewer alleles than the ploidy of the record (e.g. haploid calls)
+# columns separated by runs of spaces, as PyVCF also accepts
+ROW_PATTERN = re.compile(r'[\t ]+')
+# values PyVCF reads as None
+MISSING_VALUES = ('.', '', 'NA')
+
+
+class UnusualRecord(Exception):
+    # raised by the GT tokenizer for records it leaves to PyVCF
+    pass
+
+
+def buildGenotypeStore(filteredFilePath, tableObjDict):
+    """
+    Parses the filtered VCF exactly once into a compact genotype store that every study can slice.
+
+    The records are read by a tokenizer that only extracts the GT subfield of each sample. Files it doesn't handle
+    (breakend ALTs, FORMAT without GT, samples without a GT subfield) are parsed again with PyVCF.
+
+    Args:
+        filteredFilePath: Path to the filtered input VCF created by grep_file
+        tableObjDict: Dictionary containing associations data
+
+    Returns:
+        dict: {
+            'samples': list of sample names in column order,
+            'records': list of (rsID, chromPos, CHROM, POS, REF, ALT, AF, ploidy, codes) tuples in file order,
+            'identifierIndex': identifier (rsID, chromPos, or mapped rsID) -> list of record indices,
+            'noRsidPosIndex': chromPos -> list of record indices for records without an rsID
+        }
+    """
+    try:
+        try:
+            genotypeStore = readGenotypeStore(filteredFilePath, tableObjDict, readGenotypeRecords)
+        except UnusualRecord as e:
+            print(f"[LOG] {e}, parsing the input file with PyVCF")
+            genotypeStore = readGenotypeStore(filteredFilePath, tableObjDict, readPyVcfRecords)
+    except ValueError:
+        raise SystemExit("The VCF file is not formatted correctly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position.")
+
+    print(f"[LOG] Built genotype store with {len(genotypeStore['records'])} variants and {len(genotypeStore['samples'])} samples")
+    return genotypeStore
+
+
+def readGenotypeStore(filteredFilePath, tableObjDict, readRecords):
+    # builds the genotype store from the (rsID, CHROM, POS, REF, ALT, AF, genotypes) tuples yielded by readRecords
+    associations = tableObjDict.get('associations', {})
+    records = []
+    identifierIndex = {}
+    noRsidPosIndex = {}
+    # most records share a handful of genotype strings, so each one is converted once
+    codesCache = {}
+
+    vcf_reader = vcf.Reader(openFileForParsing(filteredFilePath))
+    samples = vcf_reader.samples
+
+    for rsID, CHROM, POS, REF, ALT, AF, genotypes in readRecords(vcf_reader):
+        chromPos = str(CHROM) + ":" + str(POS)
+
+        # convert every sample's GT into allele codes
+        sampleCodes = []
+        for genotype in genotypes:
+            alleleCodes = codesCache.get(genotype)
+            if alleleCodes is None:
+                alleleCodes = codesCache[genotype] = genotypeToAlleleCodes(genotype)
+            sampleCodes.append(alleleCodes)
+        ploidies = set([len(x) for x in sampleCodes])
+        ploidy = max(ploidies) if sampleCodes else 0
+        if len(ploidies) == 1:
+            codes = array('b', chain.from_iterable(sampleCodes))
+        else:
+            codes = array('b')
+            for alleleCodes in sampleCodes:
+                codes.extend(alleleCodes)
+                codes.extend([ABSENT_ALLELE] * (ploidy - len(alleleCodes)))
+
+        recordIdx = len(records)
+        records.append((rsID, chromPos, CHROM, POS, REF, ALT, AF, ploidy, codes))
+
+        # index every identifier this record could resolve to so that studies only visit their own records
+        keys = {chromPos}
+        if rsID is None or rsID == '.' or rsID == '':
+            noRsidPosIndex.setdefault(chromPos, []).append(recordIdx)
+        else:
+            keys.add(rsID)
+            if chromPos in associations and rsID not in associations and isinstance(associations[chromPos], str):
+                keys.add(associations[chromPos])
+        for key in keys:
+            identifierIndex.setdefault(key, []).append(recordIdx)
+
+    return {
+        'samples': samples,
+        'records': records,
+        'identifierIndex': identifierIndex,
+        'noRsidPosIndex': noRsidPosIndex
+    }
+
+
+def readPyVcfRecords(vcf_reader):
+    for record in vcf_reader:
+        ALT = [str(x) for x in record.ALT]
+        AF = record.INFO["AF"] if "AF" in record.INFO else None
+        yield record.ID, record.CHROM, record.POS, record.REF, ALT, AF, [call['GT'] for call in record.samples]
+
+
+def readGenotypeRecords(vcf_reader):
+    """
+    Tokenizes the records after the header read by vcf_reader, giving the same values as readPyVcfRecords.
+    The GT index is looked up once for each FORMAT and only the GT subfield of each sample is split out, the other
+    subfields and INFO entries (except AF) are never parsed.
+    """
+    numSamples = len(vcf_reader.samples)
+    afNumber = vcf_reader.infos['AF'].num if 'AF' in vcf_reader.infos else None
+    gtIndexes = {}
+    # vcf_reader.reader yields the stripped, non-empty lines after the header
+    for line in vcf_reader.reader:
+        # PyVCF also separates columns with runs of spaces
+        row = line.split('\t') if ' ' not in line else ROW_PATTERN.split(line)
+        CHROM = row[0]
+        POS = int(row[1])
+        rsID = row[2] if row[2] != '.' else None
+        REF = row[3]
+
+        ALT = []
+        for alt in row[4].split(','):
+            if alt in ('.', '', 'NA'):
+                ALT.append('None')
+            elif '[' in alt or ']' in alt or (len(alt) > 1 and (alt[0] == '.' or alt[-1] == '.')):
+                raise UnusualRecord(f"Breakend ALT {alt} at {CHROM}:{POS}")
+            else:
+                ALT.append(alt)
+
+        # AF is a list of floats, or a single float if the INFO header gives it one value. The last AF entry wins
+        AF = None
+        if 'AF' in row[7]:
+            for entry in row[7].split(';'):
+                key, hasValue, value = entry.partition('=')
+                if key != 'AF':
+                    continue
+                if not hasValue:
+                    raise UnusualRecord(f"AF without a value at {CHROM}:{POS}")
+                AF = [float(x) if x not in MISSING_VALUES else None for x in value.split(',')]
+                if afNumber == 1:
+                    AF = AF[0]
+
+        fmt = row[8] if len(row) > 8 else '.'
+        if fmt == '.':
+            genotypes = []
+        else:
+            gtIdx = gtIndexes.get(fmt)
+            if gtIdx is None:
+                fields = fmt.split(':')
+                if 'GT' not in fields:
+                    raise UnusualRecord(f"No GT in the FORMAT {fmt} at {CHROM}:{POS}")
+                gtIdx = gtIndexes[fmt] = fields.index('GT')
+            columns = row[9:9 + numSamples]
+            if gtIdx == 0:
+                genotypes = [x.partition(':')[0] for x in columns]
+            else:
+                try:
+                    genotypes = [x.split(':')[gtIdx] for x in columns]
+                except IndexError:
+                    raise UnusualRecord(f"Sample without a GT at {CHROM}:{POS}")
+        yield rsID, CHROM, POS, REF, ALT, AF, genotypes
+
+
+def genotypeToAlleleCodes(genotype):
+    # read and interpret the genotype column from the VCF
+    # if the genotype is completely null, both alleles are unknown
+    if genotype == "./." or genotype == ".|." or genotype == ".." or genotype == '.':
+        return [MISSING_ALLELE, MISSING_ALLELE]
+
+    if "|" in genotype:
+        gt_nums = genotype.split('|')
+    elif "/" in genotype:
+        gt_nums = genotype.split('/')
+    else:
+        gt_nums = list(genotype)
+
+    codes = []
+    for alleleNum in gt_nums:
+        if alleleNum == '.':
+            codes.append(MISSING_ALLELE)
+        else:
+            codes.append(int(alleleNum))
+    return codes
+
+
+def alleleCodesToAlleles(codes, REF, ALT):
+    alleles = []
+    for code in codes:
+        if code == 0:
+            alleles.append(str(REF))
+        elif code == MISSING_ALLELE:
+            alleles.append('.')
+        elif code != ABSENT_ALLELE:
+            alleles.append(str(ALT[code - 1]))
+    return alleles
+
+
+def getSampleAlleles(record, sampleIdx):
+    # returns the alleles of one sample for a record of the genotype store
+    REF, ALT, ploidy, codes = record[4], record[5], record[7], record[8]
+    start = sampleIdx * ploidy
+    return alleleCodesToAlleles(codes[start:start + ploidy], REF, ALT)
+
+
+def getStudyRecords(genotypeStore, snpSet, tableObjDict, snpPositions):
+    """
+    Resolves which records of the genotype store belong to a study without rescanning the file.
+
+    Uses the same identifier rules the per-study VCF pass used: chromPos identifiers first, then
+    position matching for records without an rsID, then the legacy chromPos -> rsID mapping.
+    Records without an rsID are matched through snpPositions, the SNP -> position map of the position index
+    (see position_index.py).
+
+    Returns:
+        list: (recordIdx, identifier) tuples in file order
+    """
+    associations = tableObjDict.get('associations', {})
+    identifierIndex = genotypeStore['identifierIndex']
+    noRsidPosIndex = genotypeStore['noRsidPosIndex']
+
+    studySnps = set(snpSet)
+    candidates = set()
+    # normalized database position -> first snp in the study at that position
+    studyPosToSnp = {}
+    for snp in snpSet:
+        if snp in identifierIndex:
+            candidates.update(identifierIndex[snp])
+        if noRsidPosIndex:
+            chromPos = snpPositions.get(snp)
+            # when more than one study snp is at this position, the one that comes first in the study is used
+            if chromPos in noRsidPosIndex and chromPos not in studyPosToSnp:
+                studyPosToSnp[chromPos] = snp
+                candidates.update(noRsidPosIndex[chromPos])
+
+    studyRecords = []
+    for recordIdx in sorted(candidates):
+        rsID, chromPos = genotypeStore['records'][recordIdx][0:2]
+        identifier_to_check = rsID
+        if chromPos in studySnps:
+            identifier_to_check = chromPos
+        elif rsID is None or rsID == '.' or rsID == '':
+            identifier_to_check = studyPosToSnp.get(chromPos, chromPos)
+        elif (chromPos in associations and rsID not in associations):
+            if isinstance(associations[chromPos], str):
+                identifier_to_check = associations[chromPos]
+
+        if identifier_to_check in studySnps:
+            studyRecords.append((recordIdx, identifier_to_check))
+
+    return studyRecords
+
+
+def writeBenchmarkVcf(path, numVariants, numSamples):
+    # synthetic VCF shaped like static/ad_test.vcf: GT, GT:GP and GT:PL formats with missing and partial calls
+    genotypes = ['0/0', '0/0', '0/1', '1/1', '0|1', '1|0', './.', './1']
+    formats = [('GT', lambda: ''), ('GT:GP', lambda: ':0.03,0.97,0'), ('GT:PL', lambda: ':10,5,0')]
+    rng = random.Random(0)
+    with open(path, 'w') as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
+        f.write('##FORMAT=<ID=GT,Number=1,Type=Integer,Description="Genotype">\n')
+        f.write('##FORMAT=<ID=GP,Number=G,Type=Float,Description="Genotype Probabilities">\n')
+        f.write('##FORMAT=<ID=PL,Number=G,Type=Float,Description="Phred-scaled Genotype Likelihoods">\n')
+        f.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + ["SAMP{0:05d}".format(i + 1) for i in range(numSamples)]) + "\n")
+        for i in range(numVariants):
+            fmt, otherFields = formats[i % len(formats)]
+            calls = [rng.choice(genotypes) + otherFields() for _ in range(numSamples)]
+            info = "AF={0:.3f}".format(rng.random()) if i % 2 == 0 else "."
+            f.write("\t".join([str(i % 22 + 1), str(100000 + i), "rs{0}".format(i + 1), "C", "G", ".", "PASS", info, fmt] + calls) + "\n")
+
+
+def runBenchmark(numVariants, numSamples):
+    # times building the genotype store with the GT tokenizer against PyVCF on the same synthetic file
+    fd, path = tempfile.mkstemp(suffix=".vcf")
+    os.close(fd)
+    try:
+        writeBenchmarkVcf(path, numVariants, numSamples)
+        tableObjDict = {'associations': {}}
+        timings = {}
+        stores = {}
+        for name, readRecords in (('PyVCF', readPyVcfRecords), ('GT tokenizer', readGenotypeRecords)):
+            startTime = time.time()
+            stores[name] = readGenotypeStore(path, tableObjDict, readRecords)
+            timings[name] = time.time() - startTime
+        if stores['PyVCF'] != stores['GT tokenizer']:
+            raise SystemExit("ERROR: The GT tokenizer and PyVCF built different genotype stores.")
+        print(f"[LOG] {numVariants} variants x {numSamples} samples")
+        for name, seconds in timings.items():
+            print(f"[LOG] {name}: {seconds:.3f}s")
+        print(f"[LOG] Speedup: {timings['PyVCF'] / max(timings['GT tokenizer'], 1e-9):.1f}x")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    # micro-benchmark of the genotype parsing: python genotype_store.py benchmark [numVariants] [numSamples]
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        runBenchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000, int(sys.argv[3]) if len(sys.argv) > 3 else 500)
@@ -6,9 +6,18 @@ import os.path
 import json
 import subprocess
 import tempfile
+import shutil
+from multiprocessing import Pool
 
 from sys import argv
 from connect_to_server import getPreferredPop, openFileForParsing
+import working_store as ws
+import tabix_reader as tr
+import study_index as si
+import filtered_input_cache as fc
+
+# data shared with the processes that filter the input files (see initializeFilterWorker)
+filterData = {}
 
 def open_bcf_with_bcftools(input_bcf_path, bcftools_args=None):
     """
@@ -52,13 +61,14 @@ def open_bcf_with_bcftools(input_bcf_path, bcftools_args=None):
         raise SystemExit(f"ERROR: Failed to open BCF file with bcftools: {str(e)}")
 
 
-def extract_genomic_regions_from_gwas(tableObjDict, allSnps):
+def extract_genomic_regions_from_gwas(tableObjDict, allSnps, unplacedSnps=None):
     """
-    Extract genomic regions from GWAS data for targeted bcftools queries.
+    Extract genomic regions from GWAS data for targeted bcftools and tabix queries.
     
     Args:
         tableObjDict: Dictionary containing associations data
         allSnps: Set of SNP identifiers to extract regions for
+        unplacedSnps: Optional list that the SNPs without a position are added to
     
     Returns:
         list: List of genomic regions in format "chr:pos" or "chr:start-end"
@@ -79,11 +89,9 @@ def extract_genomic_regions_from_gwas(tableObjDict, allSnps):
                 end = pos + 1000
                 region = f"{chrom}:{start}-{end}"
                 regions.append(region)
-                print(f"[LOG] Added region window from chromPos {snp}: {region}")
             except (ValueError, IndexError):
                 # If parsing fails, use the original chromPos as exact position
                 regions.append(snp)
-                print(f"[LOG] Added region from chromPos (fallback): {snp}")
         
         # Also check if the SNP exists in associations with position info
         elif snp in tableObjDict.get('associations', {}):
@@ -103,14 +111,15 @@ def extract_genomic_regions_from_gwas(tableObjDict, allSnps):
                         end = pos + 1000
                         region = f"{chrom}:{start}-{end}"
                         regions.append(region)
-                        print(f"[LOG] Added region window from associations[{snp}] ({pos_str} -> {region})")
                     else:
                         # Handle position without colon - assume it's just a position number
                         regions.append(pos_str)
-                        print(f"[LOG] Added region from associations[{snp}]: {pos_str}")
                 except (ValueError, IndexError):
                     regions.append(assoc['pos'])
-                    print(f"[LOG] Added region from associations[{snp}] (fallback): {assoc['pos']}")
+            elif unplacedSnps is not None:
+                unplacedSnps.append(snp)
+        elif unplacedSnps is not None:
+            unplacedSnps.append(snp)
     
     # Remove duplicates and sort
     unique_regions = sorted(list(set(regions)))
@@ -169,7 +178,7 @@ def open_bcf_with_region_queries(input_bcf_path, regions_list):
 
 
 # filter the input vcf or txt file so that it only include SNPs that exist in the PRSKB database
-def createFilteredFile(inputFilePath, fileHash, requiredParamsHash, superPop, refGen, sexes, valueTypes, p_cutOff, traits, studyTypes, studyIDs, ethnicities, extension, timestamp, useGWASupload):
+def createFilteredFile(inputFilePath, fileHash, requiredParamsHash, superPop, refGen, sexes, valueTypes, p_cutOff, traits, studyTypes, studyIDs, ethnicities, extension, timestamp, useGWASupload, num_processes=None):
     inputFiles = inputFilePath.split(" ")
 
     useGWASupload = True if useGWASupload == "True" or useGWASupload == True else False
@@ -192,7 +201,8 @@ def createFilteredFile(inputFilePath, fileHash, requiredParamsHash, superPop, re
     if not isPreFiltered and not isAllFiltersNone:
         basePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
         filteredStudySnpsPath = os.path.join(basePath, "filteredStudySnps_{ahash}_{uniq}.txt".format(ahash=fileHash, uniq=timestamp))
-        filteredStudySnps = filterStudySnps(tableObjDict, studySnpsDict, traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes, isOnlyStudyIDs)
+        studyIndex = si.loadStudyIndex(os.path.join(basePath, "allAssociations_{refGen}.txt".format(refGen=refGen)), tableObjDict)
+        filteredStudySnps = filterStudySnps(studyIndex, studySnpsDict, traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes, isOnlyStudyIDs)
         studySnpsDict = filteredStudySnps
         with open(filteredStudySnpsPath, 'w') as f:
             f.write(json.dumps(filteredStudySnps))
@@ -215,21 +225,52 @@ def createFilteredFile(inputFilePath, fileHash, requiredParamsHash, superPop, re
     print(f"[LOG] Using BCF format: {isBCF}")
     print(f"[LOG] Using GWAS upload: {useGWASupload}")
     
-    if isBCF:
-        print(f"[LOG] Processing BCF file with filterVCF function")
-        clumpNumDict = filterVCF(
-            tableObjDict, allClumpsObjDict, allSnps, inputFiles,
-            filteredInputPath, useGWASupload, isBCF=True
-        )
-    elif isRSids:
-        clumpNumDict = filterTXT(
-            allClumpsObjDict, allSnps, inputFiles, filteredInputPath, useGWASupload
-        )
+    # the filtered input of the same input files and snps is reused from the cache (see filtered_input_cache.py)
+    cache = fc.getCache()
+    cacheKey = None
+    matchedSnps = None
+    if cache is not None:
+        try:
+            # the snps are matched to the input through the associations file (the rsIDs and positions of the upload)
+            if useGWASupload:
+                associationsFileName = "GWASassociations_{bhash}.txt".format(bhash=fileHash)
+            else:
+                associationsFileName = "allAssociations_{refGen}.txt".format(refGen=refGen)
+            associationsStat = os.stat(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles", associationsFileName))
+            associationsIdentity = [associationsFileName, associationsStat.st_size, associationsStat.st_mtime_ns]
+            cacheKey = cache.makeKey(inputFiles, allSnps, isRSids, isBCF, useGWASupload, associationsIdentity)
+            matchedSnps = cache.get(cacheKey, filteredInputPath)
+        except OSError as e:
+            print(f"[WARN] Could not use the filtered input cache: {e}")
+            cacheKey = None
+
+    if matchedSnps is not None:
+        print(f"[LOG] Using the cached filtered input ({len(matchedSnps)} matched SNPs)")
+        clumpNumDict = countClumpNums(allClumpsObjDict, allSnps, matchedSnps)
     else:
-        clumpNumDict = filterVCF(
-            tableObjDict, allClumpsObjDict, allSnps, inputFiles,
-            filteredInputPath, useGWASupload, isBCF=False
-        )
+        # the filtered file may be a name of a cached file, which mustn't be written to
+        if os.path.exists(filteredInputPath):
+            os.remove(filteredInputPath)
+        matchedSnps = []
+        if isBCF:
+            print(f"[LOG] Processing BCF file with filterVCF function")
+            clumpNumDict = filterVCF(
+                tableObjDict, allClumpsObjDict, allSnps, inputFiles,
+                filteredInputPath, useGWASupload, isBCF=True, num_processes=num_processes, matchedSnps=matchedSnps
+            )
+        elif isRSids:
+            clumpNumDict = filterTXT(
+                allClumpsObjDict, allSnps, inputFiles, filteredInputPath, useGWASupload, matchedSnps
+            )
+        else:
+            clumpNumDict = filterVCF(
+                tableObjDict, allClumpsObjDict, allSnps, inputFiles,
+                filteredInputPath, useGWASupload, isBCF=False, num_processes=num_processes, matchedSnps=matchedSnps
+            )
+        if cacheKey is not None:
+            cache.put(cacheKey, filteredInputPath, matchedSnps)
+    if cache is not None:
+        cache.close()
 
     # write the clumpNumDict to a file for future use
     # the clumpNumDict is used to determine which variants aren't in LD with any of the other variants in the study
@@ -268,11 +309,9 @@ def getFilesAndPaths(fileHash, requiredParamsHash, superPop, refGen, isRSids, ti
         print(f"[LOG] Checking if files exist...")
         print(f"[LOG]   Associations exists: {os.path.exists(associationsPath)}")
         print(f"[LOG]   StudySnps exists: {os.path.exists(studySnpsPath)}")
-        # write the files
-        with open(associationsPath, 'r') as tableObjFile:
-            tableObjDict = json.load(tableObjFile)
-        with open(studySnpsPath, 'r') as studySnpsFile:
-            studySnpsDict = json.load(studySnpsFile)
+        # read the files (the database files are read through their binary stores)
+        tableObjDict = ws.loadWorkingFile(associationsPath, not useGWASupload)
+        studySnpsDict = ws.loadWorkingFile(studySnpsPath, not useGWASupload)
 
         # Get super populations from studyIDMetaData
         allSuperPops = set()
@@ -296,13 +335,7 @@ def getFilesAndPaths(fileHash, requiredParamsHash, superPop, refGen, isRSids, ti
             print(f"[LOG] Expected clumps file for {pop}: {clumpsPath}")
             print(f"[LOG]   Clumps file exists: {os.path.exists(clumpsPath)}")
             
-            with open(clumpsPath, 'r') as clumpsObjFile:
-                clumpsObjDict = json.load(clumpsObjFile)
-                allClumps[pop] = clumpsObjDict
-                clumpsObjFile = {}
-
-        tableObjFile = {}
-        studySnpsFile = {}
+            allClumps[pop] = ws.loadWorkingFile(clumpsPath, not useGWASupload)
     except FileNotFoundError: 
         if 'allSuperPops' in locals():
             raise SystemExit("ERROR: One or both of the required working files could not be found. \n Paths searched for: \n{0}\nClumping files for the following superPops: {1}\n{2}".format(associationsPath, allSuperPops, studySnpsPath))
@@ -341,33 +374,36 @@ def formatVarForFiltering(traits, studyTypes, studyIDs, ethnicities, sexes, valu
     return traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes
 
 
-def filterStudySnps(tableObjDict, studySnpsDict, traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes, isOnlyStudyIDs):
+def filterStudySnps(studyIndex, studySnpsDict, traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes, isOnlyStudyIDs):
+    # the study index maps each filter value to the trait/study keys it selects (see study_index.py)
     tmpObj = {}
-    for snp in tableObjDict['associations'].keys():
-        if (snp.startswith('rs')):
-            # if isSnpInFilters()
-            for trait in tableObjDict['associations'][snp]['traits'].keys():
-                useTrait = (traits is not None and trait.lower() in traits) or traits is None
-                for study in tableObjDict['associations'][snp]['traits'][trait]:
-                    useStudy = studyIDs is not None and study in studyIDs
-                    useReportedTrait = (traits is not None and tableObjDict['studyIDsToMetaData'][study]['reportedTrait'] in traits) or traits is None
-                    useStudyTypes = (studyTypes is not None and len(set(tableObjDict['studyIDsToMetaData'][study]['studyTypes']) &set(studyTypes)) > 0) or studyTypes is None
-                    useTraitStudyTypes = (studyTypes is not None and len(set(tableObjDict['studyIDsToMetaData'][study]['traits'][trait]['studyTypes']) &set(studyTypes)) > 0) or studyTypes is None
-                    useEthnicity = (ethnicities is not None and len(set([x.lower() for x in tableObjDict['studyIDsToMetaData'][study]['ethnicity']]) &set(ethnicities)) > 0) or ethnicities is None
-                    if sexes is not None and ('e' in sexes or 'exclude' in sexes):
-                        useSexes = len(set(tableObjDict['studyIDsToMetaData'][study]['traits'][trait]['sexes']) &set(['male', 'female'])) == 0
-                    else:
-                        useSexes = (sexes is not None and len(set(tableObjDict['studyIDsToMetaData'][study]['traits'][trait]['sexes']) &set(['male', 'female'])) > 0) or sexes is None
-                    for uniqueKey in tableObjDict['associations'][snp]['traits'][trait][study]:
-                        pValANno, betaAnno, valueType = uniqueKey.split("|")
-                        useValueType = (valueTypes is not None and valueType in valueTypes) or valueTypes is None
-                        fullKeyString = "|".join([trait, uniqueKey, study])
-                        if useStudy or ((not isOnlyStudyIDs) and (useTrait or useReportedTrait) and (useStudyTypes or useTraitStudyTypes) and useEthnicity and useSexes and useValueType):
-                            tmpObj[fullKeyString] = studySnpsDict[fullKeyString]
+    for fullKeyString in si.selectKeys(studyIndex, traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes, isOnlyStudyIDs):
+        tmpObj[fullKeyString] = studySnpsDict[fullKeyString]
     return tmpObj
 
 
-def filterTXT(allClumpsObjDict, allSnps, inputFiles, filteredFilePath, useGWASupload):
+def countClumpNums(allClumpsObjDict, allSnps, matchedSnps):
+    # counts the snps of each ld clump like filterTXT and filterVCF, from the snps the filtered input matched
+    clumpNumDict = {}
+    for snp in matchedSnps:
+        for pop in allClumpsObjDict.keys():
+            if snp in allClumpsObjDict[pop]:
+                clumpNum = allClumpsObjDict[pop][snp]['clumpNum']
+                clumpNumDict[str((pop, clumpNum))] = clumpNumDict.get(str((pop, clumpNum)), 0) + 1
+
+    # here we add in the other snps that are not in the sample but are in the study
+    toAdd = allSnps.difference(set(matchedSnps))
+    for snp in toAdd:
+        for pop in allClumpsObjDict.keys():
+            if snp in allClumpsObjDict[pop]:
+                clumpNum = allClumpsObjDict[pop][snp]['clumpNum']
+                clumpNumDict[str((pop,clumpNum))] = clumpNumDict.get(str((pop, clumpNum)), 0) + 1
+
+    return clumpNumDict
+
+
+# matchedSnps, if given, is filled with the snp of each line written to the filtered file
+def filterTXT(allClumpsObjDict, allSnps, inputFiles, filteredFilePath, useGWASupload, matchedSnps=None):
     filteredOutput = open(filteredFilePath, 'w')
     usedSnps = set()
     # Create a boolean to keep track of whether any variants in the input VCF match the user-specified filters
@@ -414,6 +450,8 @@ def filterTXT(allClumpsObjDict, allSnps, inputFiles, filteredFilePath, useGWASup
 
             if (snp in allSnps) or useGWASupload:
                 usedSnps.add(snp)
+                if matchedSnps is not None:
+                    matchedSnps.append(snp)
                 # We use the clumpNumDict later in the parse_files functions to determine which variants are in an LD clump by themselves
                 # if the snp is part of an ld clump that has already been noted, increase the count of the ld clump this snp is in
                 for pop in allClumpsObjDict.keys():
@@ -485,11 +523,8 @@ def build_snp_lookup_index(allSnps, tableObjDict):
     print(f"[LOG] Built index with {len(rsid_index)} rsIDs and {len(pos_index)} positions")
     return rsid_index, pos_index
 
-def filterVCF(tableObjDict, allClumpsObjDict, allSnps, inputFiles, filteredFilePath, useGWASupload, isBCF=False):
-    usedSnps = set()
-    # create a set to keep track of which ld clump numbers are assigned to only a single snp
-    clumpNumDict = {}
-    
+# matchedSnps, if given, is filled with the snp matched by each record written to the filtered file
+def filterVCF(tableObjDict, allClumpsObjDict, allSnps, inputFiles, filteredFilePath, useGWASupload, isBCF=False, num_processes=None, matchedSnps=None):
     print(f"[LOG] filterVCF: Processing {len(inputFiles)} files")
     print(f"[LOG] filterVCF: isBCF={isBCF}, useGWASupload={useGWASupload}")
     print(f"[LOG] filterVCF: Output path: {filteredFilePath}")
@@ -507,153 +542,275 @@ def filterVCF(tableObjDict, allClumpsObjDict, allSnps, inputFiles, filteredFileP
             print(f"[LOG] filterVCF: PERFORMANCE OPTIMIZATION - Will query {len(regions_list)} specific regions instead of scanning entire BCF")
         else:
             print(f"[LOG] filterVCF: No regions extracted, falling back to full BCF scan")
+
+    # bgzipped VCFs with a tabix or CSI index are read only at the blocks that hold the regions of the SNPs
+    indexPaths = {}
+    if not isBCF and len(allSnps) > 0:
+        indexPaths = {aFile: tr.findIndexPath(aFile) for aFile in inputFiles}
+        if any(indexPaths.values()):
+            unplacedSnps = []
+            regions_list = extract_genomic_regions_from_gwas(tableObjDict, allSnps, unplacedSnps)
+            if unplacedSnps or tr.parseRegions(regions_list) is None:
+                print(f"[LOG] filterVCF: {len(unplacedSnps)} SNPs have no usable position, falling back to full VCF scan")
+                indexPaths = {}
     
-    with open(filteredFilePath, 'w') as w:
-        # Create a boolean to check whether the input VCF is empty
-        fileEmpty = True
-
-        # Create a boolean to keep track of whether any variants in the input VCF match the user-specified filters
-        inputInFilters = False
-        firstFile = True
-
-        for aFile in inputFiles:
-            print(f"[LOG] filterVCF: Processing input file: {aFile}")
-            # open the input file path for opening
-            if isBCF:
-                if regions_list:
-                    print(f"[LOG] filterVCF: Opening BCF file with targeted region queries")
-                    inputVCF = open_bcf_with_region_queries(aFile, regions_list)
-                else:
-                    print(f"[LOG] filterVCF: Opening BCF file with bcftools (full scan)")
-                    inputVCF = open_bcf_with_bcftools(aFile)
-            else:
-                print(f"[LOG] filterVCF: Opening VCF file normally")
-                inputVCF = openFileForParsing(aFile)
+    # the data every file is filtered with, shared with the worker processes
+    filterData = {
+        'tableObjDict': tableObjDict,
+        'allClumpsObjDict': allClumpsObjDict,
+        'allSnps': allSnps,
+        'rsid_index': rsid_index,
+        'pos_index': pos_index,
+        'useGWASupload': useGWASupload,
+        'isBCF': isBCF,
+        'regions_list': regions_list,
+        'indexPaths': indexPaths
+    }
+
+    # each file is filtered into its own shard, which are then merged in the order of the input files
+    # only the first file's header is kept
+    if len(inputFiles) == 1:
+        shardPaths = [filteredFilePath]
+    else:
+        shardPaths = ["{0}.shard{1}".format(filteredFilePath, i) for i in range(len(inputFiles))]
+    fileJobs = [(aFile, shardPath, i == 0) for i, (aFile, shardPath) in enumerate(zip(inputFiles, shardPaths))]
 
-            try:
-                allPosInInput = set()
-                line_count = 0
-                variant_count = 0
-                matched_count = 0
+    if num_processes is not None and num_processes != "":
+        num_processes = int(num_processes)
+    else:
+        num_processes = None
+    try:
+        if len(inputFiles) == 1 or num_processes == 0:
+            initializeFilterWorker(filterData)
+            fileResults = [filterVCFFile(fileJob) for fileJob in fileJobs]
+        else:
+            num_processes = min(num_processes or os.cpu_count() or 1, len(inputFiles))
+            print(f"[LOG] filterVCF: Filtering {len(inputFiles)} files with {num_processes} processes")
+            with Pool(processes=num_processes, initializer=initializeFilterWorker, initargs=(filterData,)) as pool:
+                fileResults = pool.map(filterVCFFile, fileJobs)
+
+        for result in fileResults:
+            if 'error' in result:
+                raise SystemExit(result['error'])
+
+        if len(inputFiles) > 1:
+            with open(filteredFilePath, 'w') as w:
+                for shardPath in shardPaths:
+                    with open(shardPath, 'r') as shard:
+                        shutil.copyfileobj(shard, w)
+    finally:
+        if len(inputFiles) > 1:
+            for shardPath in shardPaths:
+                if os.path.exists(shardPath):
+                    os.remove(shardPath)
+
+    # merge the results of the files in the order they were given
+    usedSnps = set()
+    # create a set to keep track of which ld clump numbers are assigned to only a single snp
+    clumpNumDict = {}
+    for result in fileResults:
+        usedSnps.update(result['usedSnps'])
+        if matchedSnps is not None:
+            matchedSnps.extend(result['matchedSnps'])
+        for clumpKey, count in result['clumpNumDict'].items():
+            clumpNumDict[clumpKey] = clumpNumDict.get(clumpKey, 0) + count
+
+    # Create a boolean to check whether the input VCF is empty
+    fileEmpty = all(result['fileEmpty'] for result in fileResults)
+    # Create a boolean to keep track of whether any variants in the input VCF match the user-specified filters
+    inputInFilters = any(result['inputInFilters'] for result in fileResults)
+
+    if fileEmpty:
+        raise SystemExit("The VCF file is either empty or formatted incorrectly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position")
+
+    # send error message if input not in filters
+    print(f"[LOG] filterVCF: Final summary:")
+    print(f"[LOG]   Total unique SNPs used: {len(usedSnps)}")
+    print(f"[LOG]   Input matched filters: {inputInFilters}")
+
+    if not inputInFilters:
+        print(f"[LOG] filterVCF: No variants matched! Diagnostic info:")
+        print(f"[LOG]   - Expected SNPs available: {len(allSnps)}")
+        print(f"[LOG]   - Association keys available: {len(tableObjDict.get('associations', {}))}")
+        print(f"[LOG]   - Using GWAS upload: {useGWASupload}")
+        if not useGWASupload and len(allSnps) == 0:
+            raise SystemExit("ERROR: No SNPs available for filtering. This likely means the required data files (associations, study SNPs) are missing or empty.")
+        else:
+            raise SystemExit("WARNING: None of the variants available in the input file match the variants given by the specified filters. Check your input file and your filters and try again.")
+
+    # here we add in the other snps that are not in the sample but are in the study
+    toAdd = allSnps.difference(usedSnps)
+    for snp in toAdd:
+        for pop in allClumpsObjDict.keys():
+            if snp in allClumpsObjDict[pop]:
+                clumpNum = allClumpsObjDict[pop][snp]['clumpNum']
+                clumpNumDict[str((pop,clumpNum))] = clumpNumDict.get(str((pop, clumpNum)), 0) + 1
+
+    return clumpNumDict
+
+
+def initializeFilterWorker(data):
+    # with the fork start method, the filter data is inherited by the workers instead of being pickled
+    global filterData
+    filterData = data
+
+
+def filterVCFFile(fileJob):
+    """
+    Filters one input file into shardPath, writing the header lines if writeHeader is True.
+
+    Returns:
+        dict: the usedSnps, matchedSnps (in record order), clumpNumDict counts, fileEmpty, and inputInFilters of the file, or
+              {'error': message} if the file couldn't be filtered
+    """
+    aFile, shardPath, writeHeader = fileJob
+    try:
+        return filterVCFLines(aFile, shardPath, writeHeader)
+    except SystemExit as e:
+        # a SystemExit would stop a worker process without reporting back to the pool
+        return {'error': e.code}
+
+
+def filterVCFLines(aFile, shardPath, writeHeader):
+    tableObjDict = filterData['tableObjDict']
+    allClumpsObjDict = filterData['allClumpsObjDict']
+    allSnps = filterData['allSnps']
+    rsid_index = filterData['rsid_index']
+    pos_index = filterData['pos_index']
+    useGWASupload = filterData['useGWASupload']
+    isBCF = filterData['isBCF']
+    regions_list = filterData['regions_list']
+    indexPaths = filterData['indexPaths']
+
+    usedSnps = set()
+    matchedSnps = []
+    clumpNumDict = {}
+    fileEmpty = True
+    inputInFilters = False
+
+    with open(shardPath, 'w') as w:
+        print(f"[LOG] filterVCF: Processing input file: {aFile}")
+        # open the input file path for opening
+        if isBCF:
+            if regions_list:
+                print(f"[LOG] filterVCF: Opening BCF file with targeted region queries")
+                inputVCF = open_bcf_with_region_queries(aFile, regions_list)
+            else:
+                print(f"[LOG] filterVCF: Opening BCF file with bcftools (full scan)")
+                inputVCF = open_bcf_with_bcftools(aFile)
+        elif indexPaths.get(aFile):
+            print(f"[LOG] filterVCF: Opening VCF file with targeted region queries through {indexPaths[aFile]}")
+            inputVCF = tr.openRegions(aFile, indexPaths[aFile], regions_list)
+        else:
+            print(f"[LOG] filterVCF: Opening VCF file normally")
+            inputVCF = openFileForParsing(aFile)
+
+        try:
+            allPosInInput = set()
+            line_count = 0
+            variant_count = 0
+            matched_count = 0
+            
+            for line in inputVCF:
+                line_count += 1
+                if line_count <= 10:  # Log first few lines for debugging
+                    print(f"[LOG] filterVCF: Line {line_count}: {line[:100]}...")
                 
-                for line in inputVCF:
-                    line_count += 1
-                    if line_count <= 10:  # Log first few lines for debugging
-                        print(f"[LOG] filterVCF: Line {line_count}: {line[:100]}...")
+                # cut the line so that we don't use memory to tab split a huge file
+                shortLine = line[0:500]
+                if shortLine[0] == '#':
+                    if writeHeader:
+                        w.write(line)
+                else:
+                    line = line.strip()
+                    cols = shortLine.split('	')
+                    variant_count += 1
+                    
+                    # get the rsid and chrompos
+                    rsID = cols[2]
+                    chromPos = str(cols[0]) + ':' + str(cols[1])
                     
-                    # cut the line so that we don't use memory to tab split a huge file
-                    shortLine = line[0:500]
-                    if shortLine[0] == '#':
-                        if firstFile:
-                            w.write(line)
+                    if variant_count <= 5:  # Log first few variants for debugging
+                        print(f"[LOG] filterVCF: Variant {variant_count}: rsID='{rsID}', chromPos='{chromPos}'")
+                    # ensure we don't have duplicate lines of SNPs in input file
+                    if chromPos in allPosInInput:
+                        raise SystemExit(f'Found multiple lines for position {chromPos}. Please consolidate into a single line in the input file and run again. This can be done with the following command:\n\tbcftools norm -Ov -m+any original.vcf > original-merged.vcf\nwhere original.vcf is your input file and original-merged.vcf is your new vcf file.')
                     else:
-                        line = line.strip()
-                        cols = shortLine.split('	')
-                        variant_count += 1
-                        
-                        # get the rsid and chrompos
-                        rsID = cols[2]
-                        chromPos = str(cols[0]) + ':' + str(cols[1])
-                        
-                        if variant_count <= 5:  # Log first few variants for debugging
-                            print(f"[LOG] filterVCF: Variant {variant_count}: rsID='{rsID}', chromPos='{chromPos}'")
-                        # ensure we don't have duplicate lines of SNPs in input file
-                        if chromPos in allPosInInput:
-                            raise SystemExit(f'Found multiple lines for position {chromPos}. Please consolidate into a single line in the input file and run again. This can be done with the following command:\n\tbcftools norm -Ov -m+any original.vcf > original-merged.vcf\nwhere original.vcf is your input file and original-merged.vcf is your new vcf file.')
-                        else:
-                            allPosInInput.add(chromPos)
-                        # a record exists, so the file was not empty
-                        fileEmpty = False
-                        
-                        # Use optimized index-based matching
-                        matched_snp = None
-                        
-                        if useGWASupload:
-                            # GWAS upload mode: Direct position matching
-                            if chromPos in pos_index:
-                                matched_snp = pos_index[chromPos]
-                            elif chromPos in allSnps:
-                                matched_snp = chromPos
-                        else:
-                            # Try rsID first (fastest)
-                            if rsID and rsID != '.' and rsID in rsid_index:
-                                matched_snp = rsid_index[rsID]
-                            # Fall back to position matching
-                            elif chromPos in pos_index:
-                                matched_snp = pos_index[chromPos]
-                            # Legacy: check if chromPos maps to rsID
-                            elif chromPos in tableObjDict.get('associations', {}):
-                                if isinstance(tableObjDict['associations'][chromPos], str):
-                                    rsID = tableObjDict['associations'][chromPos]
-                                    if rsID in rsid_index:
-                                        matched_snp = rsid_index[rsID]
-                        
-                        # check if the snp is in the filtered studies
-                        identifier_in_snps = matched_snp is not None
-                        chromPos_in_assoc = chromPos in tableObjDict.get('associations', {})
-                        
-                        if variant_count <= 5:  # Log matching details for first few variants
-                            print(f"[LOG] filterVCF: Matching check - identifier='{matched_snp}', identifier_in_snps={identifier_in_snps}, chromPos_in_assoc={chromPos_in_assoc}, useGWASupload={useGWASupload}")
-                        
-                        if identifier_in_snps:
-                            usedSnps.add(matched_snp)
-                            matched_count += 1
-                            if matched_count <= 5:
-                                print(f"[LOG] filterVCF: MATCH {matched_count}: rsID={rsID}, chromPos={chromPos}, matched_snp={matched_snp}")
-                            # increase count of the ld clump this snp is in
-                            # We use the clumpNumDict later in the parsing functions to determine which variants are not in LD with any of the other variants
-                            for pop in allClumpsObjDict.keys():
-                                if matched_snp in allClumpsObjDict[pop]:
-                                    clumpNum = allClumpsObjDict[pop][matched_snp]['clumpNum']
-                                    clumpNumDict[str((pop, clumpNum))] = clumpNumDict.get(str((pop, clumpNum)), 0) + 1
-
-                            # write the line to the filtered VCF
-                            w.write(line)
-                            w.write("\n")
-                            inputInFilters = True
-                print(f"[LOG] filterVCF: File {aFile} summary:")
-                print(f"[LOG]   Total lines processed: {line_count}")
-                print(f"[LOG]   Total variants found: {variant_count}")
-                print(f"[LOG]   Variants matched: {matched_count}")
-                
-                allPosInInput = set()
-
-            except ValueError as e:
-                print(f"[LOG] filterVCF: ValueError processing {aFile}: {str(e)}")
-                raise SystemExit("The VCF file is not formatted correctly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position.")
-            except Exception as e:
-                print(f"[LOG] filterVCF: Unexpected error processing {aFile}: {str(e)}")
-                raise
+                        allPosInInput.add(chromPos)
+                    # a record exists, so the file was not empty
+                    fileEmpty = False
+                    
+                    # Use optimized index-based matching
+                    matched_snp = None
+                    
+                    if useGWASupload:
+                        # GWAS upload mode: Direct position matching
+                        if chromPos in pos_index:
+                            matched_snp = pos_index[chromPos]
+                        elif chromPos in allSnps:
+                            matched_snp = chromPos
+                    else:
+                        # Try rsID first (fastest)
+                        if rsID and rsID != '.' and rsID in rsid_index:
+                            matched_snp = rsid_index[rsID]
+                        # Fall back to position matching
+                        elif chromPos in pos_index:
+                            matched_snp = pos_index[chromPos]
+                        # Legacy: check if chromPos maps to rsID
+                        elif chromPos in tableObjDict.get('associations', {}):
+                            if isinstance(tableObjDict['associations'][chromPos], str):
+                                rsID = tableObjDict['associations'][chromPos]
+                                if rsID in rsid_index:
+                                    matched_snp = rsid_index[rsID]
+                    
+                    # check if the snp is in the filtered studies
+                    identifier_in_snps = matched_snp is not None
+                    chromPos_in_assoc = chromPos in tableObjDict.get('associations', {})
+                    
+                    if variant_count <= 5:  # Log matching details for first few variants
+                        print(f"[LOG] filterVCF: Matching check - identifier='{matched_snp}', identifier_in_snps={identifier_in_snps}, chromPos_in_assoc={chromPos_in_assoc}, useGWASupload={useGWASupload}")
+                    
+                    if identifier_in_snps:
+                        usedSnps.add(matched_snp)
+                        matchedSnps.append(matched_snp)
+                        matched_count += 1
+                        if matched_count <= 5:
+                            print(f"[LOG] filterVCF: MATCH {matched_count}: rsID={rsID}, chromPos={chromPos}, matched_snp={matched_snp}")
+                        # increase count of the ld clump this snp is in
+                        # We use the clumpNumDict later in the parsing functions to determine which variants are not in LD with any of the other variants
+                        for pop in allClumpsObjDict.keys():
+                            if matched_snp in allClumpsObjDict[pop]:
+                                clumpNum = allClumpsObjDict[pop][matched_snp]['clumpNum']
+                                clumpNumDict[str((pop, clumpNum))] = clumpNumDict.get(str((pop, clumpNum)), 0) + 1
+
+                        # write the line to the filtered VCF
+                        w.write(line)
+                        w.write("\n")
+                        inputInFilters = True
+            # only the records in the regions were read, so the file isn't empty if it has a header
+            if indexPaths.get(aFile) and line_count > 0:
+                fileEmpty = False
+            print(f"[LOG] filterVCF: File {aFile} summary:")
+            print(f"[LOG]   Total lines processed: {line_count}")
+            print(f"[LOG]   Total variants found: {variant_count}")
+            print(f"[LOG]   Variants matched: {matched_count}")
             
-            firstFile = False
+            allPosInInput = set()
 
-        if fileEmpty:
-            raise SystemExit("The VCF file is either empty or formatted incorrectly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position")
+        except ValueError as e:
+            print(f"[LOG] filterVCF: ValueError processing {aFile}: {str(e)}")
+            raise SystemExit("The VCF file is not formatted correctly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position.")
+        except Exception as e:
+            print(f"[LOG] filterVCF: Unexpected error processing {aFile}: {str(e)}")
+            raise
 
-        # send error message if input not in filters
-        print(f"[LOG] filterVCF: Final summary:")
-        print(f"[LOG]   Total unique SNPs used: {len(usedSnps)}")
-        print(f"[LOG]   Input matched filters: {inputInFilters}")
-        
-        if not inputInFilters:
-            print(f"[LOG] filterVCF: No variants matched! Diagnostic info:")
-            print(f"[LOG]   - Expected SNPs available: {len(allSnps)}")
-            print(f"[LOG]   - Association keys available: {len(tableObjDict.get('associations', {}))}")
-            print(f"[LOG]   - Using GWAS upload: {useGWASupload}")
-            if not useGWASupload and len(allSnps) == 0:
-                raise SystemExit("ERROR: No SNPs available for filtering. This likely means the required data files (associations, study SNPs) are missing or empty.")
-            else:
-                raise SystemExit("WARNING: None of the variants available in the input file match the variants given by the specified filters. Check your input file and your filters and try again.")
-
-        # here we add in the other snps that are not in the sample but are in the study
-        toAdd = allSnps.difference(usedSnps)
-        for snp in toAdd:
-            for pop in allClumpsObjDict.keys():
-                if snp in allClumpsObjDict[pop]:
-                    clumpNum = allClumpsObjDict[pop][snp]['clumpNum']
-                    clumpNumDict[str((pop,clumpNum))] = clumpNumDict.get(str((pop, clumpNum)), 0) + 1
-
-    return clumpNumDict
+    return {
+        'usedSnps': usedSnps,
+        'matchedSnps': matchedSnps,
+        'clumpNumDict': clumpNumDict,
+        'fileEmpty': fileEmpty,
+        'inputInFilters': inputInFilters
+    }
 
 
 # checks if the file is a vaild zipped file and returns the extension of the file inside the zipped file
@@ -742,5 +899,6 @@ if __name__ == "__main__":
     if (argv[1]) == "zip":
         getZippedFileExtension(argv[2], argv[3], argv[4])
     else:
-        createFilteredFile(argv[1], argv[2], argv[3], argv[4], argv[5], argv[6], argv[7], argv[8], argv[9], argv[10], argv[11], argv[12], argv[13], argv[14], argv[15])
+        num_processes = argv[16] if len(argv) > 16 else None
+        createFilteredFile(argv[1], argv[2], argv[3], argv[4], argv[5], argv[6], argv[7], argv[8], argv[9], argv[10], argv[11], argv[12], argv[13], argv[14], argv[15], num_processes)
 
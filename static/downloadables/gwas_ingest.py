@@ -0,0 +1,333 @@
+import collections
+import json
+import os
+import sqlite3
+import types
+from multiprocessing import Pool
+
+# Streaming ingestion of uploaded GWAS summary statistics (used by connect_to_server.formatGWASAndRetrieveClumps).
+#
+# The file is read in chunks of GWAS_CHUNK_ROWS rows, and each row is split and converted to typed columns once.
+# Gzipped files can be parsed by several processes (PRS_GWAS_PARSE_PROCESSES, 1 by default) while the main process
+# decompresses the next chunks. The rows are staged in a SQLite database in .workingFiles instead of memory, where a
+# unique index finds duplicated associations. Once the whole file is staged, the associations, trait/study to SNPs,
+# and possible alleles files are written from the database one SNP (or trait/study) at a time, so the memory used
+# doesn't depend on the size of the file. The staging database is removed when the files are written.
+#
+# With the p-value prefilter (--prefilter), the rows above the p-value cutoff of the run are set aside before their
+# alleles are strand flipped and their positions converted, so the clumps, MAF, and possible alleles of positions no
+# study can use aren't fetched. A row is only left out if every risk allele of its position in its trait/study is
+# above the cutoff, and the number of positions left out of each trait/study is written to the associations file,
+# so step 2 still reports them in 'SNPs Excluded Due To Cutoffs'.
+
+GWAS_CHUNK_ROWS = 50000
+DEFAULT_PARSE_PROCESSES = 1
+JSON_WRITE_BATCH = 10000
+
+# one parsed row of the GWAS file
+GwasRow = collections.namedtuple('GwasRow', ['studyID', 'trait', 'rsID', 'chromPos', 'riskAllele', 'pValue', 'value',
+    'betaUnit', 'superPop', 'citation', 'reportedTrait', 'uniqueKey'])
+
+
+def getParseProcesses():
+    numProcesses = os.environ.get("PRS_GWAS_PARSE_PROCESSES", DEFAULT_PARSE_PROCESSES)
+    try:
+        numProcesses = int(numProcesses)
+    except ValueError:
+        raise SystemExit(f"ERROR: PRS_GWAS_PARSE_PROCESSES must be a number of processes, not '{numProcesses}'.")
+    return max(1, numProcesses)
+
+
+def parseGwasHeader(line, userGwasBeta):
+    # returns the index of each column of the GWAS file (-1 for optional columns that aren't in it)
+    headers = line.strip().lower().split("\t")
+    try:
+        columns = {
+            'studyID': headers.index("study id"),
+            'trait': headers.index("trait"),
+            'rsID': headers.index("rsid"),
+            'chrom': headers.index("chromosome"),
+            'pos': headers.index("position"),
+            'riskAllele': headers.index("risk allele"),
+            'value': headers.index("beta coefficient") if userGwasBeta else headers.index("odds ratio"),
+            'betaUnit': headers.index("beta units") if userGwasBeta else -1,
+            'pValue': headers.index("p-value"),
+            'superPop': headers.index("super population")
+        }
+    except ValueError:
+        raise SystemExit("ERROR: The GWAS file format is not correct. Please check your file to ensure the required columns are present in a tab separated format. Additionally, check your column names and ensure that there are no extra spaces in the names and that your spelling is correct.")
+
+    for column, header in (('citation', "citation"), ('reportedTrait', "reported trait"), ('pValueAnnotation', "p-value annotation"), ('betaAnnotation', "beta annotation")):
+        columns[column] = headers.index(header) if header in headers else -1
+    return columns
+
+
+def parseGwasLines(lines, columns, userGwasBeta):
+    # converts the lines of a chunk to GwasRows
+    valueType = "beta" if userGwasBeta else "OR"
+    rows = []
+    for line in lines:
+        line = line.split("\t")
+
+        def getOptional(column, default):
+            index = columns[column]
+            return line[index] if index != -1 and index < len(line) else default
+
+        # Format chromPos to match BCF format (with 'chr' prefix if missing)
+        chrom = line[columns['chrom']]
+        if not chrom.startswith('chr'):
+            chrom = 'chr' + chrom
+        pValueAnnotation = getOptional('pValueAnnotation', "NA")
+        betaAnnotation = getOptional('betaAnnotation', "NA")
+        rows.append(GwasRow(
+            studyID=line[columns['studyID']],
+            trait=line[columns['trait']],
+            rsID=line[columns['rsID']],
+            chromPos=":".join([chrom, line[columns['pos']]]),
+            riskAllele=line[columns['riskAllele']],
+            pValue=float(line[columns['pValue']]),
+            value=float(line[columns['value']]),
+            betaUnit=line[columns['betaUnit']] if userGwasBeta else 'NA',
+            superPop=line[columns['superPop']],
+            citation=getOptional('citation', ""),
+            reportedTrait=getOptional('reportedTrait', ""),
+            uniqueKey="|".join([pValueAnnotation, betaAnnotation, valueType])
+        ))
+    return rows
+
+
+def parseGwasChunk(args):
+    return parseGwasLines(*args)
+
+
+def readLineChunks(GWASfileOpen, chunkRows):
+    # yields lists of up to chunkRows stripped, non-empty lines
+    lines = []
+    for line in GWASfileOpen:
+        line = line.strip()
+        if len(line) == 0: # skip lines that don't have content
+            continue
+        lines.append(line)
+        if len(lines) >= chunkRows:
+            yield lines
+            lines = []
+    if lines:
+        yield lines
+
+
+def readGwasChunks(GWASfileOpen, userGwasBeta, numProcesses=1, chunkRows=GWAS_CHUNK_ROWS):
+    """
+    Reads the GWAS file in chunks, closing it when it has been read.
+
+    Yields:
+        list: the GwasRows of each chunk of up to chunkRows rows, in the order of the file
+    """
+    try:
+        lineChunks = readLineChunks(GWASfileOpen, chunkRows)
+        headerChunk = next(lineChunks, [])
+        if not headerChunk:
+            return
+        columns = parseGwasHeader(headerChunk[0], userGwasBeta)
+        if len(headerChunk) > 1:
+            yield parseGwasLines(headerChunk[1:], columns, userGwasBeta)
+
+        if numProcesses > 1:
+            print(f"[LOG] Parsing the GWAS file with {numProcesses} processes")
+            with Pool(processes=numProcesses) as pool:
+                # imap keeps the chunks in order and only reads ahead of the chunks being parsed
+                for rows in pool.imap(parseGwasChunk, ((lines, columns, userGwasBeta) for lines in lineChunks)):
+                    yield rows
+        else:
+            for lines in lineChunks:
+                yield parseGwasLines(lines, columns, userGwasBeta)
+    finally:
+        GWASfileOpen.close()
+
+
+class GwasStaging:
+    """
+    The associations of a GWAS file, staged in a SQLite database while the file is read.
+    """
+
+    def __init__(self, stagingPath):
+        self.stagingPath = stagingPath
+        # the staging database of an interrupted run is started over
+        if os.path.exists(stagingPath):
+            os.remove(stagingPath)
+        self.connection = sqlite3.connect(stagingPath)
+        with self.connection:
+            # positions are numbered in the order they are first found in the file
+            self.connection.execute("CREATE TABLE positions (id INTEGER PRIMARY KEY, chromPos TEXT NOT NULL UNIQUE, rsID TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE associations (chromPos TEXT NOT NULL, trait TEXT NOT NULL, studyID TEXT NOT NULL, uniqueKey TEXT NOT NULL, riskAllele TEXT NOT NULL, studyKey INTEGER NOT NULL, pValue REAL NOT NULL, value REAL NOT NULL, betaUnit TEXT NOT NULL)")
+            self.connection.execute("CREATE UNIQUE INDEX associationsByKey ON associations (chromPos, trait, studyID, uniqueKey, riskAllele)")
+            self.connection.execute("CREATE INDEX associationsByStudyKey ON associations (studyKey)")
+            # positions converted to the reference genome of the samples, in the order they are first converted
+            self.connection.execute("CREATE TABLE convertedPositions (id INTEGER PRIMARY KEY, newPos TEXT NOT NULL UNIQUE, chromPos TEXT NOT NULL)")
+            # associations left out by the p-value prefilter, until the file is staged
+            self.connection.execute("CREATE TABLE droppedAssociations (chromPos TEXT NOT NULL, rsID TEXT NOT NULL, trait TEXT NOT NULL, studyID TEXT NOT NULL, uniqueKey TEXT NOT NULL, riskAllele TEXT NOT NULL, studyKey INTEGER NOT NULL, pValue REAL NOT NULL, value REAL NOT NULL, betaUnit TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX droppedAssociationsByKey ON droppedAssociations (chromPos, trait, studyID, uniqueKey)")
+
+    def close(self, remove=True):
+        self.connection.close()
+        if remove and os.path.exists(self.stagingPath):
+            os.remove(self.stagingPath)
+
+    def addAssociations(self, rows):
+        """
+        Stages a chunk of associations, given as (GwasRow, riskAllele, studyKey) with the strand flipped risk allele
+        and the number of the trait/study combination of the row. Duplicated associations end the program.
+        """
+        try:
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO positions (chromPos, rsID) VALUES (?, ?)",
+                    ((row.chromPos, row.rsID) for row, _, _ in rows))
+                self.connection.executemany("INSERT INTO associations (chromPos, trait, studyID, uniqueKey, riskAllele, studyKey, pValue, value, betaUnit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((row.chromPos, row.trait, row.studyID, row.uniqueKey, riskAllele, studyKey, row.pValue, row.value, row.betaUnit) for row, riskAllele, studyKey in rows))
+        except sqlite3.IntegrityError:
+            row = self.findDuplicate(rows)
+            # if the snp is duplicated, notify the user and exit
+            raise SystemExit("ERROR: The GWAS file contains at least one duplicated snp for the following combination. {}, {}, {}, {}, . \n Please ensure that there is only one snp for each combination.".format(row.chromPos, row.trait, row.studyID, row.uniqueKey))
+
+    def findDuplicate(self, rows):
+        # returns the first row of the chunk (which wasn't staged) that duplicates another association
+        chunkKeys = set()
+        for row, riskAllele, _ in rows:
+            key = (row.chromPos, row.trait, row.studyID, row.uniqueKey, riskAllele)
+            if key in chunkKeys or self.connection.execute("SELECT 1 FROM associations WHERE chromPos = ? AND trait = ? AND studyID = ? AND uniqueKey = ? AND riskAllele = ?", key).fetchone():
+                return row
+            chunkKeys.add(key)
+        return rows[0][0]
+
+    def addDroppedAssociations(self, rows):
+        # stages the (GwasRow, studyKey) of a chunk that are above the p-value cutoff of the prefilter
+        with self.connection:
+            self.connection.executemany("INSERT INTO droppedAssociations (chromPos, rsID, trait, studyID, uniqueKey, riskAllele, studyKey, pValue, value, betaUnit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((row.chromPos, row.rsID, row.trait, row.studyID, row.uniqueKey, row.riskAllele, studyKey, row.pValue, row.value, row.betaUnit) for row, studyKey in rows))
+
+    def takePartiallyDroppedAssociations(self):
+        """
+        Removes the dropped associations of a position and trait/study that also has a staged association (another
+        risk allele below the cutoff) and returns them as (GwasRow, studyKey), so they can be staged after all.
+        """
+        partialCondition = ("EXISTS (SELECT 1 FROM associations a WHERE a.chromPos = d.chromPos AND a.trait = d.trait "
+            "AND a.studyID = d.studyID AND a.uniqueKey = d.uniqueKey)")
+        rows = []
+        for chromPos, rsID, trait, studyID, uniqueKey, riskAllele, studyKey, pValue, value, betaUnit in self.connection.execute(
+                "SELECT chromPos, rsID, trait, studyID, uniqueKey, riskAllele, studyKey, pValue, value, betaUnit FROM droppedAssociations d WHERE " + partialCondition + " ORDER BY rowid"):
+            rows.append((GwasRow(studyID=studyID, trait=trait, rsID=rsID, chromPos=chromPos, riskAllele=riskAllele, pValue=pValue,
+                value=value, betaUnit=betaUnit, superPop="", citation="", reportedTrait="", uniqueKey=uniqueKey), studyKey))
+        with self.connection:
+            self.connection.execute("DELETE FROM droppedAssociations WHERE rowid IN (SELECT rowid FROM droppedAssociations d WHERE " + partialCondition + ")")
+        return rows
+
+    def getDroppedSnpCounts(self):
+        # {studyKey: number of positions dropped by the prefilter}
+        return dict(self.connection.execute("SELECT studyKey, COUNT(DISTINCT chromPos) FROM droppedAssociations GROUP BY studyKey"))
+
+    def getStudyKeys(self):
+        # the trait/study combinations that have staged associations
+        return set(studyKey for studyKey, in self.connection.execute("SELECT DISTINCT studyKey FROM associations"))
+
+    def addConvertedPositions(self, convertedPositions):
+        # stages {chromPos: newPos}. A position converted more than once keeps the first position converted to it
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO convertedPositions (newPos, chromPos) VALUES (?, ?)",
+                ((newPos, chromPos) for chromPos, newPos in convertedPositions.items()))
+
+    def getNumPositions(self):
+        return self.connection.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+
+    def getConvertedPositions(self):
+        return [newPos for newPos, in self.connection.execute("SELECT newPos FROM convertedPositions ORDER BY id")]
+
+    def iterPositions(self):
+        # the positions of the file and the converted positions that aren't positions of the file
+        for chromPos, in self.connection.execute("SELECT chromPos FROM positions ORDER BY id"):
+            yield chromPos
+        for newPos, in self.connection.execute("SELECT newPos FROM convertedPositions WHERE newPos NOT IN (SELECT chromPos FROM positions) ORDER BY id"):
+            yield newPos
+
+    def iterAssociations(self, userGwasBeta):
+        """
+        Yields (chromPos, association) for each position, with the association in the format of the associations file,
+        then (newPos, chromPos) for each converted position.
+        """
+        query = ("SELECT p.chromPos, p.rsID, a.trait, a.studyID, a.uniqueKey, a.riskAllele, a.pValue, a.value, a.betaUnit "
+            "FROM positions p JOIN associations a ON a.chromPos = p.chromPos ORDER BY p.id, a.rowid")
+        association = None
+        for chromPos, rsID, trait, studyID, uniqueKey, riskAllele, pValue, value, betaUnit in self.connection.execute(query):
+            if association is None or association['pos'] != chromPos:
+                if association is not None:
+                    yield association['pos'], association
+                association = {
+                    "pos": chromPos,
+                    "original_rsid": rsID,  # Store original rsID as metadata
+                    "traits": {}
+                }
+            alleleData = {
+                "pValue": pValue,
+                "sex": "NA",
+                "ogValueTypes": 'beta' if userGwasBeta else 'OR'
+            }
+            if userGwasBeta:
+                alleleData['betaValue'] = value
+            else:
+                alleleData['oddsRatio'] = value
+            alleleData['betaUnit'] = betaUnit
+            association["traits"].setdefault(trait, {}).setdefault(studyID, {}).setdefault(uniqueKey, {})[riskAllele] = alleleData
+        if association is not None:
+            yield association['pos'], association
+
+        # a converted position that is also a position of the file replaces its association when the file is loaded
+        for newPos, chromPos in self.connection.execute("SELECT newPos, chromPos FROM convertedPositions ORDER BY id"):
+            yield newPos, chromPos
+
+    def iterStudySnps(self, studyKey):
+        # the positions of a trait/study combination, in the order of the file
+        for chromPos, in self.connection.execute("SELECT chromPos FROM associations WHERE studyKey = ? ORDER BY rowid", (studyKey,)):
+            yield chromPos
+
+
+def writeJsonItems(f, items):
+    # writes the (key, value) items as the members of a JSON object, encoding up to JSON_WRITE_BATCH items at a time
+    f.write("{")
+    separator = ""
+    batch = []
+
+    def writeBatch():
+        # keys are only repeated when a converted position is also a position of the file, and are then kept
+        batchDict = dict(batch)
+        if len(batchDict) == len(batch):
+            encoded = json.dumps(batchDict)[1:-1]
+        else:
+            encoded = ", ".join(json.dumps(key) + ": " + json.dumps(value) for key, value in batch)
+        f.write(separator + encoded)
+        batch.clear()
+
+    for key, value in items:
+        if isinstance(value, types.GeneratorType):
+            # generators are written as lists, a batch of elements at a time
+            if batch:
+                writeBatch()
+                separator = ", "
+            f.write(separator + json.dumps(key) + ": [")
+            elementSeparator = ""
+            elements = []
+            for element in value:
+                elements.append(element)
+                if len(elements) >= JSON_WRITE_BATCH:
+                    f.write(elementSeparator + json.dumps(elements)[1:-1])
+                    elementSeparator = ", "
+                    elements = []
+            if elements:
+                f.write(elementSeparator + json.dumps(elements)[1:-1])
+            f.write("]")
+            separator = ", "
+            continue
+        batch.append((key, value))
+        if len(batch) >= JSON_WRITE_BATCH:
+            writeBatch()
+            separator = ", "
+    if batch:
+        writeBatch()
+    f.write("}")
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+import requests
+
+# Cache of the JSON responses of the server (getUrlWithParams and postUrlWithBody in connect_to_server.py).
+#
+# Every response is stored as a zlib-compressed blob in a single SQLite database in .workingFiles (or at
+# PRS_CACHE_PATH), keyed by the md5 of the request (method, url, and body), with its size, the time it was stored
+# and last used, and the ETag and Last-Modified headers the server sent with it. The database is kept under a byte
+# budget (PRS_CACHE_MAX_MB, 512MB by default) by evicting the least recently used responses, and the number of
+# entries and bytes of each method are kept in a totals table so the stats don't need a pass over the cache.
+#
+# A response older than its maximum age is revalidated with If-None-Match/If-Modified-Since when the server gave
+# validators for it, and is still used (with a warning) when the server can't be reached.
+#
+# The database also holds the validators of the downloaded working files (see working_download.py), stamped with
+# the modification time and size of the file they were sent with.
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles", "http_cache.sqlite")
+DEFAULT_MAX_MB = 512
+# the directories of json files the cache used to be kept in
+LEGACY_CACHE_DIRS = ("get_cache", "post_cache")
+
+# the cache opened by this process, shared by its threads (processes started with fork open their own)
+openCache = None
+cacheLock = threading.Lock()
+
+
+class ResponseCache:
+    """
+    A SQLite database of compressed JSON responses kept under maxBytes by least recently used eviction. The
+    connection is shared by the threads of the process, which use it one at a time (see lock).
+    """
+
+    def __init__(self, cachePath, maxBytes):
+        self.cachePath = cachePath
+        self.maxBytes = maxBytes
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(cachePath)), exist_ok=True)
+        self.connection = sqlite3.connect(cachePath, timeout=60, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, method TEXT NOT NULL, url TEXT NOT NULL, size INTEGER NOT NULL, stored REAL NOT NULL, lastAccess REAL NOT NULL, etag TEXT, lastModified TEXT, payload BLOB NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entriesByAccess ON entries (lastAccess)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS totals (method TEXT PRIMARY KEY, entries INTEGER NOT NULL, bytes INTEGER NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS downloads (path TEXT PRIMARY KEY, etag TEXT, lastModified TEXT, sourceMtime INTEGER NOT NULL, sourceSize INTEGER NOT NULL, checked REAL NOT NULL)")
+            row = self.connection.execute("SELECT value FROM info WHERE name = 'version'").fetchone()
+            if row is not None and row[0] != CACHE_VERSION:
+                self.connection.execute("DELETE FROM entries")
+                self.connection.execute("DELETE FROM totals")
+            self.connection.execute("INSERT OR REPLACE INTO info (name, value) VALUES ('version', ?)", (CACHE_VERSION,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, key):
+        """
+        Returns the cached response for key as a dict with 'payload', 'stored', 'etag', and 'lastModified', or None
+        if it isn't cached (or can't be read). Marks the response as used.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT payload, stored, etag, lastModified FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            payload = json.loads(zlib.decompress(row[0]).decode('utf-8'))
+        except (zlib.error, ValueError) as e:
+            print(f"[WARN] Cached response is corrupted, will fetch fresh: {e}")
+            self.remove(key)
+            return None
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE entries SET lastAccess = ? WHERE key = ?", (time.time(), key))
+        return {'payload': payload, 'stored': row[1], 'etag': row[2], 'lastModified': row[3]}
+
+    def put(self, key, method, url, payload, etag=None, lastModified=None):
+        # stores a response, replacing the one already stored for key, and evicts responses to stay in the budget
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+        if len(blob) > self.maxBytes:
+            print(f"[LOG] Not caching the response of {method} {url} ({len(blob) / (1024 * 1024):.2f} MB is more than the cache budget)")
+            self.remove(key)
+            return
+        with self.lock:
+            now = time.time()
+            with self.connection:
+                self.deleteEntry(key)
+                self.connection.execute("INSERT INTO entries (key, method, url, size, stored, lastAccess, etag, lastModified, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, method, url, len(blob), now, now, etag, lastModified, sqlite3.Binary(blob)))
+                self.addToTotals(method, 1, len(blob))
+                self.evict()
+
+    def refresh(self, key):
+        # the server confirmed the cached response is still current
+        with self.lock:
+            now = time.time()
+            with self.connection:
+                self.connection.execute("UPDATE entries SET stored = ?, lastAccess = ? WHERE key = ?", (now, now, key))
+
+    def remove(self, key):
+        with self.lock:
+            with self.connection:
+                self.deleteEntry(key)
+
+    def deleteEntry(self, key):
+        # must be called inside a transaction
+        row = self.connection.execute("SELECT method, size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.addToTotals(row[0], -1, -row[1])
+
+    def addToTotals(self, method, entries, size):
+        self.connection.execute("INSERT OR IGNORE INTO totals (method, entries, bytes) VALUES (?, 0, 0)", (method,))
+        self.connection.execute("UPDATE totals SET entries = entries + ?, bytes = bytes + ? WHERE method = ?", (entries, size, method))
+
+    def getTotalBytes(self):
+        row = self.connection.execute("SELECT SUM(bytes) FROM totals").fetchone()
+        return row[0] or 0
+
+    def evict(self):
+        # removes the least recently used responses until the cache is within its budget (inside a transaction)
+        excess = self.getTotalBytes() - self.maxBytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, method, size in self.connection.execute("SELECT key, method, size FROM entries ORDER BY lastAccess"):
+            evicted.append((key, method, size))
+            excess -= size
+            if excess <= 0:
+                break
+        for key, method, size in evicted:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.addToTotals(method, -1, -size)
+        print(f"[LOG] Evicted {len(evicted)} responses from the cache to stay under {self.maxBytes / (1024 * 1024):.0f} MB")
+
+    def getStats(self):
+        # returns {method: (entries, bytes)}
+        with self.lock:
+            return {method: (entries, size) for method, entries, size in self.connection.execute("SELECT method, entries, bytes FROM totals")}
+
+
+    def getDownload(self, path):
+        """
+        Returns the validators of the working file at path as a dict with 'etag', 'lastModified', and 'checked' (when
+        the server last confirmed the file is current), or None if they aren't known or the file changed since.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT etag, lastModified, sourceMtime, sourceSize, checked FROM downloads WHERE path = ?", (os.path.abspath(path),)).fetchone()
+            try:
+                sourceStat = os.stat(path)
+            except OSError:
+                return None
+            if row is None or row[2] != sourceStat.st_mtime_ns or row[3] != sourceStat.st_size:
+                return None
+            return {'etag': row[0], 'lastModified': row[1], 'checked': row[4]}
+
+    def putDownload(self, path, etag, lastModified):
+        # records the validators the server sent for the working file at path (which must already be written)
+        with self.lock:
+            sourceStat = os.stat(path)
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO downloads (path, etag, lastModified, sourceMtime, sourceSize, checked) VALUES (?, ?, ?, ?, ?, ?)",
+                    (os.path.abspath(path), etag, lastModified, sourceStat.st_mtime_ns, sourceStat.st_size, time.time()))
+
+
+def getMaxBytes():
+    maxMb = os.environ.get("PRS_CACHE_MAX_MB", DEFAULT_MAX_MB)
+    try:
+        return int(float(maxMb) * 1024 * 1024)
+    except ValueError:
+        raise SystemExit(f"ERROR: PRS_CACHE_MAX_MB must be a number of megabytes, not '{maxMb}'.")
+
+
+def getCache(cachePath=None):
+    # returns the cache of this process, opening it (and removing the old json file caches) the first time
+    global openCache
+    cachePath = cachePath or os.environ.get("PRS_CACHE_PATH", DEFAULT_CACHE_PATH)
+    with cacheLock:
+        if openCache is not None and openCache.pid == os.getpid():
+            if openCache.cachePath == cachePath:
+                return openCache
+            openCache.close()
+        openCache = ResponseCache(cachePath, getMaxBytes())
+        removeLegacyCaches(os.path.dirname(os.path.abspath(cachePath)))
+        return openCache
+
+
+def removeLegacyCaches(workingFilesPath):
+    for cacheDir in LEGACY_CACHE_DIRS:
+        legacyPath = os.path.join(workingFilesPath, cacheDir)
+        if os.path.isdir(legacyPath):
+            shutil.rmtree(legacyPath, ignore_errors=True)
+            print(f"[LOG] Removed the old response cache {legacyPath}")
+
+
+def makeKey(method, url, body=None):
+    keyContent = f"{method}|{url}"
+    if body is not None:
+        keyContent += "|" + json.dumps(body, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(keyContent.encode('utf-8')).hexdigest()
+
+
+def logCacheStats():
+    cache = getCache()
+    stats = cache.getStats()
+    postEntries = stats.get('POST', (0, 0))[0]
+    getEntries = stats.get('GET', (0, 0))[0]
+    totalMb = sum(size for _, size in stats.values()) / (1024 * 1024)
+    print(f"[LOG] Cache stats - POST: {postEntries} responses, GET: {getEntries} responses, Total: {totalMb:.2f} MB of {cache.maxBytes / (1024 * 1024):.0f} MB")
+
+
+def fetchJson(method, url, body, send, maxAgeHours=24, useCache=True):
+    """
+    Returns the JSON response of a request, from the cache if it was stored less than maxAgeHours ago.
+
+    Args:
+        method: 'GET' or 'POST'
+        url: the full url of the request (with its query string)
+        body: the body of a POST request, None for GET requests
+        send: function that takes a dict of extra headers, sends the request, and returns the response. It is
+              expected to check the status of the response, except for 304 (Not Modified)
+        maxAgeHours: how long a cached response is used without asking the server
+        useCache: if False, the cache isn't read or written
+    """
+    if not useCache:
+        return readJson(send({}))
+
+    cache = getCache()
+    key = makeKey(method, url, body)
+    entry = cache.get(key)
+    headers = {}
+    if entry is not None:
+        ageHours = (time.time() - entry['stored']) / 3600
+        if ageHours < maxAgeHours:
+            print(f"[LOG] Using cached response for {method} {url} (age: {ageHours:.2f}h)")
+            return entry['payload']
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['lastModified']:
+            headers['If-Modified-Since'] = entry['lastModified']
+
+    try:
+        response = send(headers)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        if entry is None:
+            raise
+        print(f"[WARN] Could not reach the server, using the cached response for {method} {url} (age: {ageHours:.2f}h): {e}")
+        return entry['payload']
+
+    if response.status_code == 304 and entry is not None:
+        print(f"[LOG] Cached response for {method} {url} is still current")
+        cache.refresh(key)
+        return entry['payload']
+
+    result = readJson(response)
+    try:
+        cache.put(key, method, url, result, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    except sqlite3.Error as e:
+        print(f"[WARN] Failed to cache response: {e}")
+    return result
+
+
+def readJson(response):
+    if response.status_code == 204:
+        return {}
+    return response.json()
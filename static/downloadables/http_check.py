@@ -0,0 +1,231 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+import http_cache as hc
+import download_manager as dm
+import working_download as wd
+
+# Checks the response cache (http_cache.py) and the working file downloads (working_download.py) against a local
+# stand-in for the server, so the revalidation, patch, and fallback paths can be tested without the PRSKB server:
+#   python http_check.py
+#
+# The stand-in is an http.server on 127.0.0.1 that serves the resources it is given with an ETag and a Repr-Digest,
+# answers If-None-Match with 304 when the resource hasn't changed, and with a 226 merge patch when it has a patch
+# from the version in If-None-Match. Each check uses its own cache database in a temporary folder, and the run
+# stops with an error at the first check that fails.
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # serves server.resources ({path: {'body': bytes, 'etag': str, 'patches': {base etag: patch}, 'deltaBase'}})
+    # and records each request in server.received. deltaBase, if set, is sent as the Delta-Base of every patch
+
+    def do_GET(self):
+        self.server.received.append((self.path, dict(self.headers)))
+        resource = self.server.resources.get(self.path.split('?')[0])
+        if resource is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == resource['etag']:
+            self.send_response(304)
+            self.send_header('ETag', resource['etag'])
+            self.end_headers()
+        elif self.headers.get('A-IM') == wd.PATCH_FORMAT and self.headers.get('If-None-Match') in resource['patches']:
+            baseEtag = self.headers['If-None-Match']
+            patch = json.dumps(resource['patches'][baseEtag]).encode('utf-8')
+            self.sendBody(226, patch, {'ETag': resource['etag'], 'IM': wd.PATCH_FORMAT, 'Delta-Base': resource['deltaBase'] or baseEtag})
+        else:
+            digest = base64.b64encode(hashlib.sha256(resource['body']).digest()).decode('ascii')
+            self.sendBody(200, resource['body'], {'ETag': resource['etag'], 'Repr-Digest': f"sha-256=:{digest}:"})
+
+    def sendBody(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def startStubServer():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.resources = {}
+    server.received = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stopStubServer(server):
+    server.shutdown()
+    server.server_close()
+
+
+def getUrl(server, path):
+    return "http://127.0.0.1:{0}{1}".format(server.server_address[1], path)
+
+
+def setResource(server, path, data, etag, patches=None, deltaBase=None):
+    server.resources[path] = {'body': json.dumps(data).encode('utf-8'), 'etag': etag, 'patches': patches or {}, 'deltaBase': deltaBase}
+
+
+def expect(condition, message):
+    if not condition:
+        raise SystemExit(f"ERROR: {message}")
+
+
+def useNewCache(folder, name, maxMb=hc.DEFAULT_MAX_MB):
+    # points the cache at a new database in folder (getCache opens it on its next call)
+    os.environ["PRS_CACHE_PATH"] = os.path.join(folder, name + ".sqlite")
+    os.environ["PRS_CACHE_MAX_MB"] = str(maxMb)
+
+
+def fetch(url, maxAgeHours=24):
+    # sends a GET through the cache the way connect_to_server.getUrlWithParams does
+    def send(headers):
+        response = dm.getSession().get(url=url, headers=headers)
+        response.close()
+        assert (response or response.status_code == 304), "Error connecting to the server: {0} - {1}".format(response.status_code, response.reason)
+        return response
+    return hc.fetchJson('GET', url, None, send, maxAgeHours)
+
+
+def checkRevalidation(folder):
+    # a fresh response is used without a request, a stale one is revalidated and the 304 keeps the cached copy
+    server = startStubServer()
+    try:
+        useNewCache(folder, "revalidation")
+        url = getUrl(server, "/studies")
+        setResource(server, "/studies", {'studies': [1, 2]}, '"v1"')
+        expect(fetch(url) == {'studies': [1, 2]}, "The first request didn't return the server's response")
+        expect(fetch(url) == {'studies': [1, 2]} and len(server.received) == 1, "A fresh cached response was requested again")
+
+        key = hc.makeKey('GET', url)
+        storedBefore = hc.getCache().get(key)['stored']
+        expect(fetch(url, maxAgeHours=0) == {'studies': [1, 2]}, "The revalidated response changed")
+        expect(len(server.received) == 2 and server.received[1][1].get('If-None-Match') == '"v1"', "The stale response wasn't revalidated with its ETag")
+        expect(hc.getCache().get(key)['stored'] > storedBefore, "The 304 didn't refresh the cached response")
+
+        setResource(server, "/studies", {'studies': [1, 2, 3]}, '"v2"')
+        expect(fetch(url, maxAgeHours=0) == {'studies': [1, 2, 3]}, "A changed response wasn't downloaded again")
+        expect(hc.getCache().get(key)['etag'] == '"v2"', "The new ETag wasn't stored")
+    finally:
+        stopStubServer(server)
+    print("[LOG] Checked: 304 revalidation")
+
+
+def checkOfflineFallback(folder):
+    # a stale response is used when the server can't be reached, and a response that was never cached fails
+    server = startStubServer()
+    useNewCache(folder, "offline")
+    url = getUrl(server, "/maf")
+    setResource(server, "/maf", {'rs1': 0.5}, '"v1"')
+    expect(fetch(url) == {'rs1': 0.5}, "The first request didn't return the server's response")
+    stopStubServer(server)
+
+    expect(fetch(url, maxAgeHours=0) == {'rs1': 0.5}, "The cached response wasn't used while the server was unreachable")
+    try:
+        fetch(getUrl(server, "/other"))
+    except requests.exceptions.ConnectionError:
+        pass
+    else:
+        raise SystemExit("ERROR: A request that was never cached didn't fail while the server was unreachable")
+    print("[LOG] Checked: offline fallback")
+
+
+def checkEviction(folder):
+    # the least recently used responses are evicted once the cache is over its budget
+    server = startStubServer()
+    try:
+        # random hex doesn't compress much, so each response is about 6KB in the cache
+        useNewCache(folder, "eviction", maxMb=0.015)
+        urls = {}
+        for name in ('a', 'b', 'c'):
+            urls[name] = getUrl(server, "/" + name)
+            setResource(server, "/" + name, {'data': os.urandom(6000).hex()}, '"' + name + '"')
+        fetch(urls['a'])
+        fetch(urls['b'])
+        # a is used again, so b is now the least recently used
+        fetch(urls['a'])
+        fetch(urls['c'])
+
+        cache = hc.getCache()
+        expect(cache.get(hc.makeKey('GET', urls['b'])) is None, "The least recently used response wasn't evicted")
+        expect(cache.get(hc.makeKey('GET', urls['a'])) is not None and cache.get(hc.makeKey('GET', urls['c'])) is not None, "A recently used response was evicted")
+        stats = cache.getStats()
+        expect(stats['GET'][0] == 2 and stats['GET'][1] <= cache.maxBytes, f"The cache totals don't match its entries: {stats}")
+    finally:
+        stopStubServer(server)
+    print("[LOG] Checked: LRU eviction")
+
+
+def readFile(path):
+    with open(path, 'r', encoding="utf-8") as f:
+        return json.load(f)
+
+
+def checkDownloads(folder):
+    # a working file is downloaded whole, confirmed current with a 304, patched with a 226, and downloaded whole
+    # again when the patch isn't from the local version
+    server = startStubServer()
+    try:
+        useNewCache(folder, "downloads")
+        url = getUrl(server, "/associations")
+        path = os.path.join(folder, "associations.txt")
+        version1 = {'rs1': {'beta': 1}, 'rs2': {'beta': 2}}
+        setResource(server, "/associations", version1, '"v1"')
+        expect(wd.downloadWorkingFile(path, url, {}) and readFile(path) == version1, "The first download didn't write the file")
+        expect('If-None-Match' not in server.received[-1][1], "The first download sent validators")
+
+        expect(not wd.downloadWorkingFile(path, url, {}), "A current file was downloaded again")
+        headers = server.received[-1][1]
+        expect(headers.get('If-None-Match') == '"v1"' and headers.get('A-IM') == wd.PATCH_FORMAT, "The refresh didn't send the ETag of the local file and ask for a patch")
+
+        # rs1 is removed, rs2 is changed, and rs3 is added
+        version2 = {'rs2': {'beta': 2, 'pValue': 0.01}, 'rs3': {'beta': 3}}
+        setResource(server, "/associations", version2, '"v2"', patches={'"v1"': {'rs1': None, 'rs2': {'pValue': 0.01}, 'rs3': {'beta': 3}}})
+        numReceived = len(server.received)
+        expect(wd.downloadWorkingFile(path, url, {}) and readFile(path) == version2, "The merge patch wasn't applied")
+        expect(len(server.received) == numReceived + 1, "The patched file was downloaded again")
+
+        # the server sends a patch from a version the client doesn't have
+        version3 = {'rs3': {'beta': 4}}
+        setResource(server, "/associations", version3, '"v3"', patches={'"v2"': {'rs2': None, 'rs3': {'beta': 4}}}, deltaBase='"v0"')
+        numReceived = len(server.received)
+        expect(wd.downloadWorkingFile(path, url, {}) and readFile(path) == version3, "The file wasn't downloaded whole after a patch from another version")
+        expect(len(server.received) == numReceived + 2 and 'If-None-Match' not in server.received[-1][1], "The whole file wasn't requested without validators")
+        expect(hc.getCache().getDownload(path)['etag'] == '"v3"', "The ETag of the downloaded file wasn't recorded")
+    finally:
+        stopStubServer(server)
+    print("[LOG] Checked: working file 304, 226 merge patch, and Delta-Base mismatch fallback")
+
+
+def runChecks():
+    folder = tempfile.mkdtemp()
+    savedEnv = {name: os.environ.get(name) for name in ("PRS_CACHE_PATH", "PRS_CACHE_MAX_MB")}
+    try:
+        checkRevalidation(folder)
+        checkOfflineFallback(folder)
+        checkEviction(folder)
+        checkDownloads(folder)
+    finally:
+        for name, value in savedEnv.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(folder, ignore_errors=True)
+    print("[LOG] All checks passed")
+
+
+if __name__ == "__main__":
+    runChecks()
@@ -0,0 +1,177 @@
+import bisect
+import gzip
+import os
+
+# Converts positions between reference genomes offline, using the UCSC liftOver chain files.
+#
+# A chain file is a list of chains, each a series of ungapped blocks aligning a range of the source genome to a range
+# of the target genome. The blocks are indexed by source chromosome in lists sorted by their start, so a position is
+# converted with a bisect of the list of its chromosome and an offset into the block it falls in. Positions that
+# aren't in any block (deleted or rearranged in the target genome) can't be converted.
+#
+# The chain files are read from chainFiles next to this file (where the CLI download puts them) or from
+# update_database_scripts in the repository. A conversion without a chain file is done with the chain file of the
+# opposite direction, read backwards, and conversions between two genomes that aren't hg19 go through hg19
+# (e.g. hg38 -> hg19 -> hg17).
+
+CHAIN_DIRS = (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "chainFiles"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "update_database_scripts")
+)
+# the genome every chain file converts from or to
+HUB_GENOME = "hg19"
+
+# the chain indexes loaded by this process, by (chain file path, inverted)
+loadedIndexes = {}
+
+
+class ChainIndex:
+    """
+    The blocks of a chain file, by source chromosome, sorted by their start.
+    """
+
+    def __init__(self, chainPath, inverted=False):
+        self.chainPath = chainPath
+        self.inverted = inverted
+        # source chromosome -> parallel lists of the start and end of each block in the source genome, and the
+        # chromosome, lowest position, and orientation of the block in the target genome
+        self.starts = {}
+        self.ends = {}
+        self.targetChroms = {}
+        self.targetStarts = {}
+        self.reversed = {}
+
+        blocks = {}
+        openFunc = gzip.open if chainPath.endswith(".gz") else open
+        with openFunc(chainPath, 'rt') as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                if fields[0] == "chain":
+                    # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+                    tChrom, tStart = fields[2], int(fields[5])
+                    qChrom, qSize, qReverse, qStart = fields[7], int(fields[8]), fields[9] == "-", int(fields[10])
+                    continue
+                # size [dt dq]: an ungapped block, then the gaps before the next block in each genome
+                size = int(fields[0])
+                # blocks on the reverse strand of the target are given in reverse strand coordinates
+                qLow = qSize - qStart - size if qReverse else qStart
+                if inverted:
+                    blocks.setdefault(qChrom, []).append((qLow, qLow + size, tChrom, tStart, qReverse))
+                else:
+                    blocks.setdefault(tChrom, []).append((tStart, tStart + size, qChrom, qLow, qReverse))
+                if len(fields) == 3:
+                    tStart += size + int(fields[1])
+                    qStart += size + int(fields[2])
+
+        for chrom, chromBlocks in blocks.items():
+            chromBlocks.sort()
+            starts, ends, targetChroms, targetStarts, reverse = [], [], [], [], []
+            for start, end, targetChrom, targetStart, isReversed in chromBlocks:
+                # a base aligned twice (only possible when reading a chain file backwards) keeps its first alignment
+                if ends and start < ends[-1]:
+                    continue
+                starts.append(start)
+                ends.append(end)
+                targetChroms.append(targetChrom)
+                targetStarts.append(targetStart)
+                reverse.append(isReversed)
+            self.starts[chrom] = starts
+            self.ends[chrom] = ends
+            self.targetChroms[chrom] = targetChroms
+            self.targetStarts[chrom] = targetStarts
+            self.reversed[chrom] = reverse
+
+    def convert(self, chrom, pos):
+        # converts a 0-based position, returning (chromosome, position) in the target genome or None
+        starts = self.starts.get(chrom)
+        if starts is None:
+            return None
+        i = bisect.bisect_right(starts, pos) - 1
+        if i < 0 or pos >= self.ends[chrom][i]:
+            return None
+        if self.reversed[chrom][i]:
+            return self.targetChroms[chrom][i], self.targetStarts[chrom][i] + (self.ends[chrom][i] - 1 - pos)
+        return self.targetChroms[chrom][i], self.targetStarts[chrom][i] + (pos - starts[i])
+
+
+def findChainFile(fromGenome, toGenome):
+    fileName = "{0}To{1}.over.chain".format(fromGenome, toGenome[0].upper() + toGenome[1:])
+    for chainDir in CHAIN_DIRS:
+        for name in (fileName, fileName + ".gz"):
+            chainPath = os.path.join(chainDir, name)
+            if os.path.exists(chainPath):
+                return chainPath
+    return None
+
+
+def getChainIndex(fromGenome, toGenome):
+    # returns the index converting fromGenome to toGenome, reading a chain file backwards if needed, or None
+    chainPath = findChainFile(fromGenome, toGenome)
+    inverted = False
+    if chainPath is None:
+        chainPath = findChainFile(toGenome, fromGenome)
+        inverted = True
+    if chainPath is None:
+        return None
+    key = (os.path.abspath(chainPath), inverted)
+    if key not in loadedIndexes:
+        loadedIndexes[key] = ChainIndex(chainPath, inverted)
+    return loadedIndexes[key]
+
+
+def getChainIndexes(fromGenome, toGenome):
+    """
+    Returns the chain indexes that convert fromGenome to toGenome when applied in order.
+    """
+    fromGenome, toGenome = fromGenome.lower(), toGenome.lower()
+    if fromGenome == toGenome:
+        return []
+    index = getChainIndex(fromGenome, toGenome)
+    if index is not None:
+        return [index]
+    if HUB_GENOME not in (fromGenome, toGenome):
+        indexes = [getChainIndex(fromGenome, HUB_GENOME), getChainIndex(HUB_GENOME, toGenome)]
+        if None not in indexes:
+            return indexes
+    raise SystemExit(f"ERROR: No chain file was found to convert positions from {fromGenome} to {toGenome}. Looked in {', '.join(os.path.abspath(d) for d in CHAIN_DIRS)}.")
+
+
+def convertPosition(indexes, chrom, pos):
+    # converts a 1-based position with the indexes, returning (chromosome, position) or None
+    hasPrefix = chrom.startswith("chr")
+    converted = (chrom if hasPrefix else "chr" + chrom, pos - 1)
+    for index in indexes:
+        converted = index.convert(*converted)
+        if converted is None:
+            return None
+    newChrom, newPos = converted
+    # the chromosome is returned in the style it was given in
+    if not hasPrefix and newChrom.startswith("chr"):
+        newChrom = newChrom[3:]
+    return newChrom, newPos + 1
+
+
+def convertPositions(positions, fromGenome, toGenome):
+    """
+    Converts a batch of positions from one reference genome to another.
+
+    Args:
+        positions: iterable of "chrom:pos" strings with 1-based positions (e.g. "chr1:12345" or "1:12345")
+        fromGenome, toGenome: the reference genomes (hg17, hg18, hg19, or hg38)
+
+    Returns:
+        dict: "chrom:pos" in fromGenome -> "chrom:pos" in toGenome, for the positions that could be converted
+    """
+    indexes = getChainIndexes(fromGenome, toGenome)
+    converted = {}
+    for chromPos in positions:
+        chrom, _, pos = chromPos.rpartition(":")
+        try:
+            newChromPos = convertPosition(indexes, chrom, int(pos))
+        except ValueError:
+            continue
+        if newChromPos is not None:
+            converted[chromPos] = "{0}:{1}".format(*newChromPos)
+    return converted
@@ -0,0 +1,359 @@
+import csv
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import time
+from multiprocessing import Lock, Pipe, Process
+
+# Results from every study are streamed to a single writer process that keeps the output file open,
+# instead of each process locking, reopening, and appending to the output file for every line.
+
+# the types of messages sent to the writer
+ROWS_MESSAGE = 0 # a batch of TSV rows
+JSON_MESSAGE = 1 # a study's serialized JSON object and its number of rows
+DONE_MESSAGE = 2 # all the results of a study have been sent
+SHARD_MESSAGE = 3 # all the results of a study for one shard of the samples
+
+# rows are sent to the writer in batches of this size
+ROW_BATCH_SIZE = 500
+# size of the output file's write buffer
+WRITE_BUFFER_SIZE = 1024 * 1024
+# seconds between checks that the writer is still running while waiting for the studies
+WRITER_POLL_INTERVAL = 1
+
+# state of a process sending results to the writer
+writerPipe = None
+currentStudy = None
+pendingRows = []
+# results of the current study for a shard of the samples, sent together when the study is finished
+currentShard = None
+shardOutput = None
+
+
+def startWriter(outputFilePath, isJson, header, keepStudyOrder, numShards=1, mergeShards=None, journal=None):
+    # starts the writer process and returns it with the pipe used to send it results
+    receiver, sender = Pipe(duplex=False)
+    writer = Process(target=runWriter, args=(receiver, outputFilePath, isJson, header, keepStudyOrder, numShards, mergeShards, journal))
+    writer.start()
+    # the writer holds the only receiving end, so if it stops, sending results to it raises BrokenPipeError
+    # instead of blocking forever once the pipe is full
+    receiver.close()
+    return writer, (sender, Lock())
+
+
+def stopWriter(writer, pipe):
+    # tells the writer that all the results have been sent and waits for it to finish the output file
+    try:
+        sendMessage(pipe, None)
+    except BrokenPipeError:
+        pass
+    writer.join()
+    pipe[0].close()
+    if writer.exitcode != 0:
+        raise SystemExit("ERROR: There was an error while writing the output file. Please try again.")
+    return
+
+
+def watchWriter(results, writer):
+    # yields the results of a pool's imap iterator, and stops the run if the writer stopped before they were all sent
+    while True:
+        try:
+            yield results.next(timeout=WRITER_POLL_INTERVAL)
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            if not writer.is_alive():
+                raise SystemExit("ERROR: There was an error while writing the output file. Please try again.")
+
+
+def setWriterPipe(pipe):
+    # called in each process that sends results to the writer
+    global writerPipe
+    writerPipe = pipe
+    return
+
+
+def isStreaming():
+    return writerPipe is not None
+
+
+def sendMessage(pipe, message):
+    # the lock keeps the messages of different processes from being interleaved in the pipe
+    sender, lock = pipe
+    with lock:
+        sender.send(message)
+    return
+
+
+def startStudy(studyIndex, shardIndex=None):
+    global currentStudy, currentShard, shardOutput
+    currentStudy = studyIndex
+    currentShard = shardIndex
+    shardOutput = {'rows': [], 'json': [], 'totals': None} if shardIndex is not None else None
+    return
+
+
+def setShardTotals(totals):
+    # the values of the shard needed to merge it with the other shards of the study (see runWriter)
+    shardOutput['totals'] = totals
+    return
+
+
+def addRow(row):
+    if currentShard is not None:
+        shardOutput['rows'].append(row)
+        return
+    pendingRows.append(row)
+    if len(pendingRows) >= ROW_BATCH_SIZE:
+        sendRows()
+    return
+
+
+def addJson(studyInfo):
+    if currentShard is not None:
+        shardOutput['json'].append(studyInfo)
+        return
+    sendRows()
+    # vcf results hold a list of samples, txt results are a single row
+    numRows = len(studyInfo['samples']) if 'samples' in studyInfo else 1
+    sendMessage(writerPipe, (currentStudy, JSON_MESSAGE, (json.dumps(studyInfo, indent=4), numRows)))
+    return
+
+
+def finishStudy():
+    if currentShard is not None:
+        sendMessage(writerPipe, (currentStudy, SHARD_MESSAGE, (currentShard, shardOutput)))
+        return
+    sendRows()
+    sendMessage(writerPipe, (currentStudy, DONE_MESSAGE, None))
+    return
+
+
+def sendRows():
+    if pendingRows:
+        sendMessage(writerPipe, (currentStudy, ROWS_MESSAGE, list(pendingRows)))
+        del pendingRows[:]
+    return
+
+
+def getJournalPath(outputFilePath):
+    return outputFilePath + ".journal"
+
+
+def readJournal(journalPath, outputFilePath, runParams):
+    """
+    Reads the journal of an interrupted run to resume it.
+
+    The first line of the journal holds the parameters of the run, and a line is appended with the study key and
+    the size of the output file each time the results of a study are completely written.
+
+    Returns:
+        tuple: (keys of the studies that are done, size of the output file after them), or (set(), None) if the
+        run has to start from the beginning
+    """
+    if not os.path.exists(journalPath) or not os.path.exists(outputFilePath):
+        print(f"[LOG] No journal was found for {outputFilePath}, starting from the beginning")
+        return set(), None
+
+    doneKeys = set()
+    resumeOffset = None
+    with open(journalPath, 'r', encoding="utf-8") as journal:
+        for lineNum, line in enumerate(journal):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line can be cut off if the run was killed while writing it
+                break
+            if lineNum == 0:
+                if entry.get('params') != runParams:
+                    raise SystemExit(f"ERROR: The journal {journalPath} is from a run with different parameters. Run again with the same parameters, or without resuming to start over.")
+                continue
+            doneKeys.add(entry['key'])
+            resumeOffset = entry['end']
+
+    if resumeOffset is None or os.path.getsize(outputFilePath) < resumeOffset:
+        print(f"[LOG] No finished studies were found in the journal {journalPath}, starting from the beginning")
+        return set(), None
+    print(f"[LOG] Resuming {outputFilePath} after {len(doneKeys)} finished studies")
+    return doneKeys, resumeOffset
+
+
+def runWriter(receiver, outputFilePath, isJson, header, keepStudyOrder, numShards=1, mergeShards=None, journal=None):
+    """
+    Writes the results received on the pipe to the output file until None is received.
+
+    The output is the same as appending with formatTSV and formatJson. The results of each study are written
+    together: the results of one study are written as they arrive and the others are held until it is done, in a
+    file for each study in the folder outputFilePath + ".held". If keepStudyOrder is True, that study is always the
+    first one that isn't done, so the output is in study order no matter which process finished first.
+
+    If the samples are split into numShards shards, the results of a study arrive as one SHARD_MESSAGE for each
+    shard. Once every shard of a study has arrived, mergeShards is called with their outputs in shard (and so
+    sample) order and returns the (messageType, payload) messages to write for the study.
+
+    If journal is given ({'path', 'params', 'studyKeys', 'doneStudies', 'resumeOffset'}), the key of each study and
+    the size of the output file are appended to the journal file once the study is written. If resumeOffset is not
+    None, the output file is cut back to that size and the studies in doneStudies (which aren't calculated again)
+    are kept.
+    """
+    # if the folder of the output file doesn't exist, create it
+    if "/" in outputFilePath:
+        os.makedirs(os.path.dirname(outputFilePath), exist_ok=True)
+
+    startTime = time.time()
+    resumeOffset = journal['resumeOffset'] if journal is not None else None
+    # studies with messages held until they can be written
+    heldStudies = set()
+    doneStudies = set(journal['doneStudies']) if resumeOffset is not None else set()
+    # studies that are done but held until the active study is done (if keepStudyOrder is False)
+    waitingStudies = set()
+    activeStudy = None
+    # studyIndex -> shardIndex -> output of the shards received so far
+    studyShards = {}
+    nextStudy = 0
+    while nextStudy in doneStudies:
+        nextStudy += 1
+    numRows = 0
+    # JSON studies are separated by "," and the last one is followed by " ]"
+    hasJsonStudy = resumeOffset is not None and resumeOffset > len("[")
+
+    if resumeOffset is None:
+        f = open(outputFilePath, 'w', newline='', encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+    else:
+        f = open(outputFilePath, 'r+', newline='', encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+        f.seek(resumeOffset)
+        f.truncate()
+    journalFile = None
+    if journal is not None:
+        journalFile = open(journal['path'], 'w' if resumeOffset is None else 'a', encoding="utf-8")
+        if resumeOffset is None:
+            journalFile.write(json.dumps({'params': journal['params']}) + "\n")
+            journalFile.flush()
+
+    # files of the held studies (left over if a previous run was killed)
+    heldFolder = outputFilePath + ".held"
+    shutil.rmtree(heldFolder, ignore_errors=True)
+    os.makedirs(heldFolder)
+    try:
+        with f:
+            output = csv.writer(f, delimiter='\t')
+            if resumeOffset is None:
+                if isJson:
+                    f.write("[")
+                else:
+                    output.writerow(header)
+
+            def writeMessage(messageType, payload):
+                nonlocal numRows, hasJsonStudy
+                if messageType == ROWS_MESSAGE:
+                    output.writerows(payload)
+                    numRows += len(payload)
+                elif messageType == JSON_MESSAGE:
+                    studyJson, studyRows = payload
+                    if hasJsonStudy:
+                        f.write(",")
+                    f.write(studyJson)
+                    hasJsonStudy = True
+                    numRows += studyRows
+
+            def holdMessage(studyIndex, messageType, payload):
+                # the messages are appended to the file of the study instead of being kept in memory
+                with open(os.path.join(heldFolder, str(studyIndex)), 'ab') as heldFile:
+                    pickle.dump((messageType, payload), heldFile, protocol=pickle.HIGHEST_PROTOCOL)
+                heldStudies.add(studyIndex)
+
+            def writeStudy(studyIndex):
+                if studyIndex not in heldStudies:
+                    return
+                heldStudies.remove(studyIndex)
+                heldPath = os.path.join(heldFolder, str(studyIndex))
+                with open(heldPath, 'rb') as heldFile:
+                    while True:
+                        try:
+                            heldType, heldPayload = pickle.load(heldFile)
+                        except EOFError:
+                            break
+                        writeMessage(heldType, heldPayload)
+                os.remove(heldPath)
+
+            def commitStudy(studyIndex):
+                # every result of the study is in the output file
+                if journalFile is not None:
+                    f.flush()
+                    journalFile.write(json.dumps({'key': journal['studyKeys'][studyIndex], 'end': f.tell()}) + "\n")
+                    journalFile.flush()
+
+            def handleMessage(studyIndex, messageType, payload):
+                nonlocal nextStudy, activeStudy
+                if keepStudyOrder:
+                    if messageType != DONE_MESSAGE:
+                        if studyIndex == nextStudy:
+                            writeMessage(messageType, payload)
+                        else:
+                            holdMessage(studyIndex, messageType, payload)
+                        return
+                    doneStudies.add(studyIndex)
+                    while nextStudy in doneStudies:
+                        writeStudy(nextStudy)
+                        commitStudy(nextStudy)
+                        nextStudy += 1
+                    # the results the next study already sent, the rest are written as they arrive
+                    writeStudy(nextStudy)
+                    return
+
+                if messageType != DONE_MESSAGE:
+                    if activeStudy is None:
+                        activeStudy = studyIndex
+                    if studyIndex == activeStudy:
+                        writeMessage(messageType, payload)
+                    else:
+                        holdMessage(studyIndex, messageType, payload)
+                elif activeStudy is None or studyIndex == activeStudy:
+                    commitStudy(studyIndex)
+                    # write the studies that were done while this one was written, and pick the next study to write
+                    for waitingStudy in sorted(waitingStudies):
+                        writeStudy(waitingStudy)
+                        commitStudy(waitingStudy)
+                    waitingStudies.clear()
+                    activeStudy = min(heldStudies) if heldStudies else None
+                    if activeStudy is not None:
+                        writeStudy(activeStudy)
+                else:
+                    waitingStudies.add(studyIndex)
+
+            message = receiver.recv()
+            while message is not None:
+                studyIndex, messageType, payload = message
+                if messageType == SHARD_MESSAGE:
+                    shardIndex, shardResults = payload
+                    shards = studyShards.setdefault(studyIndex, {})
+                    shards[shardIndex] = shardResults
+                    if len(shards) == numShards:
+                        del studyShards[studyIndex]
+                        for mergedType, mergedPayload in mergeShards([shards[i] for i in range(numShards)]):
+                            handleMessage(studyIndex, mergedType, mergedPayload)
+                        handleMessage(studyIndex, DONE_MESSAGE, None)
+                else:
+                    handleMessage(studyIndex, messageType, payload)
+                message = receiver.recv()
+
+            # write anything left from studies that didn't finish (they aren't added to the journal)
+            for studyIndex in sorted(heldStudies):
+                writeStudy(studyIndex)
+
+            if isJson:
+                if hasJsonStudy:
+                    f.write(" ")
+                f.write("]")
+    finally:
+        shutil.rmtree(heldFolder, ignore_errors=True)
+
+    if journalFile is not None:
+        journalFile.close()
+
+    elapsed = time.time() - startTime
+    rate = numRows / elapsed if elapsed > 0 else 0
+    print(f"[LOG] Output writer wrote {numRows} rows in {elapsed:.2f} seconds ({rate:.0f} rows/sec)")
+    return
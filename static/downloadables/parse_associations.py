@@ -1,14 +1,18 @@
 from multiprocessing import Pool
-from io import StringIO
+from functools import partial
 import json
 from Bio.Seq import reverse_complement
 import vcf
 import calculate_score as cs
+import genotype_store as gs
+import position_index as pi
+import working_store as ws
+import output_writer as ow
 import sys
 import os
 import os.path
+import time
 from collections import defaultdict
-import hashlib
 from connect_to_server import getPreferredPop, formatMafCohort
 from connect_to_server import openFileForParsing
 
@@ -38,6 +42,10 @@ def parseAndCalculateFiles(params):
     timestamp = params[21]
     isIndividualClump = int(params[22])
     superPop = params[23]
+    genotypeStore = params[24]
+    snpPositions = params[25]
+    sampleRange = params[26]
+    shardTotals = params[27]
 
     # check if the input file is a txt or vcf file
     # parse the file to get the necessary genotype information for each sample and then run the calculations
@@ -46,12 +54,155 @@ def parseAndCalculateFiles(params):
         if txtObj is not None:
             cs.calculateScore(snpSet, txtObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, unmatchedAlleleVariants, clumpedVariants, outputFilePath, None, trait, study, pValueAnno, betaAnnotation, valueType, isRSids, None, snpOverlap, excludedSnps, includedSnps, preferredPop)
     else:
-        vcfObj, mafDict, neutral_snps_map, clumped_snps_map, sample_num, sample_order, snpOverlap, excludedSnps, includedSnps, preferredPop = parse_vcf(inputFilePath, clumpsObjDict, tableObjDict, possibleAlleles, snpSet, clumpNumDict, mafDict, pValue, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, timestamp, isIndividualClump, superPop)
+        vcfObj, mafDict, neutral_snps_map, clumped_snps_map, sample_num, sample_order, snpOverlap, excludedSnps, includedSnps, preferredPop, genotypeSources = parse_vcf(genotypeStore, snpPositions, clumpsObjDict, tableObjDict, possibleAlleles, snpSet, clumpNumDict, mafDict, pValue, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, timestamp, isIndividualClump, superPop, sampleRange, shardTotals)
         if vcfObj is not None:
-            cs.calculateScore(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, sample_num, trait, study, pValueAnno, betaAnnotation, valueType, isRSids, sample_order, snpOverlap, excludedSnps, includedSnps, preferredPop)
+            cs.calculateScore(snpSet, vcfObj, tableObjDict, mafDict, percentileDict, isJson, isCondensedFormat, omitPercentiles, neutral_snps_map, clumped_snps_map, outputFilePath, sample_num, trait, study, pValueAnno, betaAnnotation, valueType, isRSids, sample_order, snpOverlap, excludedSnps, includedSnps, preferredPop, genotypeSources)
     return
 
 
+# reference data shared by every trait/study, set once in each worker process by initializeWorker
+workerData = {}
+
+
+def initializeWorker(referenceData):
+    # with the fork start method, the reference data is inherited by the workers instead of being pickled
+    global workerData
+    workerData = referenceData
+    ow.setWriterPipe(referenceData['writerPipe'])
+
+
+def calculateStudy(keyString, shardIndex=None):
+    # build the parameters for one trait/study from the shared reference data and run its calculations
+    # (only for the samples of shard shardIndex if the samples are split into shards)
+    pValue, mafCutoff, imputationThreshold, isJson, isCondensedFormat, omitPercentiles, outputFilePath, isRSids, timestamp, isIndividualClump, superPop = workerData['params']
+    tableObjDict = workerData['tableObjDict']
+    percentileDict = workerData['percentileDict']
+
+    trait, pValueAnno, betaAnnotation, valueType, study = keyString.split('|')
+    # get all of the variants associated with this trait/study
+    snpSet = workerData['studySnpsDict'][keyString]
+    uniquePercentileDict = percentileDict[keyString] if not omitPercentiles and keyString in percentileDict else {}
+    # get the population used for clumping
+    popList = tableObjDict['studyIDsToMetaData'][study]['traits'][trait]['superPopulations']
+    popList = [eachPop.lower() for eachPop in popList]
+    preferredPop = getPreferredPop(popList, superPop)
+    clumpsObjDict = workerData['allClumpsObjDict'][preferredPop]
+    sampleRange = workerData['sampleShards'][shardIndex] if shardIndex is not None else None
+    shardTotals = {} if shardIndex is not None else None
+    ow.startStudy(workerData['studyIndexes'][keyString], shardIndex)
+    parseAndCalculateFiles((workerData['filteredInputPath'], clumpsObjDict, tableObjDict, snpSet, workerData['clumpNumDict'], workerData['possibleAlleles'], workerData['mafDict'], uniquePercentileDict, pValue, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, isJson, isCondensedFormat, omitPercentiles, outputFilePath, isRSids, timestamp, isIndividualClump, superPop, workerData['genotypeStore'], workerData['snpPositions'], sampleRange, shardTotals))
+    if shardTotals is not None:
+        # parse_vcf leaves shardTotals empty if the study has no variants in the input
+        ow.setShardTotals(shardTotals or None)
+    ow.finishStudy()
+    return
+
+
+def calculateStudyChunk(chunk):
+    # runs a chunk of (keyString, shardIndex) tasks made by scheduleStudyTasks and returns its cost and size for the progress
+    chunkCost, tasks = chunk
+    for keyString, shardIndex in tasks:
+        calculateStudy(keyString, shardIndex)
+    return chunkCost, len(tasks)
+
+
+# the tasks are grouped into about this many chunks for each subprocess
+CHUNKS_PER_PROCESS = 4
+# minimum number of seconds between progress updates
+PROGRESS_INTERVAL = 5
+
+
+def scheduleStudyTasks(tasks, costs, numProcesses, largestFirst=True):
+    """
+    Orders the tasks from the most to the least expensive and groups them into chunks of about the same cost.
+    The largest studies start first and the small ones at the end fill in the subprocesses that finish early,
+    so a few large studies are not left running alone at the end. A task that costs more than a chunk is
+    dispatched on its own. If largestFirst is False, the tasks keep their order (the output writer holds the
+    results of a study until the studies before it are written when the study order is kept).
+
+    Returns:
+        list: (chunkCost, tasks) tuples in the order they should be dispatched
+    """
+    targetCost = sum(costs) / (numProcesses * CHUNKS_PER_PROCESS)
+    chunks = []
+    chunkTasks = []
+    chunkCost = 0
+    taskOrder = sorted(range(len(tasks)), key=lambda i: -costs[i]) if largestFirst else range(len(tasks))
+    for taskIdx in taskOrder:
+        if chunkTasks and chunkCost + costs[taskIdx] > targetCost:
+            chunks.append((chunkCost, chunkTasks))
+            chunkTasks = []
+            chunkCost = 0
+        chunkTasks.append(tasks[taskIdx])
+        chunkCost += costs[taskIdx]
+    if chunkTasks:
+        chunks.append((chunkCost, chunkTasks))
+    return chunks
+
+
+def reportProgress(results, numTasks, totalCost):
+    # consumes the (chunkCost, numChunkTasks) results of the chunks as they finish and prints the progress and ETA
+    startTime = time.time()
+    lastReport = startTime
+    doneTasks = 0
+    doneCost = 0
+    for chunkCost, numChunkTasks in results:
+        doneTasks += numChunkTasks
+        doneCost += chunkCost
+        now = time.time()
+        if now - lastReport >= PROGRESS_INTERVAL or doneTasks == numTasks:
+            lastReport = now
+            elapsed = now - startTime
+            # the estimated cost of the studies is a better measure of the work left than the number of studies
+            fractionDone = doneCost / totalCost if totalCost > 0 else doneTasks / numTasks
+            eta = elapsed * (1 - fractionDone) / fractionDone if fractionDone > 0 else 0
+            print(f"[LOG] Calculated {doneTasks}/{numTasks} studies ({fractionDone:.0%} of the estimated work), {elapsed:.0f}s elapsed, ETA {eta:.0f}s")
+            sys.stdout.flush()
+    return
+
+
+def getSampleShards(numSamples, numShards):
+    # splits the sample columns into numShards contiguous (start, end) ranges of about the same size
+    numShards = max(1, min(numShards, numSamples))
+    bounds = [numSamples * i // numShards for i in range(numShards + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(numShards)]
+
+
+def mergeStudyShards(isJson, isCondensedFormat, imputationThreshold, shardOutputs):
+    """
+    Merges the results of a trait/study for each shard of the samples into the results of all the samples.
+    Called by the output writer with the outputs of the shards in sample order (see output_writer.runWriter).
+
+    Returns:
+        list: (messageType, payload) messages for the output writer, empty if the study isn't written
+    """
+    totals = [output['totals'] for output in shardOutputs]
+    # whether the input has variants of the study doesn't depend on the samples, so this is the same for every shard
+    if any(x is None for x in totals):
+        return []
+    # the imputation threshold is checked for all the samples together
+    usedSnps = set().union(*[x['usedSnps'] for x in totals])
+    includedSnps = set().union(*[x['includedSnps'] for x in totals])
+    if isAboveImputationThreshold(usedSnps, includedSnps, imputationThreshold):
+        return []
+
+    if isJson:
+        studyInfo = shardOutputs[0]['json'][0]
+        studyInfo['samples'] = [sample for output in shardOutputs for sample in output['json'][0]['samples']]
+        return [(ow.JSON_MESSAGE, (json.dumps(studyInfo, indent=4), len(studyInfo['samples'])))]
+    elif isCondensedFormat:
+        # the study columns come from the first sample, followed by the snp overlap columns and the scores of every sample
+        rows = [output['rows'][0] for output in shardOutputs]
+        overlapSnps = [x for total in totals for x in total['snpOverlap']]
+        allIncludedSnps = [x for total in totals for x in total['includedSnpCounts']]
+        newLine = rows[0][:10] + cs.formatCondensedOverlap(overlapSnps, allIncludedSnps)
+        for row in rows:
+            newLine.extend(row[12:])
+        return [(ow.ROWS_MESSAGE, [newLine])]
+    else:
+        return [(ow.ROWS_MESSAGE, [row for output in shardOutputs for row in output['rows']])]
+
+
 def getDownloadedFiles(fileHash, requiredParamsHash, superPop, mafCohort, refGen, isRSids, omitPercentiles, timestamp, useGWASupload):
     isFilters = False
     mafCohort = formatMafCohort(mafCohort)
@@ -89,21 +240,18 @@ def getDownloadedFiles(fileHash, requiredParamsHash, superPop, mafCohort, refGen
 
     try:
         # open the files that were previously created
-        with open(associationsPath, 'r') as tableObjFile:
-            tableObjDict = json.load(tableObjFile)
+        # the database files are read through their binary stores, the files created for this run are read as JSON
+        useStore = not useGWASupload
+        tableObjDict = ws.loadWorkingFile(associationsPath, useStore)
         with open(clumpNumPath, 'r') as clumpNumFile:
             clumpNumDict = json.load(clumpNumFile)
-        with open(studySnpsPath, 'r') as studySnpsFile:
-            studySnpsDict = json.load(studySnpsFile)
-        with open(mafCohortPath, 'r') as mafFile:
-            mafDict = json.load(mafFile)
+        studySnpsDict = ws.loadWorkingFile(studySnpsPath, useStore and studySnpsPath != filteredStudySnpsPath)
+        mafDict = ws.loadWorkingFile(mafCohortPath, useStore)
         if not omitPercentiles:
-            with open(percentilePath, 'r', encoding="utf-8") as percentileFile:
-                percentileDict = json.load(percentileFile)
+            percentileDict = ws.loadWorkingFile(percentilePath, useStore)
         else:
             percentileDict = {}
-        with open(possibleAllelesPath, 'r') as possibleAllelesFile:
-            possibleAlleles = json.load(possibleAllelesFile)
+        possibleAlleles = ws.loadWorkingFile(possibleAllelesPath, useStore)
 
         # Get super populations from studyIDMetaData
         allSuperPops = set()
@@ -120,46 +268,33 @@ def getDownloadedFiles(fileHash, requiredParamsHash, superPop, mafCohort, refGen
         for pop in allSuperPops:
             if isFilters:
                 clumpsPath = os.path.join(basePath, "{p}_clumps_{r}_{ahash}.txt".format(p = pop, r = refGen, ahash = fileHash))
-                with open(clumpsPath, 'r') as clumpsObjFile:
-                    clumpsObjDict = json.load(clumpsObjFile)
-                    allClumps[pop] = clumpsObjDict
-                    clumpsObjFile = {}
             else:
                 clumpsPath = os.path.join(basePath, "{p}_clumps_{r}.txt".format(p = pop, r = refGen))
-                with open(clumpsPath, 'r') as clumpsObjFile:
-                    clumpsObjDict = json.load(clumpsObjFile)
-                    allClumps[pop] = clumpsObjDict
-                    clumpsObjFile = {}
+            allClumps[pop] = ws.loadWorkingFile(clumpsPath, useStore)
     
     except FileNotFoundError:
         raise SystemExit("ERROR: One or both of the required working files could not be found. \n Paths searched for: \n{0}\n{1}\n{2}\n{3}\n{4}".format(associationsPath, clumpsPath, clumpNumPath, studySnpsPath, mafCohortPath))
 
-    return tableObjDict, allClumps, clumpNumDict, studySnpsDict, possibleAlleles, mafDict, percentileDict, filteredInputPath
+    return tableObjDict, allClumps, clumpNumDict, studySnpsDict, possibleAlleles, mafDict, percentileDict, filteredInputPath, associationsPath
+
+
+def getPrefilteredSnps(tableObjDict, trait, study, pValBetaAnnoValType):
+    # the number of snps of the trait/study that the GWAS upload prefilter left out for being above the p-value cutoff
+    if 'gwasPrefilter' not in tableObjDict:
+        return 0
+    return tableObjDict['gwasPrefilter']['excludedSnps'].get("|".join([trait, pValBetaAnnoValType, study]), 0)
+
+
+def checkPrefilterCutoff(tableObjDict, pValue):
+    # a GWAS upload prefiltered at a lower p-value cutoff is missing associations this run would use
+    if 'gwasPrefilter' in tableObjDict and float(pValue) > tableObjDict['gwasPrefilter']['pValueCutoff']:
+        raise SystemExit("ERROR: The GWAS file was prefiltered at a p-value cutoff of {0}, so it can't be used with the higher cutoff {1}. Please run the calculations again without the prefilter or with a cutoff of {0} or lower.".format(tableObjDict['gwasPrefilter']['pValueCutoff'], pValue))
 
 
 def formatAndReturnGenotype(genotype, REF, ALT):
     try:
         # read and interpret the genotype column from the VCF
-        # if the genotype is not completely null
-        if genotype != "./." and genotype != ".|." and genotype !=".." and genotype != '.':
-            alleles = []
-            if "|" in genotype:
-                gt_nums = genotype.split('|')
-            elif "/" in genotype:
-                gt_nums = genotype.split('/')
-            else:
-                gt_nums = list(genotype)
-
-            for alleleNum in gt_nums:
-                if alleleNum == '0':
-                    alleles.append(str(REF))
-                elif alleleNum == '.':
-                    alleles.append('.')
-                else:
-                    gt_num = int(alleleNum) - 1
-                    alleles.append(str(ALT[gt_num]))
-        else:
-            alleles = [".", "."]
+        alleles = gs.alleleCodesToAlleles(gs.genotypeToAlleleCodes(genotype), REF, ALT)
 
     except ValueError:
         raise SystemExit("The VCF file is not formatted correctly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position.")
@@ -320,7 +455,7 @@ def parse_txt(filteredFilePath, clumpsObjDict, tableObjDict, snpSet, clumpNumDic
 
     snpOverlap = len(usedSnps)
     includedSnps = len(set(snpSet).difference(excludedDueToCutoffs, clumpedVariants) | usedSnps)
-    snpsExcluded = len(excludedDueToCutoffs)
+    snpsExcluded = len(excludedDueToCutoffs) + getPrefilteredSnps(tableObjDict, trait, study, pValBetaAnnoValType)
 
     if snpOverlap == 0:
         return None, None, None, None, None, None, None
@@ -336,138 +471,15 @@ def parse_txt(filteredFilePath, clumpsObjDict, tableObjDict, snpSet, clumpNumDic
     return final_map, clumpedVariants, unmatchedAlleleVariants, snpOverlap, snpsExcluded, includedSnps, preferredPop
 
 
-def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, snpSet, clumpNumDict, mafDict, p_cutOff, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, timestamp, isIndividualClump, superPop):
-    # variable to keep track of the number of samples in the input file
-    sampleNum=0
-    snpOverlap = 0
+def parse_vcf(genotypeStore, snpPositions, clumpsObjDict, tableObjDict, possibleAlleles, snpSet, clumpNumDict, mafDict, p_cutOff, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, timestamp, isIndividualClump, superPop, sampleRange=None, shardTotals=None):
+    # if sampleRange (start, end) is given, only those sample columns are parsed. If shardTotals is given, the
+    # imputation threshold is checked once the shards of the samples are merged (see mergeStudyShards) and the
+    # SNPs it needs are added to shardTotals
     createMaf = False
 
     if mafDict is None:
         createMaf = True
 
-    # loop through the input file and once you get to the CHROM line, count the samples and break
-    with open(filteredFilePath, 'r') as f:
-        for line in f:
-            if line[0:6] == '#CHROM':
-                cols=line.split('\t')
-                samples=cols[9:]
-                sampleNum=len(samples)
-                break
-        
-    if sampleNum > 50:
-        # create a temp file that will hold the lines of snps found in this trait/study
-        basePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles")
-        studyHash = '{t}|{s}|{p}|{b}|{v}'.format(t=trait, s=study, p=pValueAnno, b=betaAnnotation, v=valueType)
-        studyHash = studyHash.encode()
-        hashObj = hashlib.md5(studyHash)
-        studyHash = hashObj.hexdigest()
-        tempFilePath = os.path.join(basePath, "{s}_{h}_{uniq}.vcf".format(s=study, h=studyHash, uniq = timestamp))
-        useFilePath = tempFilePath
-        with open(tempFilePath, 'w', encoding="utf-8") as w:
-            # Open filtered file
-            with open(filteredFilePath, 'r', encoding="utf-8") as f:
-                for line in f:
-                    # check if the line is a header
-                    if line[0] == '#':
-                        w.write(line)
-                    else:
-                        # cut the line and get the column values
-                        shortLine = line[0:500]
-                        cols = shortLine.split('\t')
-                        rsID = cols[2]
-                        chromPos = str(cols[0]) + ":" + str(cols[1])
-                        
-                        # Check if we should use chromPos for matching (when GWAS uses chromPos as identifier)
-                        identifier_to_check = rsID
-                        if chromPos in snpSet:
-                            # If chromPos is in our SNP set, use it as the identifier
-                            identifier_to_check = chromPos
-                        elif rsID is None or rsID == '.' or rsID == '':
-                            # BCF has no rsID (rsID='.'), try position-based matching
-                            # Check if any SNP in our set maps to this position
-                            position_match_found = False
-                            for snp in snpSet:
-                                if snp in tableObjDict.get('associations', {}):
-                                    assoc = tableObjDict['associations'][snp]
-                                    if 'pos' in assoc and assoc['pos']:
-                                        # Convert database position to BCF format for comparison
-                                        db_pos = assoc['pos']
-                                        if ':' in db_pos:
-                                            db_chrom, db_pos_num = db_pos.split(':')
-                                            if not db_chrom.startswith('chr'):
-                                                db_chrom = 'chr' + db_chrom
-                                            db_chrompos = f"{db_chrom}:{db_pos_num}"
-                                            
-                                            if db_chrompos == chromPos:
-                                                identifier_to_check = snp  # Use the rsID from database
-                                                position_match_found = True
-                                                break
-                            
-                            if not position_match_found:
-                                identifier_to_check = chromPos  # Fallback to chromPos
-                        elif (chromPos in tableObjDict['associations'] and rsID not in tableObjDict['associations']):
-                            # Legacy logic for when chromPos maps to rsID
-                            if isinstance(tableObjDict['associations'][chromPos], str):
-                                rsID = tableObjDict['associations'][chromPos]
-                                identifier_to_check = rsID
-
-                        # if the identifier is in the study/trait, write the line to the temp file
-                        if identifier_to_check in snpSet:
-                            w.write(line)
-
-    else:
-        with open(filteredFilePath, 'r') as f:
-            string = ""
-            for line in f:
-                # check if the line is a header
-                if line[0] == '#':
-                    string += line
-                else:
-                    # cut the line and get the column values
-                    shortLine = line[0:500]
-                    cols = shortLine.split('\t')
-                    rsID = cols[2]
-                    chromPos = str(cols[0]) + ':' + str(cols[1])
-                    
-                    # Check if we should use chromPos for matching (when GWAS uses chromPos as identifier)
-                    identifier_to_check = rsID
-                    if chromPos in snpSet:
-                        # If chromPos is in our SNP set, use it as the identifier
-                        identifier_to_check = chromPos
-                    elif rsID is None or rsID == '.' or rsID == '':
-                        # BCF has no rsID (rsID='.'), try position-based matching
-                        # Check if any SNP in our set maps to this position
-                        position_match_found = False
-                        for snp in snpSet:
-                            if snp in tableObjDict.get('associations', {}):
-                                assoc = tableObjDict['associations'][snp]
-                                if 'pos' in assoc and assoc['pos']:
-                                    # Convert database position to BCF format for comparison
-                                    db_pos = assoc['pos']
-                                    if ':' in db_pos:
-                                        db_chrom, db_pos_num = db_pos.split(':')
-                                        if not db_chrom.startswith('chr'):
-                                            db_chrom = 'chr' + db_chrom
-                                        db_chrompos = f"{db_chrom}:{db_pos_num}"
-                                        
-                                        if db_chrompos == chromPos:
-                                            identifier_to_check = snp  # Use the rsID from database
-                                            position_match_found = True
-                                            break
-                        
-                        if not position_match_found:
-                            identifier_to_check = chromPos  # Fallback to chromPos
-                    elif (chromPos in tableObjDict['associations'] and rsID not in tableObjDict['associations']):
-                        # Legacy logic for when chromPos maps to rsID
-                        if isinstance(tableObjDict['associations'][chromPos], str):
-                            rsID = tableObjDict['associations'][chromPos]
-                            identifier_to_check = rsID
-
-                    # if the identifier is in the study/trait, write the line to the memory file
-                    if identifier_to_check in snpSet:
-                        string += line
-            useFilePath = StringIO(string)
-
     # Create a dictionary to keep track of the variants in each study
     sample_map = defaultdict(dict)
 
@@ -483,165 +495,129 @@ def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, sn
     neutral_snps_map = {}
     clumped_snps_map = {}
 
-    # open the tempFile as a vcf reader now
-    if sampleNum > 50:
-        vcf_reader = vcf.Reader(openFileForParsing(useFilePath))
-    else:
-        vcf_reader = vcf.Reader(useFilePath)
+    # identifier -> (recordIdx, isFlipped) of the record the alleles of the first sample were read from, or None if
+    # they were imputed. Index snps keep theirs as the last item of their index_snp_map tuple
+    variantSources = {}
 
-    # Get the number of samples in the vcf
-    sampleOrder = vcf_reader.samples
+    # Get the samples in the vcf
+    sampleStart, sampleEnd = sampleRange if sampleRange is not None else (0, len(genotypeStore['samples']))
+    sampleOrder = genotypeStore['samples'][sampleStart:sampleEnd]
     sample_num = len(sampleOrder)
 
+    # Get the records of the shared genotype store that belong to this trait/study
+    studyRecords = gs.getStudyRecords(genotypeStore, snpSet, tableObjDict, snpPositions)
 
     try:
-        # Iterate through each line in the vcf file
+        # Iterate through each variant of this study in the vcf file
         usedSnps = {}
         excludedDueToCutoffs = set()
         pValBetaAnnoValType = "|".join([pValueAnno, betaAnnotation, valueType])
-        for record in vcf_reader:
-            string_format = str(record.FORMAT)
-            rsID = record.ID
-            chromPos = str(record.CHROM) + ":" + str(record.POS)
-            
-            # Check if we should use chromPos for matching (when GWAS uses chromPos as identifier)
-            identifier_to_check = rsID
-            if chromPos in snpSet:
-                # If chromPos is in our SNP set, use it as the identifier
-                identifier_to_check = chromPos
-            elif rsID is None or rsID == '.' or rsID == '':
-                # BCF has no rsID (rsID='.'), try position-based matching
-                # Check if any SNP in our set maps to this position
-                position_match_found = False
-                for snp in snpSet:
-                    if snp in tableObjDict.get('associations', {}):
-                        assoc = tableObjDict['associations'][snp]
-                        if 'pos' in assoc and assoc['pos']:
-                            # Convert database position to BCF format for comparison
-                            db_pos = assoc['pos']
-                            if ':' in db_pos:
-                                db_chrom, db_pos_num = db_pos.split(':')
-                                if not db_chrom.startswith('chr'):
-                                    db_chrom = 'chr' + db_chrom
-                                db_chrompos = f"{db_chrom}:{db_pos_num}"
-                                
-                                if db_chrompos == chromPos:
-                                    identifier_to_check = snp  # Use the rsID from database
-                                    position_match_found = True
-                                    break
-                
-                if not position_match_found:
-                    identifier_to_check = chromPos  # Fallback to chromPos
-            elif (chromPos in tableObjDict['associations'] and rsID not in tableObjDict['associations']):
-                # Legacy logic for when chromPos maps to rsID
-                if isinstance(tableObjDict['associations'][chromPos], str):
-                    rsID = tableObjDict['associations'][chromPos]
-                    identifier_to_check = rsID
-
-            # check to see if the snp is in this particular trait/study
-            if identifier_to_check in snpSet:
-                # this if statement ensures that the trait/study combo actually exists in the tableObjDict for this identifier
-                # this is necessary due to excluded snps
-                if trait in tableObjDict['associations'][identifier_to_check]['traits'] and study in tableObjDict['associations'][identifier_to_check]['traits'][trait] and pValBetaAnnoValType in tableObjDict['associations'][identifier_to_check]['traits'][trait][study]:
-                    ALT = record.ALT
-                    REF = record.REF 
-
-                    # if we need to create the maf, do it here
-                    if createMaf:
-                        lineInfo = record.INFO["AF"]
-                        if identifier_to_check not in mafDict:
-                            mafDict[identifier_to_check] = {
-                                "chrom": record.CHROM,
-                                "pos": record.POS,
-                                "alleles": {}
-                            }
-                        for i in range(len(ALT)):
-                            allele = str(ALT[i])
-                            if allele not in mafDict[identifier_to_check]["alleles"]:
-                                mafDict[identifier_to_check]["alleles"][allele] = lineInfo[i]
-
-                        if REF not in mafDict[identifier_to_check]["alleles"]:
-                            mafDict[identifier_to_check]["alleles"][REF] = 1 - sum(lineInfo)
-
-                    for riskAllele in tableObjDict['associations'][identifier_to_check]['traits'][trait][study][pValBetaAnnoValType]:
-                        #grab the corresponding pvalue and risk allele
-                        pValue = tableObjDict['associations'][identifier_to_check]['traits'][trait][study][pValBetaAnnoValType][riskAllele]['pValue']
-                        mafVal = mafDict[identifier_to_check]['alleles'][riskAllele] if identifier_to_check in mafDict and riskAllele in mafDict[identifier_to_check]["alleles"] else 0
+        for recordIdx, identifier_to_check in studyRecords:
+            record = genotypeStore['records'][recordIdx]
+            CHROM, POS, REF, ALT, AF = record[2:7]
 
-                        # compare the pvalue to the pvalue cutoff
-                        if pValue <= p_cutOff and mafVal >= mafCutoff:
-                            # loop through each sample of the vcf file
-                            for call in record.samples:
-                                sample = call.sample
-                                if sample not in usedSnps:
-                                    usedSnps[sample] = set()
-                                usedSnps[sample].add(identifier_to_check)
-                                genotype = record.genotype(sample)['GT']
-                                alleles = formatAndReturnGenotype(genotype, REF, ALT)
-                                complements = takeComplement(possibleAlleles[identifier_to_check], alleles, REF, ALT) if identifier_to_check in possibleAlleles else None
-
-                                # Grab or create maps that hold sets of unused variants for this sample
-                                clumpedVariants = clumped_snps_map[sample] if sample in clumped_snps_map else set()
-                                unmatchedAlleleVariants = neutral_snps_map[sample] if sample in neutral_snps_map else set()
-
-                                atRisk = True if riskAllele in alleles or (complements is not None and riskAllele in complements) or "." in alleles else False
-                                if atRisk or not isIndividualClump:
-                                    if identifier_to_check in clumpsObjDict:
-                                        # Grab the clump number associated with this study and snp position
-                                        clumpNum = clumpsObjDict[identifier_to_check]['clumpNum']
-                                        # Check to see how many variants are in this clump. If there's only one, we can skip the clumping checks.
-                                        clumpNumTotal = clumpNumDict[str((preferredPop,clumpNum))]
-
-                                        if clumpNumTotal > 1:
-                                            if sample in index_snp_map:
-                                                # if the clump number for this snp position and study/name is already in the index map, move forward
-                                                if clumpNum in index_snp_map[sample]:
-                                                    index_snp, index_rAllele, index_alleles = index_snp_map[sample][clumpNum]
-                                                    index_pvalue = tableObjDict['associations'][index_snp]['traits'][trait][study][pValBetaAnnoValType][index_rAllele]['pValue']
-
-                                                    # Check whether the existing index snp or current snp have a lower pvalue for this study
-                                                    # and switch out the data accordingly
-                                                    if pValue < index_pvalue:
-                                                        index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements
+            # this if statement ensures that the trait/study combo actually exists in the tableObjDict for this identifier
+            # this is necessary due to excluded snps
+            if trait in tableObjDict['associations'][identifier_to_check]['traits'] and study in tableObjDict['associations'][identifier_to_check]['traits'][trait] and pValBetaAnnoValType in tableObjDict['associations'][identifier_to_check]['traits'][trait][study]:
+                # if we need to create the maf, do it here
+                if createMaf:
+                    lineInfo = AF
+                    if identifier_to_check not in mafDict:
+                        mafDict[identifier_to_check] = {
+                            "chrom": CHROM,
+                            "pos": POS,
+                            "alleles": {}
+                        }
+                    for i in range(len(ALT)):
+                        allele = str(ALT[i])
+                        if allele not in mafDict[identifier_to_check]["alleles"]:
+                            mafDict[identifier_to_check]["alleles"][allele] = lineInfo[i]
+
+                    if REF not in mafDict[identifier_to_check]["alleles"]:
+                        mafDict[identifier_to_check]["alleles"][REF] = 1 - sum(lineInfo)
+
+                for riskAllele in tableObjDict['associations'][identifier_to_check]['traits'][trait][study][pValBetaAnnoValType]:
+                    #grab the corresponding pvalue and risk allele
+                    pValue = tableObjDict['associations'][identifier_to_check]['traits'][trait][study][pValBetaAnnoValType][riskAllele]['pValue']
+                    mafVal = mafDict[identifier_to_check]['alleles'][riskAllele] if identifier_to_check in mafDict and riskAllele in mafDict[identifier_to_check]["alleles"] else 0
+
+                    # compare the pvalue to the pvalue cutoff
+                    if pValue <= p_cutOff and mafVal >= mafCutoff:
+                        # loop through each sample of the vcf file
+                        for sampleIdx, sample in enumerate(sampleOrder):
+                            if sample not in usedSnps:
+                                usedSnps[sample] = set()
+                            usedSnps[sample].add(identifier_to_check)
+                            alleles = gs.getSampleAlleles(record, sampleStart + sampleIdx)
+                            complements = takeComplement(possibleAlleles[identifier_to_check], alleles, REF, ALT) if identifier_to_check in possibleAlleles else None
+                            source = (recordIdx, complements is not None)
+
+                            # Grab or create maps that hold sets of unused variants for this sample
+                            clumpedVariants = clumped_snps_map[sample] if sample in clumped_snps_map else set()
+                            unmatchedAlleleVariants = neutral_snps_map[sample] if sample in neutral_snps_map else set()
+
+                            atRisk = True if riskAllele in alleles or (complements is not None and riskAllele in complements) or "." in alleles else False
+                            if atRisk or not isIndividualClump:
+                                if identifier_to_check in clumpsObjDict:
+                                    # Grab the clump number associated with this study and snp position
+                                    clumpNum = clumpsObjDict[identifier_to_check]['clumpNum']
+                                    # Check to see how many variants are in this clump. If there's only one, we can skip the clumping checks.
+                                    clumpNumTotal = clumpNumDict[str((preferredPop,clumpNum))]
+
+                                    if clumpNumTotal > 1:
+                                        if sample in index_snp_map:
+                                            # if the clump number for this snp position and study/name is already in the index map, move forward
+                                            if clumpNum in index_snp_map[sample]:
+                                                index_snp, index_rAllele, index_alleles, index_source = index_snp_map[sample][clumpNum]
+                                                index_pvalue = tableObjDict['associations'][index_snp]['traits'][trait][study][pValBetaAnnoValType][index_rAllele]['pValue']
+
+                                                # Check whether the existing index snp or current snp have a lower pvalue for this study
+                                                # and switch out the data accordingly
+                                                if pValue < index_pvalue:
+                                                    index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements, source
+                                                    clumpedVariants.add(index_snp)
+                                                    usedSnps[sample].discard(index_snp)
+                                                else:
+                                                    if index_alleles == "" and alleles != "" and isIndividualClump:
+                                                        index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements, source
                                                         clumpedVariants.add(index_snp)
                                                         usedSnps[sample].discard(index_snp)
                                                     else:
-                                                        if index_alleles == "" and alleles != "" and isIndividualClump:
-                                                            index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements
-                                                            clumpedVariants.add(index_snp)
-                                                            usedSnps[sample].discard(index_snp)
-                                                        else:
-                                                            clumpedVariants.add(identifier_to_check)
-                                                            usedSnps[sample].discard(identifier_to_check)
-                                                else:
-                                                    # Since the clump number for this snp position and study/name
-                                                    # doesn't already exist, add it to the index map and the sample map
-                                                    index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements
+                                                        clumpedVariants.add(identifier_to_check)
+                                                        usedSnps[sample].discard(identifier_to_check)
                                             else:
-                                                # Since the study/name combo wasn't already used in the index map, add it to both the index and sample map
-                                                index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements
-                                        # the variant is the only one in the ld clump
+                                                # Since the clump number for this snp position and study/name
+                                                # doesn't already exist, add it to the index map and the sample map
+                                                index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements, source
                                         else:
-                                            sample_map[sample][identifier_to_check] = alleles if complements is None else complements
-                                    # the variant isn't in the clump tables
+                                            # Since the study/name combo wasn't already used in the index map, add it to both the index and sample map
+                                            index_snp_map[sample][clumpNum] = identifier_to_check, riskAllele, alleles if complements is None else complements, source
+                                    # the variant is the only one in the ld clump
                                     else:
                                         sample_map[sample][identifier_to_check] = alleles if complements is None else complements
-
-                                # the sample's alleles don't include the risk allele and early clumping is not requested
+                                        if sampleIdx == 0:
+                                            variantSources[identifier_to_check] = source
+                                # the variant isn't in the clump tables
                                 else:
-                                    unmatchedAlleleVariants.add(identifier_to_check)
+                                    sample_map[sample][identifier_to_check] = alleles if complements is None else complements
+                                    if sampleIdx == 0:
+                                        variantSources[identifier_to_check] = source
 
-                                    clumped_snps_map[sample] = clumpedVariants
-                                    neutral_snps_map[sample] = unmatchedAlleleVariants
-                        else:
-                            excludedDueToCutoffs.add(identifier_to_check)
+                            # the sample's alleles don't include the risk allele and early clumping is not requested
+                            else:
+                                unmatchedAlleleVariants.add(identifier_to_check)
+
+                                clumped_snps_map[sample] = clumpedVariants
+                                neutral_snps_map[sample] = unmatchedAlleleVariants
+                    else:
+                        excludedDueToCutoffs.add(identifier_to_check)
 
         usedSnpsAcrossAllSamps = set()
         for samp in usedSnps:
             usedSnpsAcrossAllSamps.update(usedSnps[samp])
         snpOverlap = len(usedSnpsAcrossAllSamps)
         if snpOverlap == 0:
-            return None, None, None, None, None, None, None, None, None, None
+            return None, None, None, None, None, None, None, None, None, None, None
         # This next code accounts for snps that are in the study but are not reported in the sample. Instead of assuming the reference allele, we 
         # assume that the allele is unknown and thus will use MAF for calculations of these snps
         for sample in sampleOrder:
@@ -670,14 +646,14 @@ def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, sn
                                     if sample in index_snp_map:
                                         # if the clump number for this snp position and study/name is already in the index map, move forward
                                         if clumpNum in index_snp_map[sample]:
-                                            index_snp, index_rAllele, index_alleles = index_snp_map[sample][clumpNum]
+                                            index_snp, index_rAllele, index_alleles, index_source = index_snp_map[sample][clumpNum]
                                             index_pvalue = tableObjDict['associations'][index_snp]['traits'][trait][study][pValBetaAnnoValType][index_rAllele]['pValue']
 
                                             if not isIndividualClump:
                                                 # Check whether the existing index snp or current snp have a lower pvalue for this study
                                                 # and switch out the data accordingly
                                                 if pValue < index_pvalue:
-                                                    index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."]
+                                                    index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."], None
                                                     clumpedVariants.add(index_snp)
                                                     usedSnps[sample].discard(index_snp)
                                                 else:
@@ -687,12 +663,12 @@ def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, sn
                                                 # Check whether the existing index snp or current snp have a lower pvalue for this study
                                                 # and switch out the data accordingly
                                                 if pValue < index_pvalue:
-                                                    index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."]
+                                                    index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."], None
                                                     clumpedVariants.add(index_snp)
                                                     usedSnps[sample].discard(index_snp)
                                                 else:
                                                     if index_alleles == "":
-                                                        index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."]
+                                                        index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."], None
                                                         clumpedVariants.add(index_snp)
                                                         usedSnps[sample].discard(index_snp)
                                                     else:
@@ -701,16 +677,20 @@ def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, sn
                                         else:
                                             # Since the clump number for this snp position and study/name
                                             # doesn't already exist, add it to the index map and the sample map
-                                            index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."]
+                                            index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."], None
                                     else:
                                         # Since the study/name combo wasn't already used in the index map, add it to both the index and sample map
-                                        index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."]
+                                        index_snp_map[sample][clumpNum] = rsID, riskAllele, [".", "."], None
                                 # the variant is the only one in its clump
                                 else:
                                     sample_map[sample][rsID] = [".", "."]
+                                    if sample == sampleOrder[0]:
+                                        variantSources[rsID] = None
                             # the variant isn't in the clump tables
                             else:
                                 sample_map[sample][rsID] = [".", "."]
+                                if sample == sampleOrder[0]:
+                                    variantSources[rsID] = None
                         else:
                             excludedDueToCutoffs.add(rsID)
             clumped_snps_map[sample] = clumpedVariants
@@ -718,8 +698,10 @@ def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, sn
         # Add the index snp for each sample's ld clump to the sample map
         for sample in index_snp_map:
                 for clumpNum in index_snp_map[sample]:
-                    rsID, rAllele, alleles = index_snp_map[sample][clumpNum]
+                    rsID, rAllele, alleles, source = index_snp_map[sample][clumpNum]
                     sample_map[sample][rsID] = alleles
+                    if sample == sampleOrder[0]:
+                        variantSources[rsID] = source
 
     except ValueError:
         raise SystemExit("The VCF file is not formatted correctly. Each line must have 'GT' (genotype) formatting and a non-Null value for the chromosome and position.")
@@ -737,20 +719,46 @@ def parse_vcf(filteredFilePath, clumpsObjDict, tableObjDict, possibleAlleles, sn
 
     snpOverlapAll = len(usedSnpsAcrossAllSamps)
     if snpOverlapAll == 0:
-        return None, None, None, None, None, None, None, None, None, None
-    elif (len(allIncludedSnps) - snpOverlapAll) / len(allIncludedSnps) > imputationThreshold:
-        return None, None, None, None, None, None, None, None, None, None
-
-    snpsExcluded = len(excludedDueToCutoffs)
+        return None, None, None, None, None, None, None, None, None, None, None
+    elif shardTotals is not None:
+        shardTotals['usedSnps'] = usedSnpsAcrossAllSamps
+        shardTotals['includedSnps'] = allIncludedSnps
+        shardTotals['snpOverlap'] = [snpOverlap[samp] for samp in snpOverlap]
+        shardTotals['includedSnpCounts'] = [includedSnps[samp] for samp in snpOverlap]
+    elif isAboveImputationThreshold(usedSnpsAcrossAllSamps, allIncludedSnps, imputationThreshold):
+        return None, None, None, None, None, None, None, None, None, None, None
+
+    snpsExcluded = len(excludedDueToCutoffs) + getPrefilteredSnps(tableObjDict, trait, study, "|".join([pValueAnno, betaAnnotation, valueType]))
     final_map = dict(sample_map)
-    vcf_reader = None
+    genotypeSources = getGenotypeSources(genotypeStore, sampleStart, variantSources) if not isIndividualClump else None
 
-    #remove temp file
-    if sampleNum > 50:
-        if os.path.exists(tempFilePath):
-            os.remove(tempFilePath)
+    return final_map, mafDict, neutral_snps_map, clumped_snps_map, sample_num, sampleOrder, snpOverlap, snpsExcluded, includedSnps, preferredPop, genotypeSources
 
-    return final_map, mafDict, neutral_snps_map, clumped_snps_map, sample_num, sampleOrder, snpOverlap, snpsExcluded, includedSnps, preferredPop
+
+def getGenotypeSources(genotypeStore, sampleStart, variantSources):
+    # without individual clumping every sample keeps the same variants, read from the same records, so the sparse
+    # scoring engine can count the alleles of every sample at once from the allele codes of the genotype store.
+    # Each variant gets its record and the allele of each allele code (complemented if its strand was flipped)
+    variants = {}
+    for identifier, source in variantSources.items():
+        if source is not None:
+            recordIdx, isFlipped = source
+            REF, ALT = genotypeStore['records'][recordIdx][4:6]
+            codeAlleles = [str(REF)] + [str(x) for x in ALT]
+            if isFlipped:
+                codeAlleles = [reverse_complement(x) for x in codeAlleles]
+            source = (recordIdx, codeAlleles)
+        variants[identifier] = source
+    return {
+        'genotypeStore': genotypeStore,
+        'sampleStart': sampleStart,
+        'variants': variants
+    }
+
+
+def isAboveImputationThreshold(usedSnps, includedSnps, imputationThreshold):
+    # True if too many of the included snps of a study would be imputed
+    return (len(includedSnps) - len(usedSnps)) / len(includedSnps) > imputationThreshold
 
 
 def takeComplement(possibleAlleles, alleles, REF, ALT):
@@ -774,20 +782,24 @@ def getSamples(inputFilePath, header):
     return header
 
 
-def runParsingAndCalculations(inputFilePath, fileHash, requiredParamsHash, superPop, mafCohort, refGen, pValue, mafCutoff, imputationThreshold, extension, outputFilePath, outputType, isCondensedFormat, omitPercentiles, timestamp, num_processes, isIndividualClump, useGWASupload):
-    paramOpts = []
+def runParsingAndCalculations(inputFilePath, fileHash, requiredParamsHash, superPop, mafCohort, refGen, pValue, mafCutoff, imputationThreshold, extension, outputFilePath, outputType, isCondensedFormat, omitPercentiles, timestamp, num_processes, isIndividualClump, useGWASupload, keepStudyOrder=False, numShards=1, resume=False):
     if num_processes == "":
         num_processes = None
     else:
         num_processes = int(num_processes)
+    numShards = 1 if numShards == "" else int(numShards)
+    resume = True if resume == "1" or resume == True else False
 
     omitPercentiles = False if int(omitPercentiles) == 0 else True
+    useGWASupload = True if useGWASupload == "True" or useGWASupload == True else False
+    keepStudyOrder = True if keepStudyOrder == "1" or keepStudyOrder == True else False
     
     # tells us if we were passed rsIDs or a vcf
     isRSids = True if extension.lower().endswith(".txt") or inputFilePath.lower().endswith(".txt") else False
 
     # Access the downloaded files and paths
-    tableObjDict, allClumpsObjDict, clumpNumDict, studySnpsDict, possibleAlleles, mafDict, percentileDict, filteredInputPath = getDownloadedFiles(fileHash, requiredParamsHash, superPop, mafCohort, refGen, isRSids, omitPercentiles, timestamp, useGWASupload)
+    tableObjDict, allClumpsObjDict, clumpNumDict, studySnpsDict, possibleAlleles, mafDict, percentileDict, filteredInputPath, associationsPath = getDownloadedFiles(fileHash, requiredParamsHash, superPop, mafCohort, refGen, isRSids, omitPercentiles, timestamp, useGWASupload)
+    checkPrefilterCutoff(tableObjDict, pValue)
     
     # Determine whether the output format is condensed and either json or tsv
     if outputType == '.json':
@@ -801,17 +813,9 @@ def runParsingAndCalculations(inputFilePath, fileHash, requiredParamsHash, super
             isCondensedFormat = True
 
     
-    if isJson: #json and verbose
-        # we need to make sure the outputFile doesn't already exist so that we don't append to an old file
-        if os.path.exists(outputFilePath):
-            os.remove(outputFilePath)
-        jsonOutput = open(outputFilePath, 'w')
-        jsonOutput.write("[]")
-        jsonOutput.close()
-
-    else:
-        # we need to write out the header depending on the output type
-        header = []
+    # the output writer creates the output file, the tsv header depends on the output type
+    header = None
+    if not isJson:
         if isCondensedFormat and isRSids: # condensed and txt input
             header = ['Study ID', 'Reported Trait', 'Trait', 'Citation', 'P-Value Annotation', 'Beta Annotation', 'Score Type', 'Units (if applicable)', 'Used Super Population', 'SNPs Excluded Due To Cutoffs', 'SNP Overlap', 'Included SNPs', 'Polygenic Risk Score', 'Percentile']
         elif isCondensedFormat: # condensed and vcf input
@@ -822,41 +826,86 @@ def runParsingAndCalculations(inputFilePath, fileHash, requiredParamsHash, super
             header = ['Study ID', 'Reported Trait', 'Trait', 'Citation', 'P-Value Annotation', 'Beta Annotation', 'Score Type', 'Units (if applicable)', 'Used Super Population', 'SNPs Excluded Due To Cutoffs', 'SNP Overlap', 'Included SNPs', 'Polygenic Risk Score', 'Percentile', 'Protective Variants', 'Risk Variants', 'Variants Without Risk Allele', 'Variants in High LD']
         else: # verbose and vcf input
             header = ['Sample', 'Study ID', 'Reported Trait', 'Trait', 'Citation', 'P-Value Annotation', 'Beta Annotation', 'Score Type', 'Units (if applicable)', 'Used Super Population', 'SNPs Excluded Due To Cutoffs', 'SNP Overlap', 'Included SNPs', 'Polygenic Risk Score', 'Percentile', 'Protective Variants', 'Risk Variants', 'Variants Without Risk Allele', 'Variants in High LD']
-        cs.formatTSV(True, None, header, outputFilePath)
-
-    # we create params for each study so that we can run them on separate processes
-    for keyString in studySnpsDict:
-        trait, pValueAnno, betaAnnotation, valueType, study = keyString.split('|')
-        # get all of the variants associated with this trait/study
-        snpSet = studySnpsDict[keyString]
-        uniquePercentileDict = percentileDict[keyString] if not omitPercentiles and keyString in percentileDict else {}
-        # get the population used for clumping
-        popList = tableObjDict['studyIDsToMetaData'][study]['traits'][trait]['superPopulations']
-        popList = [eachPop.lower() for eachPop in popList]
-        preferredPop = getPreferredPop(popList, superPop)
-        clumpsObjDict = allClumpsObjDict[preferredPop]
-        paramOpts.append((filteredInputPath, clumpsObjDict, tableObjDict, snpSet, clumpNumDict, possibleAlleles, mafDict, uniquePercentileDict, pValue, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, isJson, isCondensedFormat, omitPercentiles, outputFilePath, isRSids, timestamp, isIndividualClump, superPop))
+
+    # parse the filtered vcf once so that every study reads its genotypes from the same in-memory store
+    genotypeStore = gs.buildGenotypeStore(filteredInputPath, tableObjDict) if not isRSids else None
+    # records without an rsID are matched to the study snps by position
+    snpPositions = {}
+    if genotypeStore is not None and genotypeStore['noRsidPosIndex']:
+        snpPositions = pi.getSnpPositions(pi.loadPositionIndex(associationsPath, tableObjDict, not useGWASupload))
+
+    # the reference data is handed to each worker once when it starts, so each task only carries its study key
+    referenceData = {
+        'filteredInputPath': filteredInputPath,
+        'tableObjDict': tableObjDict,
+        'allClumpsObjDict': allClumpsObjDict,
+        'clumpNumDict': clumpNumDict,
+        'studySnpsDict': studySnpsDict,
+        'possibleAlleles': possibleAlleles,
+        'mafDict': mafDict,
+        'percentileDict': percentileDict,
+        'genotypeStore': genotypeStore,
+        'snpPositions': snpPositions,
+        'studyIndexes': {keyString: i for i, keyString in enumerate(studySnpsDict)},
+        'params': (pValue, mafCutoff, imputationThreshold, isJson, isCondensedFormat, omitPercentiles, outputFilePath, isRSids, timestamp, isIndividualClump, superPop)
+    }
+    studyKeys = list(studySnpsDict)
+
+    # finished studies are recorded in a journal next to the output file so that an interrupted run can be resumed
+    journal = {
+        'path': ow.getJournalPath(outputFilePath),
+        'params': [str(x) for x in (inputFilePath, fileHash, superPop, mafCohort, refGen, pValue, mafCutoff, imputationThreshold, outputType, isCondensedFormat, omitPercentiles, isIndividualClump, useGWASupload)],
+        'studyKeys': studyKeys,
+        'doneStudies': set(),
+        'resumeOffset': None
+    }
+    if resume:
+        doneKeys, journal['resumeOffset'] = ow.readJournal(journal['path'], outputFilePath, journal['params'])
+        journal['doneStudies'] = set(i for i, keyString in enumerate(studyKeys) if keyString in doneKeys)
+        studyKeys = [keyString for keyString in studyKeys if keyString not in doneKeys]
+
+    # with sample shards, each study is calculated separately for each contiguous range of sample columns,
+    # so that runs with few studies and many samples still use every subprocess
+    mergeShards = None
+    if genotypeStore is not None and numShards > 1 and len(genotypeStore['samples']) > 1:
+        referenceData['sampleShards'] = getSampleShards(len(genotypeStore['samples']), numShards)
+        numShards = len(referenceData['sampleShards'])
+        mergeShards = partial(mergeStudyShards, isJson, isCondensedFormat, float(imputationThreshold))
+        print(f"[LOG] Splitting {len(genotypeStore['samples'])} samples into {numShards} shards")
+    else:
+        numShards = 1
+
+    # the cost of a study (or of a study for a shard of the samples) is estimated as its number of snps times its number of samples
+    if numShards == 1:
+        tasks = [(keyString, None) for keyString in studyKeys]
+        costs = [len(studySnpsDict[keyString]) * (len(genotypeStore['samples']) if genotypeStore is not None else 1) for keyString in studyKeys]
+    else:
+        tasks = [(keyString, shardIndex) for keyString in studyKeys for shardIndex in range(numShards)]
+        costs = [len(studySnpsDict[keyString]) * (sampleEnd - sampleStart) for keyString in studyKeys for sampleStart, sampleEnd in referenceData['sampleShards']]
+
+    # every result is sent to a single process that writes the output file
+    writer, referenceData['writerPipe'] = ow.startWriter(outputFilePath, isJson, header, keepStudyOrder, numShards, mergeShards, journal)
+    try:
         # if no subprocesses are going to be used, run the calculations once for each study/trait
         if num_processes == 0:
-            parseAndCalculateFiles((filteredInputPath, clumpsObjDict, tableObjDict, snpSet, clumpNumDict, possibleAlleles, mafDict, uniquePercentileDict, pValue, mafCutoff, imputationThreshold, trait, study, pValueAnno, betaAnnotation, valueType, isJson, isCondensedFormat, omitPercentiles, outputFilePath, isRSids, timestamp, isIndividualClump, superPop))
-
-    if num_processes is None or (type(num_processes) is int and num_processes > 0):
-        with Pool(processes=num_processes) as pool:
-            pool.map(parseAndCalculateFiles, paramOpts)
-
-    if isJson: #json and verbose
-        # we need to make sure the outputFile doesn't already exist so that we don't append to an old file
-        if os.path.exists(outputFilePath):
-            jsonOutput = open(outputFilePath, 'r+')
-            checkChar = jsonOutput.readlines()[-1][-2]
-            if checkChar == ",":
-                jsonOutput.seek(0,2)
-                position = jsonOutput.tell() -2
-                jsonOutput.seek(position)
-                jsonOutput.write(" ")
-                jsonOutput.close()
+            initializeWorker(referenceData)
+            reportProgress(map(calculateStudyChunk, [(cost, [task]) for task, cost in zip(tasks, costs)]), len(tasks), sum(costs))
+
+        if num_processes is None or (type(num_processes) is int and num_processes > 0):
+            with Pool(processes=num_processes, initializer=initializeWorker, initargs=(referenceData,)) as pool:
+                # the most expensive studies are dispatched first (unless the study order is kept), in chunks of about the same cost
+                chunks = scheduleStudyTasks(tasks, costs, num_processes or os.cpu_count() or 1, not keepStudyOrder)
+                # the run stops if the writer stops, instead of the subprocesses waiting for it forever
+                reportProgress(ow.watchWriter(pool.imap_unordered(calculateStudyChunk, chunks), writer), len(tasks), sum(costs))
+    finally:
+        ow.stopWriter(writer, referenceData['writerPipe'])
+    # the run is complete, so it won't be resumed
+    if os.path.exists(journal['path']):
+        os.remove(journal['path'])
 
 if __name__ == "__main__":
-    useGWASupload = True if sys.argv[18] == "True" or sys.argv[18] == True else False
-    runParsingAndCalculations(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6], sys.argv[7], sys.argv[8], sys.argv[9], sys.argv[10], sys.argv[11], sys.argv[12], sys.argv[13], sys.argv[14], sys.argv[15], sys.argv[16], sys.argv[17], useGWASupload)
+    keepStudyOrder = sys.argv[19] if len(sys.argv) > 19 else False
+    numShards = sys.argv[20] if len(sys.argv) > 20 else 1
+    resume = sys.argv[21] if len(sys.argv) > 21 else False
+    runParsingAndCalculations(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6], sys.argv[7], sys.argv[8], sys.argv[9], sys.argv[10], sys.argv[11], sys.argv[12], sys.argv[13], sys.argv[14], sys.argv[15], sys.argv[16], sys.argv[17], sys.argv[18], keepStudyOrder, numShards, resume)
 
@@ -0,0 +1,91 @@
+import json
+import os
+import working_store as ws
+
+# Index from the normalized position ("chr1:12345") of every association to the SNP identifiers at that position.
+#
+# Records without an rsID in the input VCF can only be matched to the study SNPs by position. The index is built
+# once for an associations file, so parse_vcf matches those records with a dictionary lookup instead of
+# normalizing the position of every study SNP again for each study. It is written next to the associations file
+# (and read through its binary store) and is rebuilt when the associations file changes.
+
+POSITION_INDEX_VERSION = 1
+
+
+def getPositionIndexPath(associationsPath):
+    directory, fileName = os.path.split(associationsPath)
+    return os.path.join(directory, "positionIndex_" + fileName)
+
+
+def normalizePosition(dbPos):
+    # the database positions are "1:12345", the index uses "chr1:12345". Returns None for malformed positions
+    if not dbPos or dbPos.count(':') != 1:
+        return None
+    dbChrom, dbPosNum = dbPos.split(':')
+    if not dbChrom.startswith('chr'):
+        dbChrom = 'chr' + dbChrom
+    return f"{dbChrom}:{dbPosNum}"
+
+
+def buildPositionIndex(tableObjDict):
+    # returns {normalized position: list of SNP identifiers at that position, in the order of the associations}
+    positions = {}
+    for snp, snpData in tableObjDict.get('associations', {}).items():
+        if isinstance(snpData, str):
+            continue
+        chromPos = normalizePosition(snpData.get('pos'))
+        if chromPos is not None:
+            positions.setdefault(chromPos, []).append(snp)
+    return positions
+
+
+def getSnpPositions(positions):
+    # inverts the index into {SNP identifier: normalized position}, so each study only looks up its own SNPs
+    snpPositions = {}
+    for chromPos, snps in positions.items():
+        for snp in snps:
+            snpPositions.setdefault(snp, chromPos)
+    return snpPositions
+
+
+def loadPositionIndex(associationsPath, tableObjDict, useStore=True):
+    """
+    Returns the position index of the associations file at associationsPath. If useStore is True, the index is
+    read from its working file, which is written (or rewritten, if the associations file changed) when needed.
+    Otherwise it is built in memory.
+    """
+    if not useStore:
+        return buildPositionIndex(tableObjDict)
+
+    indexPath = getPositionIndexPath(associationsPath)
+    sourceStat = os.stat(associationsPath)
+    if os.path.exists(indexPath):
+        index = ws.loadWorkingFile(indexPath)
+        if index.get('version') == POSITION_INDEX_VERSION and index.get('sourceMtime') == sourceStat.st_mtime_ns and index.get('sourceSize') == sourceStat.st_size:
+            return index['positions']
+
+    print(f"[LOG] Building the position index of {associationsPath}")
+    try:
+        return writePositionIndex(tableObjDict, associationsPath)
+    except OSError as e:
+        print(f"[LOG] Could not write the position index for {associationsPath}: {e}")
+        return buildPositionIndex(tableObjDict)
+
+
+def writePositionIndex(tableObjDict, associationsPath):
+    # builds the index of the associations file at associationsPath and writes it (and its binary store) next to it
+    positions = buildPositionIndex(tableObjDict)
+    sourceStat = os.stat(associationsPath)
+    index = {
+        'version': POSITION_INDEX_VERSION,
+        'sourceMtime': sourceStat.st_mtime_ns,
+        'sourceSize': sourceStat.st_size,
+        'positions': positions
+    }
+    indexPath = getPositionIndexPath(associationsPath)
+    tmpPath = indexPath + ".tmp{0}".format(os.getpid())
+    with open(tmpPath, 'w', encoding="utf-8") as f:
+        f.write(json.dumps(index))
+    os.replace(tmpPath, indexPath)
+    ws.writeStore(index, ws.getStorePath(indexPath), indexPath)
+    return positions
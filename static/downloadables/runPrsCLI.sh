@@ -140,6 +140,11 @@ usage () {
     echo -e "   ${MYSTERYCOLOR}-x${NC} sets the cutoff minor allele frequency value"
     echo -e "   ${MYSTERYCOLOR}-l${NC} individual-specific LD clumping ex. -l"
     echo -e "   ${MYSTERYCOLOR}-h${NC} imputation threshold ex. -h 0.5"
+    echo -e "   ${MYSTERYCOLOR}-d${NC} writes the results in study order ex. -d"
+    echo -e "   ${MYSTERYCOLOR}-w${NC} runs step 2 in the running step 2 daemon (start it with: python step2_daemon.py start) ex. -w"
+    echo -e "   ${MYSTERYCOLOR}-j${NC} number of sample shards each study is split into for the calculations ex. -j 8"
+    echo -e "   ${MYSTERYCOLOR}--resume${NC} (or -z) continues an interrupted run, keeping the studies already in the output file ex. --resume"
+    echo -e "   ${MYSTERYCOLOR}--prefilter${NC} (or -P) leaves the GWAS associations above the p-value cutoff out of the upload ex. --prefilter"
     echo ""
 }
 
@@ -217,8 +222,13 @@ learnAboutParameters () {
         echo -e "| ${LIGHTPURPLE}20${NC} - -x cutoff value for minor allele frequency                 |"
         echo -e "| ${LIGHTPURPLE}21${NC} - -l individual-specific LD clumping                         |"
         echo -e "| ${LIGHTPURPLE}22${NC} - -h imputation threshold                                    |"
+        echo -e "| ${LIGHTPURPLE}23${NC} - -d deterministic study order in the output                 |"
+        echo -e "| ${LIGHTPURPLE}24${NC} - -w use the step 2 daemon                                   |"
+        echo -e "| ${LIGHTPURPLE}25${NC} - -j number of sample shards                                 |"
+        echo -e "| ${LIGHTPURPLE}26${NC} - --resume an interrupted run                                |"
+        echo -e "| ${LIGHTPURPLE}27${NC} - --prefilter the GWAS upload by p-value                     |"
         echo -e "|                                                                 |"
-        echo -e "| ${LIGHTPURPLE}23${NC} - Done                                                       |"
+        echo -e "| ${LIGHTPURPLE}28${NC} - Done                                                       |"
         echo    "|_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _|"
 
         # gets the inputted number from the user
@@ -347,6 +357,7 @@ learnAboutParameters () {
             14 ) echo -e "${MYSTERYCOLOR} -n number of subprocesses: ${NC}"
                 echo "This parameter allows you to choose the number of processes used to run the tool."
                 echo "By default, the Python script will run the calculations using all available nodes."
+                echo "When multiple VCF files are given, they are also filtered in parallel using this many processes."
                 echo "" ;;
             15 ) echo -e "${MYSTERYCOLOR} -u tab separated GWAS data file path: ${NC}"
                 echo "If you wish to calculate polygenic risk scores using your own GWAS data, use this"
@@ -408,7 +419,43 @@ learnAboutParameters () {
                 echo "SNPs can decrease the usefulness of risk scores. We allow the user to choose the ratio"
                 echo "of SNPs present in the sample to imputed SNPs. The default for this parameter is 0.5"
                 echo "" ;;
-            23 ) cont=0 ;;
+            23 ) echo -e "${MYSTERYCOLOR} -d deterministic study order: ${NC}"
+                echo "Results are written to the output file as each study finishes, so when multiple subprocesses"
+                echo "are used the studies can appear in a different order from run to run."
+                echo "Include the -d flag to always write the studies in the same order. The results of studies that"
+                echo "finish early are held in temporary files in the folder <output file>.held until the studies before"
+                echo "them are written."
+                echo "" ;;
+            24 ) echo -e "${MYSTERYCOLOR} -w step 2 daemon: ${NC}"
+                echo "Each run of the tool loads the association, clump, minor allele frequency, and percentile"
+                echo "working files again. When many files are scored with the same data, start the step 2 daemon once with"
+                echo "   python step2_daemon.py start"
+                echo "and include the -w flag. The daemon keeps the working files loaded between runs and reloads"
+                echo "a file only when it has changed. Stop it with: python step2_daemon.py stop"
+                echo "" ;;
+            25 ) echo -e "${MYSTERYCOLOR} -j number of sample shards: ${NC}"
+                echo "By default, the subprocesses each calculate whole studies, so a run with only a few studies"
+                echo "uses only a few subprocesses no matter how many samples the VCF has."
+                echo "This parameter splits the samples into this many groups of neighboring samples, and each"
+                echo "subprocess calculates a study for one group. The results of the groups are put back together"
+                echo "in the original sample order, so the output is the same as without this parameter."
+                echo "It has no effect on rsIDs:genotypes input files. By default, the samples are not split."
+                echo "" ;;
+            26 ) echo -e "${MYSTERYCOLOR} --resume an interrupted run: ${NC}"
+                echo "Each study is recorded in a journal next to the output file (the output file name followed by"
+                echo ".journal) once its results are written. If a run is interrupted, run the same command again with"
+                echo "--resume (or -z) to skip the studies that were already written and add the rest to the output file."
+                echo "The result is the same as a run that wasn't interrupted. The journal is removed when a run finishes."
+                echo "" ;;
+            27 ) echo -e "${MYSTERYCOLOR} --prefilter the GWAS upload by p-value: ${NC}"
+                echo "When a GWAS summary statistics file is uploaded (-u), the clumps, minor allele frequencies, and"
+                echo "possible alleles of every association in it are retrieved, even the ones the p-value cutoff (-c)"
+                echo "will exclude. With --prefilter (or -P), the associations above the p-value cutoff are left out"
+                echo "before they are retrieved, which makes the upload of large files much faster. The associations"
+                echo "left out are still counted in 'SNPs Excluded Due To Cutoffs', so the results are the same."
+                echo "It has no effect without a GWAS file. By default, the upload is not prefiltered."
+                echo "" ;;
+            28 ) cont=0 ;;
             * ) echo "INVALID OPTION";;
         esac
         if [[ "$cont" != "0" ]]; then
@@ -637,6 +684,11 @@ calculatePRS () {
     isCondensedFormat=1
     omitPercentiles=0
     isIndividualClump=0
+    keepStudyOrder=0
+    useDaemon=0
+    sampleShards=""
+    resume=0
+    prefilterGWAS=0
 
     single="'"
     escaped="\'"
@@ -667,7 +719,19 @@ calculatePRS () {
     # create python import paths
     SCRIPT_DIR="/Users/nader/workspace/helixxy/PolyRiskScore/static/downloadables"
 
-    while getopts 'f:o:c:r:p:t:k:i:e:vs:g:n:u:a:by:q:mx:lh:' c "$@"
+    # --resume is the long form of -z and --prefilter is the long form of -P
+    for arg in "$@"; do
+        shift
+        if [[ "$arg" == "--resume" ]]; then
+            set -- "$@" "-z"
+        elif [[ "$arg" == "--prefilter" ]]; then
+            set -- "$@" "-P"
+        else
+            set -- "$@" "$arg"
+        fi
+    done
+
+    while getopts 'f:o:c:r:p:t:k:i:e:vs:g:n:u:a:by:q:mx:lh:dwj:zP' c "$@"
     do
         case $c in
             f)  if ! [ -z "$filename" ]; then
@@ -894,6 +958,22 @@ calculatePRS () {
                     exit 1
                 fi;;
             l)  isIndividualClump=1;;
+            d)  keepStudyOrder=1;;
+            w)  useDaemon=1;;
+            z)  resume=1;;
+            P)  prefilterGWAS=1;;
+            j)  if ! [ -z "$sampleShards" ]; then
+                    echo "Too many sample shard arguments requested at once."
+                    echo -e "${LIGHTRED}Quitting...${NC}"
+                    exit 1
+                fi
+                sampleShards=$OPTARG
+                if (! [[ $sampleShards =~ ^[0-9]+$ ]]) || [[ $sampleShards -lt 1 ]]; then
+                    echo -e "${LIGHTRED}$sampleShards ${NC}is not a valid input for the number of sample shards"
+                    echo "The number of sample shards must be at least 1"
+                    echo -e "${LIGHTRED}Quitting...${NC}"
+                    exit 1
+                fi;;
             h)  if ! [ -z "$imputationLevel" ]; then
                     echo "Too many imputation thresholds given"
                     echo -e "${LIGHTRED}Quitting...${NC}"
@@ -1213,7 +1293,7 @@ calculatePRS () {
             # saves both to files
             # GWAS data --> GWASassociations_{fileHash}.txt
             # clumps --> {superPop}_clumps_{refGen}_{fileHash}.txt
-            if $pyVer "${SCRIPT_DIR}/connect_to_server.py" "GWAS" "${GWASfilename}" "${userGwasBeta}" "${GWASextension}" "${GWASrefgen}" "${refgen}" "${superPop}" "${mafCohort}" "${fileHash}" "${extension}"; then
+            if $pyVer "${SCRIPT_DIR}/connect_to_server.py" "GWAS" "${GWASfilename}" "${userGwasBeta}" "${GWASextension}" "${GWASrefgen}" "${refgen}" "${superPop}" "${mafCohort}" "${fileHash}" "${extension}" "${cutoff}" "${prefilterGWAS}"; then
                 echo "Formatted GWAS data and retrieved clumping information from the PRSKB"
             else
                 echo -e "${LIGHTRED}AN ERROR HAS CAUSED THE TOOL TO EXIT... Quitting${NC}"
@@ -1245,11 +1325,19 @@ calculatePRS () {
             FILE="${SCRIPT_DIR}/.workingFiles/GWASassociations_${fileHash}.txt"
         fi
 
+        # with -w, the filtering and calculations are run by the step 2 daemon, which keeps the working files loaded
+        filterScript=("${SCRIPT_DIR}/grep_file.py")
+        calculateScript=("${SCRIPT_DIR}/parse_associations.py")
+        if [[ $useDaemon -eq 1 ]]; then
+            filterScript=("${SCRIPT_DIR}/step2_daemon.py" filter)
+            calculateScript=("${SCRIPT_DIR}/step2_daemon.py" calculate)
+        fi
+
         # filter the input file so that it only includes the lines with variants that match the given filters
-        if $pyVer "${SCRIPT_DIR}/grep_file.py" "$files" "$fileHash" "$requiredParamsHash" "$superPop" "$refgen" "${sexes}" "${valueTypes}" "$cutoff" "${traits}" "${studyTypes}" "${studyIDs}" "$ethnicities" "$extension" "$TIMESTAMP" "$useGWAS"; then
+        if $pyVer "${filterScript[@]}" "$files" "$fileHash" "$requiredParamsHash" "$superPop" "$refgen" "${sexes}" "${valueTypes}" "$cutoff" "${traits}" "${studyTypes}" "${studyIDs}" "$ethnicities" "$extension" "$TIMESTAMP" "$useGWAS" "$processes"; then
             echo "Filtered input file"
             # parse through the filtered input file and calculate scores for each given study
-            if $pyVer "${SCRIPT_DIR}/parse_associations.py" "$files" "$fileHash" "$requiredParamsHash" "$superPop" "${mafCohort}" "$refgen" "$cutoff" "$mafCutoff" "${imputationLevel}" "$extension" "$output" "$outputType" "$isCondensedFormat" "$omitPercentiles" "$TIMESTAMP" "$processes" "$isIndividualClump" "$useGWAS"; then
+            if $pyVer "${calculateScript[@]}" "$files" "$fileHash" "$requiredParamsHash" "$superPop" "${mafCohort}" "$refgen" "$cutoff" "$mafCutoff" "${imputationLevel}" "$extension" "$output" "$outputType" "$isCondensedFormat" "$omitPercentiles" "$TIMESTAMP" "$processes" "$isIndividualClump" "$useGWAS" "$keepStudyOrder" "$sampleShards" "$resume"; then
                 echo "Parsed through genotype information"
                 echo "Calculated score"
             else
@@ -0,0 +1,253 @@
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import genotype_store as gs
+
+# numpy and scipy are optional. When they are not installed, calculate_score falls back to looping over each sample
+try:
+    import numpy as np
+    from scipy import sparse
+    HAS_SPARSE = True
+except ImportError:
+    HAS_SPARSE = False
+
+
+def getStudyColumns(snpSet, tableObjDict, trait, studyID, pValBetaAnnoValType, valueType):
+    """
+    Builds the weight vector of a trait/study: one column for each (rsID, risk allele) in the study.
+
+    Returns:
+        tuple: (columnIndex, weights, units) where columnIndex maps rsID -> list of (column, riskAllele),
+               weights holds the betaValue (or log of the oddsRatio) and units the betaUnit of each column
+    """
+    columnIndex = {}
+    weights = []
+    units = []
+    for rsID in snpSet:
+        if rsID in tableObjDict['associations'] and not isinstance(tableObjDict['associations'][rsID], str):
+            studies = tableObjDict['associations'][rsID]['traits'].get(trait, {})
+            if studyID in studies and pValBetaAnnoValType in studies[studyID]:
+                for riskAllele, assocInfo in studies[studyID][pValBetaAnnoValType].items():
+                    snpBeta = assocInfo['betaValue'] if valueType == "beta" else math.log(assocInfo['oddsRatio'])
+                    columnIndex.setdefault(rsID, []).append((len(weights), riskAllele))
+                    weights.append(float(snpBeta))
+                    units.append(assocInfo['betaUnit'])
+    return columnIndex, weights, units
+
+
+def getVcfObjEntries(columnIndex, vcfObj, mafDict, sampleOrder):
+    # reads the alleles of each sample from vcfObj (used with individual clumping, where the samples don't share
+    # their variants)
+    rows = []
+    cols = []
+    dosages = [] # risk allele count, with '.' counted as the maf of the risk allele
+    matches = [] # number of alleles that add a beta (risk allele or '.')
+    others = [] # number of alleles that are neither the risk allele nor '.'
+    called = [] # 1 if the sample has at least one non-empty allele
+    for sampleIdx, samp in enumerate(sampleOrder):
+        if samp not in vcfObj:
+            continue
+        for rsID, alleles in vcfObj[samp].items():
+            if rsID not in columnIndex or alleles == "" or alleles is None:
+                continue
+            alleles = [str(allele) for allele in alleles]
+            numMissing = alleles.count(".")
+            numCalled = len(alleles) - alleles.count("")
+            for col, riskAllele in columnIndex[rsID]:
+                numRisk = alleles.count(riskAllele)
+                mafVal = mafDict[rsID]['alleles'][riskAllele] if rsID in mafDict and riskAllele in mafDict[rsID]["alleles"] else 0
+                rows.append(sampleIdx)
+                cols.append(col)
+                dosages.append(numRisk + numMissing * mafVal)
+                matches.append(numRisk + numMissing)
+                others.append(numCalled - numRisk - numMissing)
+                called.append(1 if numCalled > 0 else 0)
+    return rows, cols, dosages, matches, others, called
+
+
+def getGenotypeEntries(columnIndex, vcfObj, mafDict, sampleOrder, genotypeSources):
+    """
+    Builds the same entries as getVcfObjEntries from the int8 allele codes of the genotype store. The alleles of
+    every sample of a variant are counted at once by comparing its codes with each allele code.
+
+    Returns:
+        tuple: the entries as numpy arrays, or None if the samples don't all have the variants of genotypeSources
+    """
+    records = genotypeSources['genotypeStore']['records']
+    sampleStart = genotypeSources['sampleStart']
+    variants = genotypeSources['variants']
+    presentIdxs = [sampleIdx for sampleIdx, samp in enumerate(sampleOrder) if samp in vcfObj]
+    if any(len(vcfObj[sampleOrder[sampleIdx]]) != len(variants) for sampleIdx in presentIdxs):
+        return None
+    presentRows = np.array(presentIdxs, dtype=np.int64)
+    numRows = len(presentRows)
+    noAlleles = np.zeros(numRows, dtype=np.int64)
+
+    entries = ([], [], [], [], [], [])
+    for rsID, columns in columnIndex.items():
+        if rsID not in variants or numRows == 0:
+            continue
+        if variants[rsID] is None:
+            # the variant was imputed, both alleles are unknown
+            alleleCounts = {'.': np.full(numRows, 2, dtype=np.int64)}
+            numCalled = np.full(numRows, 2, dtype=np.int64)
+        else:
+            recordIdx, codeAlleles = variants[rsID]
+            ploidy, codes = records[recordIdx][7:9]
+            if ploidy > 0:
+                sampleCodes = np.frombuffer(codes, dtype=np.int8).reshape(-1, ploidy)[sampleStart + presentRows]
+            else:
+                sampleCodes = np.empty((numRows, 0), dtype=np.int8)
+            numCalled = (sampleCodes != gs.ABSENT_ALLELE).sum(axis=1)
+            # number of copies of each allele in each sample
+            alleleCounts = {}
+            for code in np.unique(sampleCodes).tolist():
+                if code == gs.ABSENT_ALLELE:
+                    continue
+                allele = "." if code == gs.MISSING_ALLELE else codeAlleles[code]
+                count = (sampleCodes == code).sum(axis=1)
+                alleleCounts[allele] = alleleCounts[allele] + count if allele in alleleCounts else count
+
+        numMissing = alleleCounts.get(".", noAlleles)
+        for col, riskAllele in columns:
+            numRisk = alleleCounts.get(riskAllele, noAlleles)
+            mafVal = mafDict[rsID]['alleles'][riskAllele] if rsID in mafDict and riskAllele in mafDict[rsID]["alleles"] else 0
+            entries[0].append(presentRows)
+            entries[1].append(np.full(numRows, col, dtype=np.int64))
+            entries[2].append(numRisk + numMissing * mafVal)
+            entries[3].append(numRisk + numMissing)
+            entries[4].append(numCalled - numRisk - numMissing)
+            entries[5].append((numCalled > 0).astype(np.int64))
+    return tuple(np.concatenate(entry) if entry else np.zeros(0, dtype=np.int64) for entry in entries)
+
+
+def calculateSparseScores(snpSet, vcfObj, tableObjDict, mafDict, neutral_snps_map, trait, studyID, pValBetaAnnoValType, valueType, sampleOrder, genotypeSources=None):
+    """
+    Calculates the polygenic risk score of every sample of a trait/study with a single sparse matrix product.
+
+    The dosage matrix (samples x variants) holds the number of risk alleles each sample carries, with unknown
+    alleles ('.') weighted by the minor allele frequency of the risk allele. Multiplying it by the weights of the
+    study gives the same sum of betas that vcfcalculations builds one sample at a time. With genotypeSources (see
+    parse_associations.getGenotypeSources) the dosages are counted from the allele codes of the genotype store,
+    otherwise from the alleles of each sample in vcfObj.
+
+    Returns:
+        tuple: (scores, sampleUnits) where scores is a list of prs strings in sampleOrder (formatted like
+               getPRSFromArray) and sampleUnits is a list of the sets of beta units used for each sample
+    """
+    columnIndex, weights, units = getStudyColumns(snpSet, tableObjDict, trait, studyID, pValBetaAnnoValType, valueType)
+
+    entries = None
+    if genotypeSources is not None:
+        entries = getGenotypeEntries(columnIndex, vcfObj, mafDict, sampleOrder, genotypeSources)
+    if entries is None:
+        entries = getVcfObjEntries(columnIndex, vcfObj, mafDict, sampleOrder)
+    rows, cols, dosages, matches, others, called = entries
+
+    shape = (len(sampleOrder), len(weights))
+    dosageMatrix = sparse.csr_matrix((dosages, (rows, cols)), shape=shape, dtype=np.float64)
+    matchMatrix = sparse.csr_matrix((matches, (rows, cols)), shape=shape, dtype=np.int64)
+    otherMatrix = sparse.csr_matrix((others, (rows, cols)), shape=shape, dtype=np.int64)
+    calledMatrix = sparse.csr_matrix((called, (rows, cols)), shape=shape, dtype=np.int64)
+    weights = np.array(weights, dtype=np.float64)
+
+    # sum of the betas of each sample
+    betaSums = dosageMatrix.dot(weights)
+    # a sample has betas if any allele matched the risk allele or was unknown
+    hasBetas = np.asarray(matchMatrix.sum(axis=1)).ravel() > 0
+    # a variant is non-missing if it was added to the protective/risk variants (a matching allele with a non-zero beta)
+    # or to the variants without the risk allele (any other allele)
+    nonZeroWeights = (weights != 0).astype(np.int64)
+    counted = (matchMatrix.multiply(nonZeroWeights).tocsr() + otherMatrix) > 0
+    nonMissingSnps = np.asarray(counted.sum(axis=1)).ravel()
+    for sampleIdx, samp in enumerate(sampleOrder):
+        if samp in neutral_snps_map:
+            nonMissingSnps[sampleIdx] += len(neutral_snps_map[samp])
+
+    # apply the same transforms as getPRSFromArray to every sample at once
+    ploidy = 2
+    scorable = hasBetas & (nonMissingSnps > 0)
+    combinedBetas = np.zeros(len(sampleOrder), dtype=np.float64)
+    combinedBetas[scorable] = betaSums[scorable] / (ploidy * nonMissingSnps[scorable])
+    if valueType.lower() == 'or':
+        combinedBetas[scorable] = np.exp(combinedBetas[scorable])
+    scores = [str(float(combinedBetas[i])) if scorable[i] else "NF" for i in range(len(sampleOrder))]
+
+    # beta units used by each sample
+    unitNames = []
+    unitCols = []
+    for unit in units:
+        if unit not in unitNames:
+            unitNames.append(unit)
+        unitCols.append(unitNames.index(unit))
+    unitMatrix = sparse.csr_matrix((np.ones(len(units), dtype=np.int64), (list(range(len(units))), unitCols)), shape=(len(units), len(unitNames)))
+    unitCounts = calledMatrix.dot(unitMatrix).toarray()
+    sampleUnits = [set(unitNames[u] for u in np.flatnonzero(unitCounts[i])) for i in range(len(sampleOrder))]
+
+    return scores, sampleUnits
+
+
+def runBenchmark(numVariants, numSamples):
+    # times the condensed calculations of one study on a synthetic file: the per-sample loop of vcfcalculations,
+    # and the sparse engine with the dosages read from vcfObj and from the allele codes of the genotype store
+    import calculate_score as cs
+    tmpDir = tempfile.mkdtemp()
+    try:
+        vcfPath = os.path.join(tmpDir, "benchmark.vcf")
+        gs.writeBenchmarkVcf(vcfPath, numVariants, numSamples)
+        genotypeStore = gs.readGenotypeStore(vcfPath, {'associations': {}}, gs.readGenotypeRecords)
+        samples = genotypeStore['samples']
+
+        # a study with a beta for every variant, and the vcfObj parse_vcf builds for it without clumps
+        rng = random.Random(0)
+        associations = {}
+        mafDict = {}
+        vcfObj = {samp: {} for samp in samples}
+        variants = {}
+        for recordIdx, record in enumerate(genotypeStore['records']):
+            rsID, REF, ALT = record[0], record[4], record[5]
+            riskAllele = rng.choice([REF] + ALT)
+            associations[rsID] = {'traits': {'trait': {'study': {'NA|NA|beta': {riskAllele: {'pValue': 1e-8, 'betaValue': rng.uniform(-1, 1), 'betaUnit': 'unit'}}}}}}
+            mafDict[rsID] = {'alleles': {riskAllele: rng.random()}}
+            for sampleIdx, samp in enumerate(samples):
+                vcfObj[samp][rsID] = gs.getSampleAlleles(record, sampleIdx)
+            variants[rsID] = (recordIdx, [str(REF)] + [str(x) for x in ALT])
+        tableObjDict = {'associations': associations, 'studyIDsToMetaData': {'study': {'citation': 'citation', 'reportedTrait': 'trait'}}}
+        genotypeSources = {'genotypeStore': genotypeStore, 'sampleStart': 0, 'variants': variants}
+        snpSet = list(associations)
+        counts = {samp: len(snpSet) for samp in samples}
+
+        timings = {}
+        outputs = {}
+        for name, useSparse, sources in (('per-sample loop', False, None), ('sparse, vcfObj dosages', True, None), ('sparse, allele code dosages', True, genotypeSources)):
+            outputPath = os.path.join(tmpDir, "{0}.tsv".format(len(outputs)))
+            cs.ss.HAS_SPARSE = useSparse and HAS_SPARSE
+            startTime = time.time()
+            cs.vcfcalculations(snpSet, vcfObj, tableObjDict, mafDict, {}, False, True, True, {}, {}, outputPath, len(samples), 'trait', 'study', 'NA', 'NA', 'beta', samples, counts, 0, counts, 'eur', sources)
+            timings[name] = time.time() - startTime
+            with open(outputPath, 'r') as f:
+                outputs[name] = f.read()
+        cs.ss.HAS_SPARSE = HAS_SPARSE
+        if outputs['sparse, vcfObj dosages'] != outputs['sparse, allele code dosages']:
+            raise SystemExit("ERROR: The dosages read from vcfObj and from the allele codes gave different scores.")
+        # the loop adds the betas in another order, so its scores may differ in the last few decimal places
+        loopScores = outputs['per-sample loop'].strip().split('\t')[-numSamples:]
+        sparseScores = outputs['sparse, allele code dosages'].strip().split('\t')[-numSamples:]
+        if any(x != y and not math.isclose(float(x), float(y), rel_tol=1e-9) for x, y in zip(loopScores, sparseScores)):
+            raise SystemExit("ERROR: The sparse engine and the per-sample loop calculated different scores.")
+        print(f"[LOG] {numVariants} variants x {numSamples} samples")
+        for name, seconds in timings.items():
+            print(f"[LOG] {name}: {seconds:.3f}s ({timings['per-sample loop'] / max(seconds, 1e-9):.1f}x)")
+    finally:
+        for fileName in os.listdir(tmpDir):
+            os.remove(os.path.join(tmpDir, fileName))
+        os.rmdir(tmpDir)
+
+
+if __name__ == "__main__":
+    # micro-benchmark of the condensed calculations: python sparse_score.py benchmark [numVariants] [numSamples]
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        runBenchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000, int(sys.argv[3]) if len(sys.argv) > 3 else 500)
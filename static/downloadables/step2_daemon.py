@@ -0,0 +1,158 @@
+import json
+import os
+import socket
+import sys
+import traceback
+import grep_file as gf
+import parse_associations as pa
+import output_writer as ow
+import working_store as ws
+
+# Long-running process for step 2 (filtering the input file and calculating the scores).
+#
+# Every run of runPrsCLI.sh normally starts grep_file.py and parse_associations.py, which both load the same
+# association, clump, maf, and percentile working files. The daemon loads them once and keeps them in memory
+# between jobs, reloading a file only when it changes (its mtime or size no longer match). Files read through
+# their binary stores keep only the mapped store between jobs, the values decoded by a job are released after it. Jobs are sent over a
+# Unix socket and run one at a time, with the same arguments grep_file.py and parse_associations.py take.
+#
+# usage (the socket is .workingFiles/step2_daemon.sock unless PRS_DAEMON_SOCKET is set):
+#   python step2_daemon.py start                                          starts the daemon (runs until stopped)
+#   python step2_daemon.py stop                                           stops a running daemon
+#   python step2_daemon.py filter <grep_file.py arguments>                runs grep_file.py in the daemon
+#   python step2_daemon.py calculate <parse_associations.py arguments>    runs parse_associations.py in the daemon
+
+DEFAULT_SOCKET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".workingFiles", "step2_daemon.sock")
+# separates the output of a job from its exit code in the daemon's reply
+EXIT_CODE_MARKER = b"\x00"
+
+
+def startDaemon(socketPath=DEFAULT_SOCKET_PATH):
+    if os.path.exists(socketPath):
+        if isDaemonRunning(socketPath):
+            raise SystemExit(f"ERROR: A daemon is already running at {socketPath}.")
+        # left behind by a daemon that didn't shut down cleanly
+        os.remove(socketPath)
+    os.makedirs(os.path.dirname(os.path.abspath(socketPath)), exist_ok=True)
+
+    ws.keepFilesLoaded()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen(8)
+    print(f"[LOG] Step 2 daemon listening on {socketPath}")
+    sys.stdout.flush()
+
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    job = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+                except ValueError:
+                    continue
+                if job.get('command') == 'stop':
+                    connection.sendall(EXIT_CODE_MARKER + b"0")
+                    break
+                exitCode = runJob(job, connection)
+                connection.sendall(EXIT_CODE_MARKER + str(exitCode).encode('utf-8'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+    print("[LOG] Step 2 daemon stopped")
+    return
+
+
+def runJob(job, connection):
+    # runs a job with its output (including the output of its subprocesses) sent to the client
+    sys.stdout.flush()
+    sys.stderr.flush()
+    savedStdout = os.dup(1)
+    savedStderr = os.dup(2)
+    os.dup2(connection.fileno(), 1)
+    os.dup2(connection.fileno(), 2)
+    exitCode = 0
+    savedCwd = os.getcwd()
+    try:
+        os.chdir(job['cwd'])
+        # forget the working files that changed since the last job
+        ws.dropChangedFiles()
+        if job['command'] == 'filter':
+            gf.createFilteredFile(*job['args'])
+        elif job['command'] == 'calculate':
+            pa.runParsingAndCalculations(*job['args'])
+        else:
+            raise SystemExit(f"ERROR: Unknown daemon command {job['command']}.")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exitCode = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exitCode = 1
+    except Exception:
+        traceback.print_exc()
+        exitCode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(savedStdout, 1)
+        os.dup2(savedStderr, 2)
+        os.close(savedStdout)
+        os.close(savedStderr)
+        os.chdir(savedCwd)
+        # release the data of the job, the working files stay loaded
+        pa.workerData = {}
+        ow.setWriterPipe(None)
+        ws.releaseDecodedFiles()
+    return exitCode
+
+
+def sendJob(command, args, socketPath=DEFAULT_SOCKET_PATH):
+    # sends a job to the daemon, prints its output as it arrives, and returns its exit code
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+    except OSError:
+        raise SystemExit(f"ERROR: Could not connect to the step 2 daemon at {socketPath}. Start it with 'python step2_daemon.py start'.")
+
+    with client:
+        job = {'command': command, 'args': args, 'cwd': os.getcwd()}
+        client.sendall(json.dumps(job).encode('utf-8') + b"\n")
+        output = sys.stdout.buffer
+        reply = b""
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            reply += data
+            # keep everything after a possible exit code marker until the reply is complete
+            markerPos = reply.rfind(EXIT_CODE_MARKER)
+            writeUpTo = markerPos if markerPos != -1 else len(reply)
+            output.write(reply[:writeUpTo])
+            output.flush()
+            reply = reply[writeUpTo:]
+
+    if not reply.startswith(EXIT_CODE_MARKER):
+        raise SystemExit("ERROR: The step 2 daemon stopped before the job finished.")
+    return int(reply[len(EXIT_CODE_MARKER):])
+
+
+def isDaemonRunning(socketPath):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    socketPath = os.environ.get("PRS_DAEMON_SOCKET", DEFAULT_SOCKET_PATH)
+    if sys.argv[1] == "start":
+        startDaemon(socketPath)
+    else:
+        sys.exit(sendJob(sys.argv[1], sys.argv[2:], socketPath))
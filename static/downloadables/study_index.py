@@ -0,0 +1,149 @@
+import json
+import os
+
+# Inverted index of the study metadata in the associations file, used by grep_file.filterStudySnps.
+#
+# Every trait/study key ("trait|pValueAnnotation|betaAnnotation|valueType|studyID") is numbered in the order it is
+# first found in the associations, and each filter value (trait, reported trait, study type, ethnicity, sex, value
+# type, and study ID) maps to the numbers of the keys it selects. Filtering is then a few set operations over the
+# keys instead of a pass over every SNP in the associations. The index is written next to the associations file
+# and is rebuilt when the associations file changes.
+
+STUDY_INDEX_VERSION = 1
+
+
+def getStudyIndexPath(associationsPath):
+    directory, fileName = os.path.split(associationsPath)
+    return os.path.join(directory, "studyIndex_" + fileName)
+
+
+def buildStudyIndex(tableObjDict):
+    """
+    Builds the inverted index of the trait/study keys of the associations.
+
+    Returns:
+        dict: {
+            'keys': trait/study keys in the order they are found in the associations,
+            'byTrait', 'byReportedTrait', 'byStudyType', 'byEthnicity', 'byValueType', 'byStudyID':
+                filter value -> list of key numbers,
+            'sexSpecific': key numbers of the traits studied in males or females
+        }
+    """
+    metaData = tableObjDict['studyIDsToMetaData']
+    keyNumbers = {}
+    index = {
+        'keys': [],
+        'byTrait': {},
+        'byReportedTrait': {},
+        'byStudyType': {},
+        'byEthnicity': {},
+        'byValueType': {},
+        'byStudyID': {},
+        'sexSpecific': []
+    }
+
+    def addKey(indexName, value, keyNumber):
+        keyList = index[indexName].setdefault(value, [])
+        if not keyList or keyList[-1] != keyNumber:
+            keyList.append(keyNumber)
+
+    for snp, snpData in tableObjDict['associations'].items():
+        # only the rsID entries hold the traits, the other entries map positions to rsIDs
+        if not snp.startswith('rs'):
+            continue
+        for trait, studies in snpData['traits'].items():
+            for study, uniqueKeys in studies.items():
+                for uniqueKey in uniqueKeys:
+                    fullKeyString = "|".join([trait, uniqueKey, study])
+                    if fullKeyString in keyNumbers:
+                        continue
+                    keyNumber = len(index['keys'])
+                    keyNumbers[fullKeyString] = keyNumber
+                    index['keys'].append(fullKeyString)
+
+                    studyData = metaData[study]
+                    traitData = studyData['traits'][trait]
+                    addKey('byTrait', trait.lower(), keyNumber)
+                    addKey('byReportedTrait', studyData['reportedTrait'], keyNumber)
+                    # a study type can be given to the whole study or only to the trait
+                    for studyType in set(studyData['studyTypes']) | set(traitData['studyTypes']):
+                        addKey('byStudyType', studyType, keyNumber)
+                    for ethnicity in set(x.lower() for x in studyData['ethnicity']):
+                        addKey('byEthnicity', ethnicity, keyNumber)
+                    addKey('byValueType', uniqueKey.split("|")[2], keyNumber)
+                    addKey('byStudyID', study, keyNumber)
+                    if len(set(traitData['sexes']) & set(['male', 'female'])) > 0:
+                        index['sexSpecific'].append(keyNumber)
+
+    return index
+
+
+def writeStudyIndex(tableObjDict, associationsPath):
+    # builds the index of the associations file at associationsPath and writes it next to the file
+    index = buildStudyIndex(tableObjDict)
+    sourceStat = os.stat(associationsPath)
+    index['version'] = STUDY_INDEX_VERSION
+    index['sourceMtime'] = sourceStat.st_mtime_ns
+    index['sourceSize'] = sourceStat.st_size
+    indexPath = getStudyIndexPath(associationsPath)
+    tmpPath = indexPath + ".tmp{0}".format(os.getpid())
+    with open(tmpPath, 'w', encoding="utf-8") as f:
+        f.write(json.dumps(index))
+    os.replace(tmpPath, indexPath)
+    return index
+
+
+def loadStudyIndex(associationsPath, tableObjDict):
+    # returns the index of the associations file, building it if it is missing or out of date
+    indexPath = getStudyIndexPath(associationsPath)
+    sourceStat = os.stat(associationsPath)
+    try:
+        with open(indexPath, 'r', encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get('version') == STUDY_INDEX_VERSION and index.get('sourceMtime') == sourceStat.st_mtime_ns and index.get('sourceSize') == sourceStat.st_size:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    print(f"[LOG] Building the study index of {associationsPath}")
+    try:
+        return writeStudyIndex(tableObjDict, associationsPath)
+    except OSError as e:
+        print(f"[LOG] Could not write the study index for {associationsPath}: {e}")
+        return buildStudyIndex(tableObjDict)
+
+
+def selectKeys(index, traits, studyTypes, studyIDs, ethnicities, sexes, valueTypes, isOnlyStudyIDs):
+    """
+    Selects the trait/study keys that pass the filters (formatted by grep_file.formatVarForFiltering).
+    A key is selected if its study ID was requested, or if it passes every other filter that was given.
+
+    Returns:
+        list: the selected keys, in the order they are found in the associations
+    """
+    def union(indexName, values):
+        keyNumbers = set()
+        for value in values:
+            keyNumbers.update(index[indexName].get(value, []))
+        return keyNumbers
+
+    selected = set()
+    if not isOnlyStudyIDs:
+        selected = set(range(len(index['keys'])))
+        if traits is not None:
+            selected &= union('byTrait', traits) | union('byReportedTrait', traits)
+        if studyTypes is not None:
+            selected &= union('byStudyType', studyTypes)
+        if ethnicities is not None:
+            selected &= union('byEthnicity', ethnicities)
+        if sexes is not None:
+            if 'e' in sexes or 'exclude' in sexes:
+                selected -= set(index['sexSpecific'])
+            else:
+                selected &= set(index['sexSpecific'])
+        if valueTypes is not None:
+            selected &= union('byValueType', valueTypes)
+    if studyIDs is not None:
+        selected |= union('byStudyID', studyIDs)
+
+    return [index['keys'][keyNumber] for keyNumber in sorted(selected)]
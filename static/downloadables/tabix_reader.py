@@ -0,0 +1,314 @@
+import gzip
+import os
+import struct
+import zlib
+from bisect import bisect_right
+
+# Random access into bgzipped VCF files through their tabix (.tbi) or CSI (.csi) index.
+#
+# A bgzipped file is a series of independently compressed gzip blocks of at most 64KB. A virtual offset points to
+# a line inside the file: the upper 48 bits are the position of the compressed block in the file and the lower 16
+# bits are the position inside the uncompressed block. The index maps bins of genomic positions to chunks
+# (ranges of virtual offsets) that hold the records of the bin, so only the blocks that hold the requested
+# positions are read and decompressed.
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+TBI_MAGIC = b"TBI\x01"
+CSI_MAGIC = b"CSI\x01"
+# binning scheme of tabix indexes (CSI indexes store their own)
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+def findIndexPath(vcfPath):
+    # returns the path of the tabix or CSI index of a bgzipped VCF, or None if there isn't one
+    if not vcfPath.lower().endswith((".gz", ".bgz")) or not isBgzf(vcfPath):
+        return None
+    for indexPath in (vcfPath + ".tbi", vcfPath + ".csi"):
+        if os.path.exists(indexPath):
+            return indexPath
+    return None
+
+
+def isBgzf(path):
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+class BgzfReader:
+    """
+    Reads lines from a bgzipped file starting at a virtual offset. The last block read is kept, so reading
+    chunks that share a block only decompresses it once.
+    """
+
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        self.blockOffset = None
+        self.blockData = b""
+        self.nextBlockOffset = 0
+
+    def close(self):
+        self.handle.close()
+
+    def loadBlock(self, blockOffset):
+        # loads the block that starts at blockOffset in the file. Returns False at the end of the file
+        if blockOffset == self.blockOffset:
+            return True
+        self.handle.seek(blockOffset)
+        header = self.handle.read(12)
+        if len(header) < 12:
+            return False
+        if header[:4] != BGZF_MAGIC:
+            raise SystemExit("ERROR: The bgzipped input file is corrupted or is not in BGZF format. Compress it with 'bgzip' and index it with 'tabix -p vcf', or remove the index file to read the whole file.")
+        extraLength = struct.unpack('<H', header[10:12])[0]
+        extra = self.handle.read(extraLength)
+        blockSize = None
+        position = 0
+        # the BSIZE subfield holds the total size of the block minus 1
+        while position + 4 <= len(extra):
+            subfieldId = extra[position:position + 2]
+            subfieldLength = struct.unpack('<H', extra[position + 2:position + 4])[0]
+            if subfieldId == b"BC":
+                blockSize = struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+            position += 4 + subfieldLength
+        if blockSize is None:
+            raise SystemExit("ERROR: The bgzipped input file is corrupted or is not in BGZF format.")
+        compressed = self.handle.read(blockSize - 12 - extraLength - 8)
+        self.handle.read(8) # crc32 and uncompressed size
+        self.blockData = zlib.decompress(compressed, -15)
+        self.blockOffset = blockOffset
+        self.nextBlockOffset = blockOffset + blockSize
+        return True
+
+    def readLines(self, startOffset, endOffset=None):
+        """
+        Yields (virtualOffset, line) for every line that starts at or after the virtual offset startOffset and
+        before endOffset (or the end of the file). Lines are decoded as utf-8 and keep their newline.
+        """
+        if not self.loadBlock(startOffset >> 16):
+            return
+        position = startOffset & 0xFFFF
+        pending = []
+        lineOffset = None
+        while True:
+            # lines that start at the end of a block start at the beginning of the next block
+            if position >= len(self.blockData):
+                if not self.loadBlock(self.nextBlockOffset):
+                    break
+                position = 0
+                continue
+            if lineOffset is None:
+                lineOffset = (self.blockOffset << 16) | position
+                if endOffset is not None and lineOffset >= endOffset:
+                    return
+            newline = self.blockData.find(b"\n", position)
+            if newline == -1:
+                pending.append(self.blockData[position:])
+                position = len(self.blockData)
+                continue
+            pending.append(self.blockData[position:newline + 1])
+            position = newline + 1
+            yield lineOffset, b"".join(pending).decode('utf-8')
+            pending = []
+            lineOffset = None
+        if pending:
+            yield lineOffset, b"".join(pending).decode('utf-8')
+
+
+class TabixIndex:
+    """
+    A tabix (.tbi) or CSI (.csi) index of a bgzipped VCF.
+
+    Attributes:
+        names: reference (chromosome) names in the order of the file
+        references: one (bins, linearIndex) tuple for each reference, where bins maps bin -> (loffset, chunks)
+    """
+
+    def __init__(self, indexPath):
+        with gzip.open(indexPath, 'rb') as f:
+            data = f.read()
+        magic = data[:4]
+        if magic == TBI_MAGIC:
+            self.minShift = TBI_MIN_SHIFT
+            self.depth = TBI_DEPTH
+            numRefs = struct.unpack_from('<i', data, 4)[0]
+            position = self.readNames(data, 8)
+        elif magic == CSI_MAGIC:
+            self.minShift, self.depth, auxLength = struct.unpack_from('<iii', data, 4)
+            if auxLength < 28:
+                raise SystemExit(f"ERROR: The CSI index {indexPath} does not hold the names of the chromosomes. Index the VCF with 'tabix --csi -p vcf' or 'bcftools index'.")
+            self.readNames(data, 16)
+            position = 16 + auxLength
+            numRefs = struct.unpack_from('<i', data, position)[0]
+            position += 4
+        else:
+            raise SystemExit(f"ERROR: {indexPath} is not a tabix or CSI index.")
+
+        isCsi = magic == CSI_MAGIC
+        self.references = []
+        for _ in range(numRefs):
+            numBins = struct.unpack_from('<i', data, position)[0]
+            position += 4
+            bins = {}
+            for _ in range(numBins):
+                if isCsi:
+                    binNum, loffset, numChunks = struct.unpack_from('<IQi', data, position)
+                    position += 16
+                else:
+                    binNum, numChunks = struct.unpack_from('<Ii', data, position)
+                    loffset = 0
+                    position += 8
+                chunks = struct.unpack_from('<' + 'Q' * (2 * numChunks), data, position)
+                position += 16 * numChunks
+                bins[binNum] = (loffset, list(zip(chunks[0::2], chunks[1::2])))
+            linearIndex = ()
+            if not isCsi:
+                numIntervals = struct.unpack_from('<i', data, position)[0]
+                position += 4
+                linearIndex = struct.unpack_from('<' + 'Q' * numIntervals, data, position)
+                position += 8 * numIntervals
+            self.references.append((bins, linearIndex))
+
+    def readNames(self, data, position):
+        # reads the tabix header (format, columns, meta character, names) and returns the position after it
+        self.format, self.colSeq, self.colBeg, self.colEnd, meta, self.skip, namesLength = struct.unpack_from('<iiiiiii', data, position)
+        self.meta = chr(meta)
+        position += 28
+        self.names = [name.decode('utf-8') for name in data[position:position + namesLength].split(b"\x00") if name]
+        return position + namesLength
+
+    def getReferenceName(self, chrom):
+        # the chromosome name used by the file ('chr1' and '1' refer to the same chromosome)
+        if chrom in self.names:
+            return chrom
+        otherName = chrom[3:] if chrom.startswith('chr') else 'chr' + chrom
+        if otherName in self.names:
+            return otherName
+        return None
+
+    def getBins(self, beg, end):
+        # bins that may hold records overlapping the 0-based, end exclusive region [beg, end)
+        bins = []
+        end -= 1
+        shift = self.minShift + self.depth * 3
+        firstBin = 0
+        for level in range(self.depth + 1):
+            bins.extend(range(firstBin + (beg >> shift), firstBin + (end >> shift) + 1))
+            shift -= 3
+            firstBin += 1 << (level * 3)
+        return bins
+
+    def getMinOffset(self, refIdx, beg):
+        # records that start before this virtual offset can't overlap a region starting at beg
+        bins, linearIndex = self.references[refIdx]
+        if linearIndex:
+            return linearIndex[min(beg >> TBI_MIN_SHIFT, len(linearIndex) - 1)]
+        # CSI indexes store the offset of the first record of each bin, use the smallest bin that holds beg
+        for level in range(self.depth, -1, -1):
+            firstBin = ((1 << (level * 3)) - 1) // 7
+            binNum = firstBin + (beg >> (self.minShift + (self.depth - level) * 3))
+            if binNum in bins:
+                return bins[binNum][0]
+        return 0
+
+    def getChunks(self, chrom, beg, end):
+        # chunks (begin, end virtual offsets) that may hold records in the 0-based, end exclusive region [beg, end)
+        name = self.getReferenceName(chrom)
+        if name is None:
+            return []
+        refIdx = self.names.index(name)
+        bins = self.references[refIdx][0]
+        minOffset = self.getMinOffset(refIdx, beg)
+        chunks = []
+        for binNum in self.getBins(beg, end):
+            if binNum in bins:
+                chunks.extend(chunk for chunk in bins[binNum][1] if chunk[1] > minOffset)
+        return chunks
+
+
+def parseRegions(regionsList):
+    """
+    Parses regions in the format "chr:start-end" or "chr:pos" (1-based, inclusive) and merges the ones that overlap.
+
+    Returns:
+        dict: chrom -> sorted list of (start, end) tuples, or None if a region couldn't be parsed
+    """
+    regions = {}
+    for region in regionsList:
+        if ':' not in region:
+            return None
+        chrom, span = region.rsplit(':', 1)
+        try:
+            if '-' in span:
+                start, end = [int(x) for x in span.split('-')]
+            else:
+                start = end = int(span)
+        except ValueError:
+            return None
+        regions.setdefault(chrom, []).append((start, end))
+
+    for chrom in regions:
+        merged = []
+        for start, end in sorted(regions[chrom]):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        regions[chrom] = merged
+    return regions
+
+
+def openRegions(vcfPath, indexPath, regionsList):
+    """
+    Yields the header lines of a bgzipped VCF and then, in file order, only the records inside the given regions.
+
+    Args:
+        vcfPath: path of the bgzipped VCF
+        indexPath: path of its .tbi or .csi index
+        regionsList: regions in the format "chr:start-end" or "chr:pos"
+    """
+    index = TabixIndex(indexPath)
+    regions = parseRegions(regionsList)
+
+    # regions by the chromosome names used in the file, and the chunks of the file that hold them
+    fileRegions = {}
+    chunks = []
+    for chrom, chromRegions in regions.items():
+        name = index.getReferenceName(chrom)
+        if name is None:
+            continue
+        fileRegions[name] = ([start for start, end in chromRegions], [end for start, end in chromRegions])
+        for start, end in chromRegions:
+            chunks.extend(index.getChunks(name, start - 1, end))
+
+    # merge the chunks so that every block is read once and every record is visited once
+    mergedChunks = []
+    for chunkBegin, chunkEnd in sorted(chunks):
+        if mergedChunks and chunkBegin <= mergedChunks[-1][1]:
+            mergedChunks[-1][1] = max(mergedChunks[-1][1], chunkEnd)
+        else:
+            mergedChunks.append([chunkBegin, chunkEnd])
+    print(f"[LOG] Tabix index {indexPath}: reading {len(mergedChunks)} chunks for {sum(len(x) for x in regions.values())} regions")
+
+    reader = BgzfReader(vcfPath)
+    try:
+        for _, line in reader.readLines(0):
+            if not line.startswith(index.meta):
+                break
+            yield line
+
+        for chunkBegin, chunkEnd in mergedChunks:
+            for _, line in reader.readLines(chunkBegin, chunkEnd):
+                if line.startswith(index.meta):
+                    continue
+                cols = line[0:500].split('\t', 2)
+                if cols[0] not in fileRegions or len(cols) < 2:
+                    continue
+                starts, ends = fileRegions[cols[0]]
+                pos = int(cols[1])
+                regionIdx = bisect_right(starts, pos) - 1
+                if regionIdx >= 0 and pos <= ends[regionIdx]:
+                    yield line
+    finally:
+        reader.close()
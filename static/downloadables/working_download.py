@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import json
+import os
+import urllib.parse
+import http_cache as hc
+import download_manager as dm
+
+# Downloads the working files (associations, clumps, maf, percentiles, ...) from the server and keeps them current.
+#
+# The first download of a file is a plain GET. The ETag and Last-Modified headers sent with it are recorded in the
+# response cache (http_cache.py), and later refreshes send them back as If-None-Match and If-Modified-Since:
+#   304 Not Modified   the local file is current and is left as it is
+#   226 IM Used        (RFC 3229 delta encoding, requested with "A-IM: merge-patch") the body is a JSON merge patch
+#                      (RFC 7396) from the version named by If-None-Match to the version in the new ETag. It is
+#                      applied to the local file. Patches are ignored if their Delta-Base isn't the local version
+#   200 OK             the body is the whole file, for servers (or versions) without patches
+# Whole files are streamed to disk as they are received, without being parsed, so the memory used doesn't depend on
+# the size of the file. They are checked against the Content-Length and the checksum the server sends (Repr-Digest,
+# RFC 9530, or Digest, RFC 3230) before they are used. Files are written to a temporary file and renamed over the
+# working file, so an interrupted or corrupted download leaves the previous version in place. The validators are recorded after the rename; if that is interrupted the next refresh
+# asks for a patch from the older version, and since merge patches set values rather than change them, applying it
+# to the newer file gives the same result.
+
+PATCH_FORMAT = "merge-patch"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# checksums the server may send, strongest first, and their hashlib names
+DIGEST_ALGORITHMS = (('sha-512', 'sha512'), ('sha-256', 'sha256'), ('md5', 'md5'))
+
+
+def getLastChecked(path):
+    # time the working file at path was last downloaded or confirmed current by the server (0 if it doesn't exist)
+    if not os.path.exists(path):
+        return 0
+    download = hc.getCache().getDownload(path)
+    checked = download['checked'] if download is not None else 0
+    return max(os.path.getmtime(path), checked)
+
+
+def writeJsonFile(path, data):
+    tmpPath = path + ".tmp{0}".format(os.getpid())
+    with open(tmpPath, 'w', encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmpPath, path)
+
+
+def applyMergePatch(target, patch):
+    # applies a JSON merge patch: dictionaries are merged key by key, null removes a key, anything else replaces
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = applyMergePatch(target.get(key), value)
+    return target
+
+
+def requestFile(url, params, headers):
+    # sends the request without reading the body. The caller must close the response
+    print(f"[LOG] GET URL: {url}?{urllib.parse.urlencode(params, doseq=True)}")
+    # the checksums the server sends cover the content-coded body, while requests gives back the decoded body, so
+    # the body is requested without compression
+    headers = dict(headers, **{'Accept-Encoding': 'identity'})
+    response = dm.getSession().get(url=url, params=params, headers=headers, stream=True)
+    if not response:
+        response.close()
+    assert (response), "Error connecting to the server: {0} - {1}".format(response.status_code, response.reason)
+    return response
+
+
+def getExpectedDigest(response):
+    # returns the (hashlib name, digest) of the strongest checksum the server sent for the body, or None
+    digests = {}
+    for header in ('Repr-Digest', 'Digest'):
+        for item in response.headers.get(header, "").split(','):
+            algorithm, _, value = item.strip().partition('=')
+            try:
+                digests.setdefault(algorithm.lower(), base64.b64decode(value.strip(':')))
+            except ValueError:
+                continue
+    for algorithm, hashName in DIGEST_ALGORITHMS:
+        if algorithm in digests:
+            return hashName, digests[algorithm]
+    return None
+
+
+def streamToFile(response, path):
+    # writes the body of the response to path, checking its length and checksum before it replaces the file
+    fileName = os.path.basename(path)
+    # a server that compressed the body anyway sent the checksum and Content-Length of the compressed body
+    isEncoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+    expectedDigest = getExpectedDigest(response) if not isEncoded else None
+    hashName = expectedDigest[0] if expectedDigest is not None else 'sha256'
+    digest = hashlib.new(hashName)
+    size = 0
+    tmpPath = path + ".tmp{0}".format(os.getpid())
+    try:
+        with open(tmpPath, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        contentLength = response.headers.get('Content-Length')
+        if contentLength is not None and not isEncoded:
+            assert size == int(contentLength), f"The download of {fileName} was cut short ({size} of {contentLength} bytes)"
+        if expectedDigest is not None:
+            assert digest.digest() == expectedDigest[1], f"The download of {fileName} is corrupted (its {hashName} checksum doesn't match the server's)"
+        os.replace(tmpPath, path)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+    if expectedDigest is not None:
+        verified = "verified"
+    elif isEncoded:
+        verified = "not verified, the server compressed the body"
+    else:
+        verified = "not verified, the server sent no checksum"
+    print(f"[LOG] Downloaded {fileName} ({size / (1024 * 1024):.2f} MB, {hashName} {digest.hexdigest()} {verified})")
+
+
+def downloadWorkingFile(path, url, params):
+    """
+    Brings the working file at path up to date with the file the server sends for url and params.
+
+    Returns:
+        bool: True if the file was downloaded or patched, False if the local file was already current
+    """
+    fileName = os.path.basename(path)
+    cache = hc.getCache()
+    download = cache.getDownload(path)
+    headers = {}
+    if download is not None:
+        if download['etag']:
+            headers['If-None-Match'] = download['etag']
+            headers['A-IM'] = PATCH_FORMAT
+        if download['lastModified']:
+            headers['If-Modified-Since'] = download['lastModified']
+
+    response = requestFile(url, params, headers)
+    try:
+        if response.status_code == 304 and download is not None:
+            print(f"[LOG] {fileName} is up to date")
+            cache.putDownload(path, download['etag'], download['lastModified'])
+            return False
+
+        if response.status_code == 226:
+            if download is not None and response.headers.get('IM') == PATCH_FORMAT and response.headers.get('Delta-Base', download['etag']) == download['etag']:
+                # patches are small, but applying one means loading the file
+                with open(path, 'r', encoding="utf-8") as f:
+                    data = json.load(f)
+                data = applyMergePatch(data, response.json())
+                writeJsonFile(path, data)
+                cache.putDownload(path, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                print(f"[LOG] Patched {fileName} to the latest version ({len(response.content) / (1024 * 1024):.2f} MB patch)")
+                return True
+            print(f"[LOG] Could not apply the patch the server sent for {fileName}, downloading the whole file")
+            response.close()
+            response = requestFile(url, params, {})
+
+        streamToFile(response, path)
+        cache.putDownload(path, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    finally:
+        response.close()
+    return True
@@ -0,0 +1,529 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Mapping
+
+# Binary store for the large JSON working files (associations, clumps, maf, percentiles, ...)
+#
+# The store is written next to the JSON file it was created from and is memory-mapped when read, so opening it
+# costs almost no parsing time and the pages are shared between every process that reads it. Nested dictionaries
+# are only decoded when they are accessed, and association leaf dictionaries (pValue, oddsRatio, betaValue, ...)
+# are stored as rows of columnar arrays. The keys of each dictionary are found through an open addressing hash
+# table (crc32 of the key, linear probing) stored with the dictionary, whose slots hold (key index + 1, crc32).
+#
+# Layout (native byte order, sections aligned to 8 bytes):
+#   header | string offsets (uint64) | string data (utf-8) | record layouts (json) | record columns | nodes
+STORE_MAGIC = b'PRSKBWF\x00'
+STORE_VERSION = 2
+STORE_EXTENSION = ".bin"
+ENDIAN_MARKER = 0x01020304
+
+HEADER_FORMAT = '=8sIIqq' + 'Q' * 10
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# node type tags
+NONE_NODE = 0
+FALSE_NODE = 1
+TRUE_NODE = 2
+INT_NODE = 3
+BIGINT_NODE = 4 # integers that don't fit in 64 bits, stored as their decimal string
+FLOAT_NODE = 5
+STR_NODE = 6
+LIST_NODE = 7
+DICT_NODE = 8
+RECORD_NODE = 9
+
+# association leaf dictionaries are stored as rows of these columns
+RECORD_NUMBER_FIELDS = ('pValue', 'oddsRatio', 'betaValue')
+RECORD_STRING_FIELDS = ('betaUnit', 'sex', 'ogValueTypes')
+RECORD_FIELDS = set(RECORD_NUMBER_FIELDS + RECORD_STRING_FIELDS)
+# how a number field of a record was stored
+NUMBER_NONE = 0
+NUMBER_INT = 1
+NUMBER_FLOAT = 2
+NO_STRING = 0xFFFFFFFF
+# StoreDict.decoded values for keys that aren't in the dictionary
+NOT_FOUND = object()
+
+# stores that have already been opened by this process, by path
+openStores = {}
+# working files kept loaded between runs by a long-running process (see step2_daemon.py), by path:
+# (mtime_ns, size, contents). None unless keepFilesLoaded has been called
+loadedFiles = None
+
+
+def getStorePath(jsonPath):
+    return os.path.splitext(jsonPath)[0] + STORE_EXTENSION
+
+
+def loadWorkingFile(jsonPath, useStore=True):
+    """
+    Loads a JSON working file. If useStore is True, the file is read through its binary store, which is created
+    the first time the file is loaded (or when the JSON file has changed since the store was written).
+
+    Returns:
+        dict-like: the contents of the file. Dictionaries read from the store are read-only mappings
+    """
+    if not useStore:
+        with open(jsonPath, 'r', encoding="utf-8") as f:
+            return json.load(f)
+
+    storePath = getStorePath(jsonPath)
+    sourceStat = os.stat(jsonPath)
+    if loadedFiles is not None:
+        loaded = loadedFiles.get(jsonPath)
+        if loaded is not None and loaded[0] == sourceStat.st_mtime_ns and loaded[1] == sourceStat.st_size:
+            return loaded[2]
+
+    store = openStore(storePath, sourceStat)
+    if store is not None:
+        data = store.getRoot()
+    else:
+        with open(jsonPath, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+        try:
+            writeStore(data, storePath, jsonPath)
+        except OSError as e:
+            print(f"[LOG] Could not write the binary store for {jsonPath}: {e}")
+
+    if loadedFiles is not None:
+        loadedFiles[jsonPath] = (sourceStat.st_mtime_ns, sourceStat.st_size, data)
+    return data
+
+
+def keepFilesLoaded():
+    # keeps the working files loaded in memory until the JSON file changes. Files read through their binary stores
+    # keep their stores mapped, the values decoded from them are released after each run (see releaseDecodedFiles)
+    global loadedFiles
+    if loadedFiles is None:
+        loadedFiles = {}
+    return
+
+
+def releaseDecodedFiles():
+    # forgets the values decoded from the stores (including the keys that were looked up and not found), so that a
+    # long-running process doesn't grow with every input it scores. The stores stay open in openStores
+    if loadedFiles is None:
+        return
+    for jsonPath in list(loadedFiles):
+        if isinstance(loadedFiles[jsonPath][2], StoreDict):
+            del loadedFiles[jsonPath]
+    for store in openStores.values():
+        store.strings = {}
+    return
+
+
+def dropChangedFiles():
+    # forgets the loaded working files that were changed or removed since they were loaded
+    if loadedFiles is None:
+        return
+    for jsonPath in list(loadedFiles):
+        mtime, size, data = loadedFiles[jsonPath]
+        try:
+            sourceStat = os.stat(jsonPath)
+        except OSError:
+            sourceStat = None
+        if sourceStat is None or sourceStat.st_mtime_ns != mtime or sourceStat.st_size != size:
+            print(f"[LOG] {jsonPath} changed since it was loaded")
+            del loadedFiles[jsonPath]
+            openStores.pop(getStorePath(jsonPath), None)
+    return
+
+
+def openStore(storePath, sourceStat=None):
+    # returns the opened store, or None if the store is missing, from another version, or out of date with its JSON file
+    store = openStores.get(storePath)
+    if store is None:
+        try:
+            store = WorkingFileStore(storePath)
+        except (OSError, ValueError):
+            return None
+    if sourceStat is not None and (store.sourceMtime != sourceStat.st_mtime_ns or store.sourceSize != sourceStat.st_size):
+        openStores.pop(storePath, None)
+        return None
+    openStores[storePath] = store
+    return store
+
+
+def openStoreNode(storePath, offset):
+    # used to unpickle dictionaries from the store (e.g. when they are sent to a worker process)
+    store = openStores.get(storePath)
+    if store is None:
+        store = WorkingFileStore(storePath)
+        openStores[storePath] = store
+    return store.getNode(offset)
+
+
+def convertWorkingFile(jsonPath):
+    # converts an existing JSON working file into a binary store
+    with open(jsonPath, 'r', encoding="utf-8") as f:
+        data = json.load(f)
+    storePath = getStorePath(jsonPath)
+    writeStore(data, storePath, jsonPath)
+    return storePath
+
+
+def writeStore(data, storePath, sourcePath):
+    """
+    Writes data (as loaded from the JSON working file at sourcePath) to a binary store at storePath.
+    The store is written to a temporary file first so that other processes never see a partial store.
+    """
+    writer = StoreWriter()
+    rootOffset = writer.addNode(data)
+
+    sourceStat = os.stat(sourcePath)
+    stringOffsets = [0]
+    stringData = bytearray()
+    for string in writer.strings:
+        stringData += string.encode('utf-8')
+        stringOffsets.append(len(stringData))
+    layoutData = json.dumps(writer.layouts).encode('utf-8')
+
+    sections = [
+        array('Q', stringOffsets).tobytes(),
+        bytes(stringData),
+        layoutData,
+        writer.getRecordColumns(),
+        bytes(writer.nodes)
+    ]
+    positions = []
+    position = HEADER_SIZE
+    for section in sections:
+        position = alignPosition(position)
+        positions.append(position)
+        position += len(section)
+
+    header = struct.pack(HEADER_FORMAT, STORE_MAGIC, STORE_VERSION, ENDIAN_MARKER, sourceStat.st_mtime_ns, sourceStat.st_size,
+        len(writer.strings), positions[0], positions[1], positions[2], len(layoutData), len(writer.layoutIds), positions[3], positions[4], rootOffset, 0)
+
+    tmpPath = "{0}.{1}.tmp".format(storePath, os.getpid())
+    try:
+        with open(tmpPath, 'wb') as f:
+            f.write(header)
+            for sectionPosition, section in zip(positions, sections):
+                f.write(b'\x00' * (sectionPosition - f.tell()))
+                f.write(section)
+        os.replace(tmpPath, storePath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+    print(f"[LOG] Wrote binary store {storePath} ({len(writer.strings)} strings, {len(writer.layoutIds)} association records)")
+    return
+
+
+def alignPosition(position):
+    return (position + 7) // 8 * 8
+
+
+def getTableSize(numKeys):
+    # the hash table of a dictionary is a power of two at most half full
+    return 1 << (2 * numKeys - 1).bit_length() if numKeys else 0
+
+
+class StoreWriter(object):
+    # encodes JSON data into the string table, record columns, and nodes of a store
+    def __init__(self):
+        self.strings = []
+        self.stringIds = {}
+        self.layouts = []
+        self.layoutIndex = {}
+        self.nodes = bytearray()
+        self.scalarNodes = {}
+        # record columns
+        self.numbers = [[] for x in RECORD_NUMBER_FIELDS]
+        self.numberKinds = [[] for x in RECORD_NUMBER_FIELDS]
+        self.stringColumns = [[] for x in RECORD_STRING_FIELDS]
+        self.layoutIds = []
+
+    def getStringId(self, string):
+        sid = self.stringIds.get(string)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(string)
+            self.stringIds[string] = sid
+        return sid
+
+    def addScalar(self, key, packed):
+        # identical scalars share a single node
+        offset = self.scalarNodes.get(key)
+        if offset is None:
+            offset = len(self.nodes)
+            self.nodes += packed
+            self.scalarNodes[key] = offset
+        return offset
+
+    def addNode(self, value):
+        # children are written before their parents so that their offsets are known
+        if value is None:
+            return self.addScalar((NONE_NODE,), struct.pack('=B', NONE_NODE))
+        elif value is True:
+            return self.addScalar((TRUE_NODE,), struct.pack('=B', TRUE_NODE))
+        elif value is False:
+            return self.addScalar((FALSE_NODE,), struct.pack('=B', FALSE_NODE))
+        elif isinstance(value, int):
+            if -2**63 <= value < 2**63:
+                return self.addScalar((INT_NODE, value), struct.pack('=Bq', INT_NODE, value))
+            return self.addScalar((BIGINT_NODE, value), struct.pack('=BI', BIGINT_NODE, self.getStringId(str(value))))
+        elif isinstance(value, float):
+            packed = struct.pack('=Bd', FLOAT_NODE, value)
+            return self.addScalar(packed, packed)
+        elif isinstance(value, str):
+            sid = self.getStringId(value)
+            return self.addScalar((STR_NODE, sid), struct.pack('=BI', STR_NODE, sid))
+        elif isinstance(value, list):
+            children = [self.addNode(x) for x in value]
+            offset = len(self.nodes)
+            self.nodes += struct.pack('=BI', LIST_NODE, len(children))
+            self.nodes += array('Q', children).tobytes()
+            return offset
+        elif isinstance(value, dict):
+            if self.isRecord(value):
+                return self.addRecord(value)
+            keys = list(value.keys())
+            keyIds = [self.getStringId(key) for key in keys]
+            children = [self.addNode(value[key]) for key in keys]
+            # keys keep their JSON order for iteration, and a hash table is used for lookups
+            tableSize = getTableSize(len(keys))
+            table = array('I', bytes(8 * tableSize))
+            for i, key in enumerate(keys):
+                keyHash = zlib.crc32(key.encode('utf-8'))
+                slot = keyHash & (tableSize - 1)
+                while table[2 * slot]:
+                    slot = (slot + 1) & (tableSize - 1)
+                table[2 * slot] = i + 1
+                table[2 * slot + 1] = keyHash
+            offset = len(self.nodes)
+            self.nodes += struct.pack('=BI', DICT_NODE, len(keys))
+            self.nodes += array('I', keyIds).tobytes() + array('Q', children).tobytes() + table.tobytes()
+            return offset
+        else:
+            raise ValueError("Cannot store a value of type {} in a working file store".format(type(value).__name__))
+
+    def isRecord(self, value):
+        if not value or not all(key in RECORD_FIELDS for key in value):
+            return False
+        # layout ids are stored in a uint8 column
+        if tuple(value.keys()) not in self.layoutIndex and len(self.layouts) > 255:
+            return False
+        for key in RECORD_NUMBER_FIELDS:
+            number = value.get(key)
+            if isinstance(number, bool) or not (number is None or isinstance(number, float) or (isinstance(number, int) and abs(number) < 2**53)):
+                return False
+        for key in RECORD_STRING_FIELDS:
+            if not (value.get(key) is None or isinstance(value.get(key), str)):
+                return False
+        return True
+
+    def addRecord(self, value):
+        layout = tuple(value.keys())
+        layoutId = self.layoutIndex.get(layout)
+        if layoutId is None:
+            layoutId = len(self.layouts)
+            self.layouts.append(list(layout))
+            self.layoutIndex[layout] = layoutId
+
+        row = len(self.layoutIds)
+        self.layoutIds.append(layoutId)
+        for i, key in enumerate(RECORD_NUMBER_FIELDS):
+            number = value.get(key)
+            if number is None:
+                self.numbers[i].append(0.0)
+                self.numberKinds[i].append(NUMBER_NONE)
+            else:
+                self.numbers[i].append(float(number))
+                self.numberKinds[i].append(NUMBER_INT if isinstance(number, int) else NUMBER_FLOAT)
+        for i, key in enumerate(RECORD_STRING_FIELDS):
+            string = value.get(key)
+            self.stringColumns[i].append(NO_STRING if string is None else self.getStringId(string))
+
+        offset = len(self.nodes)
+        self.nodes += struct.pack('=BI', RECORD_NODE, row)
+        return offset
+
+    def getRecordColumns(self):
+        # float64 columns, then uint32 string id columns, then uint8 number kind and layout columns
+        columns = bytearray()
+        for column in self.numbers:
+            columns += array('d', column).tobytes()
+        for column in self.stringColumns:
+            columns += array('I', column).tobytes()
+        for column in self.numberKinds:
+            columns += array('B', column).tobytes()
+        columns += array('B', self.layoutIds).tobytes()
+        return bytes(columns)
+
+
+class WorkingFileStore(object):
+    # a memory-mapped store. Nodes are decoded from the mapped file as they are accessed
+    def __init__(self, storePath):
+        self.path = storePath
+        with open(storePath, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER_SIZE:
+            raise ValueError("The working file store {} is too small".format(storePath))
+        (magic, version, endianMarker, self.sourceMtime, self.sourceSize, stringCount, stringOffsetsPos, stringDataPos,
+            layoutPos, layoutSize, recordCount, recordPos, self.nodesPos, self.rootOffset, reserved) = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION or endianMarker != ENDIAN_MARKER:
+            raise ValueError("The working file store {} was written by a different version of the tool".format(storePath))
+
+        self.buffer = buffer = memoryview(self.mm)
+        self.stringOffsets = buffer[stringOffsetsPos:stringOffsetsPos + 8 * (stringCount + 1)].cast('Q')
+        self.stringDataPos = stringDataPos
+        self.layouts = [tuple(layout) for layout in json.loads(bytes(buffer[layoutPos:layoutPos + layoutSize]).decode('utf-8'))]
+
+        position = recordPos
+        self.numberColumns = []
+        for key in RECORD_NUMBER_FIELDS:
+            self.numberColumns.append(buffer[position:position + 8 * recordCount].cast('d'))
+            position += 8 * recordCount
+        self.stringColumns = []
+        for key in RECORD_STRING_FIELDS:
+            self.stringColumns.append(buffer[position:position + 4 * recordCount].cast('I'))
+            position += 4 * recordCount
+        self.numberKinds = []
+        for key in RECORD_NUMBER_FIELDS:
+            self.numberKinds.append(buffer[position:position + recordCount])
+            position += recordCount
+        self.layoutIds = buffer[position:position + recordCount]
+
+        self.strings = {}
+
+    def getStringBytes(self, sid):
+        start = self.stringDataPos + self.stringOffsets[sid]
+        end = self.stringDataPos + self.stringOffsets[sid + 1]
+        return self.mm[start:end]
+
+    def getString(self, sid):
+        string = self.strings.get(sid)
+        if string is None:
+            string = self.getStringBytes(sid).decode('utf-8')
+            self.strings[sid] = string
+        return string
+
+    def getRoot(self):
+        return self.getNode(self.rootOffset)
+
+    def getNode(self, offset):
+        position = self.nodesPos + offset
+        tag = self.mm[position]
+        if tag == DICT_NODE:
+            return StoreDict(self, offset)
+        elif tag == RECORD_NODE:
+            return self.getRecord(struct.unpack_from('=I', self.mm, position + 1)[0])
+        elif tag == STR_NODE:
+            return self.getString(struct.unpack_from('=I', self.mm, position + 1)[0])
+        elif tag == FLOAT_NODE:
+            return struct.unpack_from('=d', self.mm, position + 1)[0]
+        elif tag == INT_NODE:
+            return struct.unpack_from('=q', self.mm, position + 1)[0]
+        elif tag == LIST_NODE:
+            n = struct.unpack_from('=I', self.mm, position + 1)[0]
+            return [self.getNode(child) for child in struct.unpack_from('=' + 'Q' * n, self.mm, position + 5)]
+        elif tag == NONE_NODE:
+            return None
+        elif tag == TRUE_NODE:
+            return True
+        elif tag == FALSE_NODE:
+            return False
+        elif tag == BIGINT_NODE:
+            return int(self.getString(struct.unpack_from('=I', self.mm, position + 1)[0]))
+        raise ValueError("The working file store {} is corrupted".format(self.path))
+
+    def getRecord(self, row):
+        record = {}
+        for key in self.layouts[self.layoutIds[row]]:
+            if key in RECORD_NUMBER_FIELDS:
+                i = RECORD_NUMBER_FIELDS.index(key)
+                kind = self.numberKinds[i][row]
+                if kind == NUMBER_NONE:
+                    record[key] = None
+                elif kind == NUMBER_INT:
+                    record[key] = int(self.numberColumns[i][row])
+                else:
+                    record[key] = self.numberColumns[i][row]
+            else:
+                sid = self.stringColumns[RECORD_STRING_FIELDS.index(key)][row]
+                record[key] = None if sid == NO_STRING else self.getString(sid)
+        return record
+
+
+class StoreDict(Mapping):
+    """
+    Read-only dictionary backed by a dictionary node of a store. Values (and missing keys) are decoded the first
+    time they are looked up and kept, so repeated lookups cost about the same as a dict lookup.
+    """
+    __slots__ = ('store', 'offset', 'size', 'keyIds', 'children', 'table', 'decoded')
+
+    def __init__(self, store, offset):
+        self.store = store
+        self.offset = offset
+        position = store.nodesPos + offset
+        self.size = struct.unpack_from('=I', store.mm, position + 1)[0]
+        keyIdsPos = position + 5
+        childrenPos = keyIdsPos + 4 * self.size
+        tablePos = childrenPos + 8 * self.size
+        self.keyIds = store.buffer[keyIdsPos:childrenPos].cast('I')
+        self.children = store.buffer[childrenPos:tablePos].cast('Q')
+        self.table = store.buffer[tablePos:tablePos + 8 * getTableSize(self.size)].cast('I')
+        self.decoded = {}
+
+    def findIndex(self, key):
+        # probes the hash table from the crc32 of the key until the key or an empty slot is found
+        if not isinstance(key, str) or not self.size:
+            return -1
+        table = self.table
+        mask = len(table) // 2 - 1
+        keyHash = zlib.crc32(key.encode('utf-8'))
+        slot = keyHash & mask
+        entry = table[2 * slot]
+        while entry:
+            if table[2 * slot + 1] == keyHash and self.store.getString(self.keyIds[entry - 1]) == key:
+                return entry - 1
+            slot = (slot + 1) & mask
+            entry = table[2 * slot]
+        return -1
+
+    def decode(self, key):
+        index = self.findIndex(key)
+        value = self.store.getNode(self.children[index]) if index >= 0 else NOT_FOUND
+        self.decoded[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.decoded.get(key, None)
+        if value is None and key not in self.decoded:
+            value = self.decode(key)
+        if value is NOT_FOUND:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        value = self.decoded.get(key, NOT_FOUND)
+        if value is NOT_FOUND and key not in self.decoded:
+            value = self.decode(key)
+        return value is not NOT_FOUND
+
+    def __iter__(self):
+        for sid in self.keyIds:
+            yield self.store.getString(sid)
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        # only the location of the node is pickled. The receiving process maps the same file
+        return (openStoreNode, (self.store.path, self.offset))
+
+
+if __name__ == "__main__":
+    # convert existing JSON working files: python working_store.py <jsonFile> [<jsonFile> ...]
+    for jsonPath in sys.argv[1:]:
+        convertWorkingFile(jsonPath)
@@ -14,6 +14,7 @@ exports.version = async (req,res) => {
 
 exports.download = (req,res) => {
     downloadPath = path.join(__dirname, '../..', 'downloadables')
+    chainPath = path.join(__dirname, '../../..', 'update_database_scripts')
     res.zip({
         files: [{
             path: path.join(downloadPath, '/parse_associations.py'),
@@ -27,6 +28,66 @@ exports.download = (req,res) => {
         }, {
             path: path.join(downloadPath, '/calculate_score.py'),
             name: '/calculate_score.py'
+        }, {
+            path: path.join(downloadPath, '/genotype_store.py'),
+            name: '/genotype_store.py'
+        }, {
+            path: path.join(downloadPath, '/sparse_score.py'),
+            name: '/sparse_score.py'
+        }, {
+            path: path.join(downloadPath, '/working_store.py'),
+            name: '/working_store.py'
+        }, {
+            path: path.join(downloadPath, '/output_writer.py'),
+            name: '/output_writer.py'
+        }, {
+            path: path.join(downloadPath, '/step2_daemon.py'),
+            name: '/step2_daemon.py'
+        }, {
+            path: path.join(downloadPath, '/tabix_reader.py'),
+            name: '/tabix_reader.py'
+        }, {
+            path: path.join(downloadPath, '/study_index.py'),
+            name: '/study_index.py'
+        }, {
+            path: path.join(downloadPath, '/position_index.py'),
+            name: '/position_index.py'
+        }, {
+            path: path.join(downloadPath, '/http_cache.py'),
+            name: '/http_cache.py'
+        }, {
+            path: path.join(downloadPath, '/working_download.py'),
+            name: '/working_download.py'
+        }, {
+            path: path.join(downloadPath, '/download_manager.py'),
+            name: '/download_manager.py'
+        }, {
+            path: path.join(downloadPath, '/allele_store.py'),
+            name: '/allele_store.py'
+        }, {
+            path: path.join(downloadPath, '/liftover.py'),
+            name: '/liftover.py'
+        }, {
+            path: path.join(downloadPath, '/gwas_ingest.py'),
+            name: '/gwas_ingest.py'
+        }, {
+            path: path.join(downloadPath, '/filtered_input_cache.py'),
+            name: '/filtered_input_cache.py'
+        }, {
+            path: path.join(downloadPath, '/http_check.py'),
+            name: '/http_check.py'
+        }, {
+            path: path.join(chainPath, '/hg19ToHg38.over.chain'),
+            name: '/chainFiles/hg19ToHg38.over.chain'
+        }, {
+            path: path.join(chainPath, '/hg38ToHg19.over.chain'),
+            name: '/chainFiles/hg38ToHg19.over.chain'
+        }, {
+            path: path.join(chainPath, '/hg19ToHg18.over.chain'),
+            name: '/chainFiles/hg19ToHg18.over.chain'
+        }, {
+            path: path.join(chainPath, '/hg19ToHg17.over.chain'),
+            name: '/chainFiles/hg19ToHg17.over.chain'
         }, {
             path: path.join(downloadPath, '/runPrsCLI.sh'),
             name: '/runPrsCLI.sh'